@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+#
+# Use of several HCI controllers, e.g. the onboard one plus USB dongles. Every
+# powered adapter BlueZ exports gets its own DeviceDiscovery, and each device
+# is assigned to one adapter when its session is created:
+#
+#   - an adapter the device is still connected through keeps it,
+#   - otherwise the adapter with the best score wins, where the score is the
+#     RSSI the adapter last saw the device with (UNSEEN_RSSI if never) minus
+#     LOAD_WEIGHT dB per session the adapter already has,
+#   - adapters at max_connections sessions take no more devices.
+#
+# When an adapter goes away (Powered false, or its object is removed) its
+# sessions are moved to the other adapters; sessions that fit nowhere stay and
+# reconnect once it is back. Devices are not moved back when it recovers, the
+# adapter only takes new ones again.
+
+import collections
+import dbus
+import logging
+import bluetooth_constants
+import bluetooth_utils
+import metrics
+import sys
+sys.path.insert(0, '.')
+
+from device_discovery import DeviceDiscovery
+from device_session import STATE_NOTIFYING
+
+log = logging.getLogger("thunderboard")
+
+# dB of RSSI worth one session less on an adapter
+LOAD_WEIGHT = 10
+# RSSI assumed for a device an adapter has not seen
+UNSEEN_RSSI = -100
+
+class AdapterState(object):
+    """
+    Sessions and health of one adapter
+    """
+
+    def __init__(self, path, discovery, max_connections, available):
+        self.path = path
+        self.name = path[path.rfind("/") + 1:]
+        self.discovery = discovery
+        self.max_connections = max_connections
+        self.available = available
+        # bdaddr -> DeviceSession
+        self.sessions = {}
+
+    def load(self):
+        return len(self.sessions)
+
+    def connected(self):
+        return sum(1 for session in self.sessions.values() if session.state == STATE_NOTIFYING)
+
+    def has_room(self):
+        return self.available and len(self.sessions) < self.max_connections
+
+
+class AdapterScheduler(object):
+    """
+    Devices spread over the adapters by load and RSSI, moved off failed adapters
+    """
+
+    def __init__(self, bus, session_factory, scan_timeout, max_connections=10,
+                 max_devices=1024, max_age=300.0, adapter_names=None):
+        self.bus = bus
+        # session_factory(bdaddr, discovery) returns a new, not started DeviceSession
+        self.session_factory = session_factory
+        # session_removed(session) after a session was stopped for a migration
+        self.session_removed = None
+        self.scan_timeout = scan_timeout
+        self.max_connections = max_connections
+        self.max_devices = max_devices
+        self.max_age = max_age
+        # only these adapters (e.g. hci0, hci1) if given, all otherwise
+        self.adapter_names = set(adapter_names) if adapter_names else None
+        self.adapters = collections.OrderedDict()
+        # bdaddr -> DeviceSession
+        self.sessions = {}
+        # devices no adapter had room for
+        self.waiting = []
+        self.running = False
+        self.matches = []
+        self.objects = {}
+
+    # Enumerate the adapters and seed their registries from one GetManagedObjects
+    def start(self):
+        om = dbus.Interface(self.bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, "/"),
+                            bluetooth_constants.DBUS_OM_IFACE)
+        self.objects = om.GetManagedObjects(byte_arrays=True)
+        for path, interfaces in sorted(self.objects.items()):
+            if bluetooth_constants.ADAPTER_INTERFACE in interfaces:
+                self.add_adapter(str(path), interfaces[bluetooth_constants.ADAPTER_INTERFACE])
+
+        namespace = bluetooth_constants.BLUEZ_NAMESPACE.rstrip("/")
+        self.matches.append(bluetooth_utils.MatchRule(self.bus, self.adapter_properties_changed,
+                bluetooth_constants.DBUS_PROPERTIES, "PropertiesChanged",
+                path_namespace = namespace, arg0 = bluetooth_constants.ADAPTER_INTERFACE,
+                path_keyword = "path"))
+        self.matches.append(bluetooth_utils.MatchRule(self.bus, self.interfaces_added,
+                bluetooth_constants.DBUS_OM_IFACE, "InterfacesAdded",
+                path = "/", arg0path = bluetooth_constants.BLUEZ_NAMESPACE))
+        self.matches.append(bluetooth_utils.MatchRule(self.bus, self.interfaces_removed,
+                bluetooth_constants.DBUS_OM_IFACE, "InterfacesRemoved",
+                path = "/", arg0path = bluetooth_constants.BLUEZ_NAMESPACE))
+
+    def add_adapter(self, path, properties):
+        state = self.adapters.get(path)
+        if state is not None:
+            self.set_available(state, bool(properties.get('Powered', False)))
+            return
+        name = path[path.rfind("/") + 1:]
+        if self.adapter_names is not None and name not in self.adapter_names:
+            return
+        discovery = DeviceDiscovery(self.bus, path, self.scan_timeout,
+                                    max_devices=self.max_devices, max_age=self.max_age)
+        discovery.load_managed_objects(objects=self.objects)
+        state = AdapterState(path, discovery, self.max_connections,
+                             bool(properties.get('Powered', False)))
+        self.adapters[path] = state
+        log.info("Adapter %s %s, %d device(s) known", name,
+                 "powered" if state.available else "not powered", len(discovery.devices))
+        metrics.registry.gauge("thunderboard_adapter_%s_sessions" % name,
+                               "Devices assigned to adapter " + name, state.load)
+        metrics.registry.gauge("thunderboard_adapter_%s_connected" % name,
+                               "Devices notifying through adapter " + name, state.connected)
+        if state.available:
+            self.assign_waiting()
+
+    # first powered adapter, for what runs on one adapter only (passive scan,
+    # GATT server)
+    def primary(self):
+        for state in self.adapters.values():
+            if state.available:
+                return state
+        return None
+
+    def choose(self, bdaddr, exclude=None):
+        best = None
+        best_score = None
+        for state in self.adapters.values():
+            if state is exclude or not state.has_room():
+                continue
+            record = state.discovery.devices.get_by_address(bdaddr)
+            if record is not None and record.connected:
+                return state
+            rssi = UNSEEN_RSSI
+            if record is not None and record.rssi is not None:
+                rssi = record.rssi
+            score = rssi - LOAD_WEIGHT * state.load()
+            if best is None or score > best_score:
+                best = state
+                best_score = score
+        return best
+
+    # Create the session of a device on the best adapter, None if all are full
+    def assign(self, bdaddr):
+        bdaddr = bdaddr.upper()
+        if bdaddr in self.sessions:
+            return self.sessions[bdaddr]
+        state = self.choose(bdaddr)
+        if state is None:
+            if bdaddr not in self.waiting:
+                log.warning("%s: No adapter has room, waiting", bdaddr)
+                self.waiting.append(bdaddr)
+            return None
+        session = self.session_factory(bdaddr, state.discovery)
+        state.sessions[bdaddr] = session
+        self.sessions[bdaddr] = session
+        log.info("%s: Assigned to %s (%d/%d)", bdaddr, state.name, state.load(),
+                 state.max_connections)
+        if self.running:
+            session.start()
+        return session
+
+    # The device is no longer wanted, e.g. after a reload of the device list.
+    # Returns its session, which the caller stops, or None.
+    def remove(self, bdaddr):
+        bdaddr = bdaddr.upper()
+        if bdaddr in self.waiting:
+            self.waiting.remove(bdaddr)
+        session = self.sessions.pop(bdaddr, None)
+        for state in self.adapters.values():
+            state.sessions.pop(bdaddr, None)
+        if session is not None:
+            self.assign_waiting()
+        return session
+
+    def assign_waiting(self):
+        waiting = self.waiting
+        self.waiting = []
+        for bdaddr in waiting:
+            self.assign(bdaddr)
+
+    # Start the sessions, after the GATT objects BlueZ already exported were
+    # handed to other_objects(path, interfaces)
+    def run(self, other_objects=None):
+        if other_objects is not None:
+            for path, interfaces in self.objects.items():
+                if bluetooth_constants.DEVICE_INTERFACE not in interfaces and \
+                        bluetooth_constants.ADAPTER_INTERFACE not in interfaces:
+                    other_objects(path, interfaces)
+        self.objects = {}
+        self.running = True
+        for session in self.sessions.values():
+            session.start()
+
+    def set_available(self, state, available):
+        if available == state.available:
+            return
+        state.available = available
+        if available:
+            log.info("Adapter %s is back", state.name)
+            self.assign_waiting()
+        else:
+            log.warning("Adapter %s failed, moving %d device(s)", state.name, state.load())
+            for bdaddr in list(state.sessions):
+                self.migrate(state, bdaddr)
+
+    def migrate(self, state, bdaddr):
+        target = self.choose(bdaddr, exclude=state)
+        if target is None:
+            log.warning("%s: No other adapter has room, staying on %s", bdaddr, state.name)
+            return
+        session = state.sessions.pop(bdaddr)
+        session.link_lost()
+        session.stop()
+        if self.session_removed is not None:
+            self.session_removed(session)
+        metrics.migrations.inc()
+        log.info("%s: Moving from %s to %s", bdaddr, state.name, target.name)
+        session = self.session_factory(bdaddr, target.discovery)
+        target.sessions[bdaddr] = session
+        self.sessions[bdaddr] = session
+        if self.running:
+            session.start()
+
+    def adapter_properties_changed(self, interface, changed, invalidated, path):
+        state = self.adapters.get(path)
+        if state is not None and 'Powered' in changed:
+            self.set_available(state, bool(changed['Powered']))
+
+    def interfaces_added(self, path, interfaces):
+        if bluetooth_constants.ADAPTER_INTERFACE in interfaces:
+            self.add_adapter(str(path), interfaces[bluetooth_constants.ADAPTER_INTERFACE])
+
+    def interfaces_removed(self, path, interfaces):
+        state = self.adapters.get(path)
+        if state is not None and bluetooth_constants.ADAPTER_INTERFACE in interfaces:
+            self.set_available(state, False)
+
+    # adapter name -> sessions, connected, max and available, e.g. for logs
+    def utilization(self):
+        return dict((state.name, {"sessions": state.load(), "connected": state.connected(),
+                                  "max": state.max_connections, "available": state.available})
+                    for state in self.adapters.values())
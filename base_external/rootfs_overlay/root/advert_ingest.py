@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+#
+# Passive ingestion: events are taken from the advertising data BlueZ reports
+# while scanning (ManufacturerData and ServiceData of Device1) instead of from
+# GATT notifications, so the number of boards is not limited by the
+# connections the controller supports.
+#
+# Every change of a device's advertising data is published to
+#   <prefix>/<device>/advert   {"ts":<ms>,"rssi":<dBm>,"manufacturer":{"<id>":"<hex>"},
+#                               "service":{"<uuid>":"<hex>"}}
+# Data equal to what was last published for the device is dropped, unless
+# min_interval seconds have passed since, which makes a beacon with constant
+# data show up as a heartbeat. RSSI changes alone are never published.
+
+import binascii
+import collections
+import json
+import time
+import bluetooth_utils
+import event_payload
+import metrics
+import sys
+sys.path.insert(0, '.')
+
+class AdvertIngest(object):
+    """
+    Publishes the advertising data of scanned devices, dropping repeats
+    """
+
+    def __init__(self, publisher, topic_prefix, addresses=None, min_interval=60.0,
+                 max_devices=1024):
+        self.publisher = publisher
+        self.topic_prefix = topic_prefix
+        self.min_interval = min_interval
+        self.max_devices = max_devices
+        # device path -> [topic, manufacturer data, service data, last publish time],
+        # None for devices not in addresses, least recently received first
+        self.last = collections.OrderedDict()
+        self.set_addresses(addresses)
+
+    # only these addresses if given, all devices otherwise. On a change (gateway
+    # reload) the devices skipped so far are looked at again and those no
+    # longer listed are dropped.
+    def set_addresses(self, addresses):
+        self.addresses = set(address.upper() for address in addresses) if addresses else None
+        for path, state in list(self.last.items()):
+            if state is None or (self.addresses is not None and
+                                 bluetooth_utils.device_path_to_address(path).upper()
+                                 not in self.addresses):
+                del self.last[path]
+
+    # DeviceDiscovery advert callback: changed holds the Device1 properties that
+    # changed (all of them for a new device), record is the DeviceRecord
+    def advert_received(self, path, changed, record):
+        state = self.last.get(path, False)
+        if state is None:
+            return
+        if state is False:
+            address = record.address or bluetooth_utils.device_path_to_address(path)
+            if len(self.last) >= self.max_devices:
+                self.last.popitem(last=False)
+            if self.addresses is not None and address.upper() not in self.addresses:
+                self.last[path] = None
+                return
+            state = [event_payload.device_topic(self.topic_prefix, address, "advert"), None, None, 0]
+            self.last[path] = state
+        else:
+            self.last.move_to_end(path)
+        metrics.adverts.inc()
+
+        manufacturer = changed.get('ManufacturerData', state[1])
+        service = changed.get('ServiceData', state[2])
+        now = time.monotonic()
+        if manufacturer == state[1] and service == state[2] and now - state[3] < self.min_interval:
+            metrics.advert_duplicates.inc()
+            return
+        state[1] = manufacturer
+        state[2] = service
+        state[3] = now
+        rssi = record.rssi
+        self.publisher.publish(state[0], encode_advert(time.time(), rssi, manufacturer, service))
+
+def encode_advert(timestamp, rssi, manufacturer, service):
+    advert = {"ts": int(timestamp * 1000)}
+    if rssi is not None:
+        advert["rssi"] = int(rssi)
+    if manufacturer:
+        advert["manufacturer"] = dict(("%04x" % company, binascii.hexlify(bytes(data)).decode())
+                                      for company, data in manufacturer.items())
+    if service:
+        advert["service"] = dict((str(uuid), binascii.hexlify(bytes(data)).decode())
+                                 for uuid, data in service.items())
+    return json.dumps(advert, separators=(",", ":")).encode()
@@ -0,0 +1,588 @@
+#!/usr/bin/python3
+#
+# asyncio version of the gateway, an alternative to thunderboard_EFR32BG22.py
+# for many boards. D-Bus goes through dbus-next and MQTT through paho driven by
+# the same event loop, so there are no callbacks on other threads and no
+# blocking calls: connect, service resolution and StartNotify of every device
+# run as concurrent coroutines, each D-Bus call with a timeout, and a board that
+# does not answer only holds up its own session.
+#
+# Signals are matched per device: a session adds one match rule on its device
+# path namespace (Device1 and GATT PropertiesChanged), plus one rule for the
+# InterfacesAdded of the adapter shared by all sessions, and the messages are
+# handed to the session owning the path.
+#
+#   python3 async_gateway.py [-f devices.txt] [bdaddr ...]
+#
+# Topics and payloads are the same as the GLib gateway's, see event_payload.py.
+
+import argparse
+import asyncio
+import logging
+import random
+import signal
+import threading
+import time
+import bluetooth_constants
+import bluetooth_utils
+import event_payload
+import metrics
+import mqtt_constants
+import sys
+sys.path.insert(0, '.')
+
+from dbus_next import BusType, Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+from paho.mqtt import client as mqtt_client
+
+log = logging.getLogger("thunderboard")
+
+DBUS_SERVICE_NAME = "org.freedesktop.DBus"
+DBUS_PATH = "/org/freedesktop/DBus"
+
+# seconds, reconnect policy as in DeviceSession
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+CONNECT_TIMEOUT = 20
+RESOLVE_TIMEOUT = 30
+CALL_TIMEOUT = 10
+
+STATE_DISCONNECTED = "disconnected"
+STATE_SCANNING = "scanning"
+STATE_CONNECTING = "connecting"
+STATE_RESOLVING = "resolving"
+STATE_NOTIFYING = "notifying"
+
+class BluezError(Exception):
+    """
+    Error reply of a D-Bus call
+    """
+
+    def __init__(self, name, message=""):
+        Exception.__init__(self, "%s: %s" % (name, message))
+        self.name = name
+
+
+class BluezClient(object):
+    """
+    D-Bus calls to BlueZ with timeouts, scanning shared by the sessions, and
+    signal dispatch to the session watching a device path
+    """
+
+    def __init__(self, bus, adapter_path):
+        self.bus = bus
+        self.adapter_path = adapter_path
+        # device path -> handler(message)
+        self.watchers = {}
+        # device path -> futures waiting for the device to appear
+        self.wanted = {}
+        self.scan_users = 0
+        bus.add_message_handler(self.dispatch)
+
+    async def call(self, path, interface, member, signature="", body=None, timeout=CALL_TIMEOUT,
+                   destination=bluetooth_constants.BLUEZ_SERVICE_NAME):
+        message = Message(destination=destination, path=path, interface=interface, member=member,
+                          signature=signature, body=body or [])
+        reply = await asyncio.wait_for(self.bus.call(message), timeout)
+        if reply.message_type == MessageType.ERROR:
+            raise BluezError(reply.error_name, reply.body[0] if reply.body else "")
+        return reply.body
+
+    async def add_match(self, rule):
+        await self.call(DBUS_PATH, DBUS_SERVICE_NAME, "AddMatch", "s", [rule],
+                        destination=DBUS_SERVICE_NAME)
+
+    async def remove_match(self, rule):
+        await self.call(DBUS_PATH, DBUS_SERVICE_NAME, "RemoveMatch", "s", [rule],
+                        destination=DBUS_SERVICE_NAME)
+
+    # InterfacesAdded of every object on the adapter, for scanning and for the
+    # GATT objects appearing during service resolution
+    async def start(self):
+        await self.add_match("type='signal',sender='%s',interface='%s',member='InterfacesAdded',"
+                             "arg0path='%s/'" % (bluetooth_constants.BLUEZ_SERVICE_NAME,
+                                                 bluetooth_constants.DBUS_OM_IFACE,
+                                                 self.adapter_path))
+
+    def watch_rule(self, device_path):
+        return "type='signal',sender='%s',interface='%s',member='PropertiesChanged'," \
+               "path_namespace='%s'" % (bluetooth_constants.BLUEZ_SERVICE_NAME,
+                                        bluetooth_constants.DBUS_PROPERTIES, device_path)
+
+    async def watch(self, device_path, handler):
+        self.watchers[device_path] = handler
+        await self.add_match(self.watch_rule(device_path))
+
+    async def unwatch(self, device_path):
+        if self.watchers.pop(device_path, None) is not None:
+            await self.remove_match(self.watch_rule(device_path))
+
+    def dispatch(self, message):
+        if message.message_type != MessageType.SIGNAL:
+            return
+        if message.member == "InterfacesAdded":
+            path, interfaces = message.body
+            if bluetooth_constants.DEVICE_INTERFACE in interfaces:
+                for future in self.wanted.pop(path, ()):
+                    if not future.done():
+                        future.set_result(True)
+        else:
+            path = message.path
+        handler = self.watchers.get(bluetooth_utils.object_path_to_device_path(path))
+        if handler is not None:
+            handler(message)
+
+    async def start_scan(self):
+        self.scan_users += 1
+        if self.scan_users > 1:
+            return
+        try:
+            await self.call(self.adapter_path, bluetooth_constants.ADAPTER_INTERFACE,
+                            "SetDiscoveryFilter", "a{sv}", [{"Transport": Variant("s", "le")}])
+            await self.call(self.adapter_path, bluetooth_constants.ADAPTER_INTERFACE,
+                            "StartDiscovery")
+        except BluezError as e:
+            if e.name != "org.bluez.Error.InProgress":
+                raise
+
+    async def stop_scan(self):
+        self.scan_users -= 1
+        if self.scan_users > 0:
+            return
+        try:
+            await self.call(self.adapter_path, bluetooth_constants.ADAPTER_INTERFACE,
+                            "StopDiscovery")
+        except BluezError:
+            pass
+
+    # True once BlueZ knows the device, scanning for up to timeout seconds if
+    # it does not yet
+    async def find_device(self, device_path, timeout):
+        try:
+            await self.call(device_path, bluetooth_constants.DBUS_PROPERTIES, "Get", "ss",
+                            [bluetooth_constants.DEVICE_INTERFACE, "Address"])
+            return True
+        except BluezError:
+            pass
+        future = asyncio.get_running_loop().create_future()
+        self.wanted.setdefault(device_path, []).append(future)
+        start = time.monotonic()
+        try:
+            # inside the try so a failed start still drops the scan user
+            await self.start_scan()
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiting = self.wanted.get(device_path)
+            if waiting is not None and future in waiting:
+                waiting.remove(future)
+                if not waiting:
+                    del self.wanted[device_path]
+            metrics.discovery_seconds.observe(time.monotonic() - start)
+            await self.stop_scan()
+
+
+class MqttLoop(object):
+    """
+    paho-mqtt client run by the asyncio loop through its socket callbacks
+    """
+
+    def __init__(self, client, broker, port, topic_prefix):
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.client = client
+        self.broker = broker
+        self.port = port
+        self.topic_prefix = topic_prefix
+        self.misc_task = None
+        self.connect_task = None
+        self.stopping = False
+        # callback(device id, value) for LED commands
+        self.command_handler = None
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        client.will_set(event_payload.gateway_topic(topic_prefix, "status"),
+                        event_payload.STATUS_OFFLINE, qos=1, retain=True)
+
+    # the socket callbacks come from the executor running connect() or from
+    # the loop itself, where the socket may be closed right after
+    def in_loop(self, func, *args):
+        if threading.get_ident() == self.thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.in_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.in_loop(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.in_loop(self.loop.remove_writer, sock)
+
+    def start(self):
+        self.misc_task = self.loop.create_task(self.misc_loop())
+        self.connect_task = self.loop.create_task(self.connect())
+
+    # keepalive pings and retries
+    async def misc_loop(self):
+        while True:
+            self.client.loop_misc()
+            await asyncio.sleep(1)
+
+    # the TCP connect blocks, it runs in the default executor
+    async def connect(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self.stopping:
+            try:
+                await self.loop.run_in_executor(None, self.client.connect, self.broker, self.port)
+                return
+            except OSError as e:
+                log.error("MQTT connect to %s:%d failed, %s", self.broker, self.port, e)
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            delay = min(RECONNECT_MAX_DELAY, delay * 2)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            log.error("MQTT connect refused, return code %d", rc)
+            return
+        log.info("Connected to MQTT Broker!")
+        client.publish(event_payload.gateway_topic(self.topic_prefix, "status"),
+                       event_payload.STATUS_ONLINE, qos=1, retain=True)
+        client.subscribe(self.topic_prefix + "/+/led/set")
+
+    def on_disconnect(self, client, userdata, rc):
+        log.info("Disconnected from MQTT Broker, return code %d", rc)
+        if not self.stopping and (self.connect_task is None or self.connect_task.done()):
+            self.connect_task = self.loop.create_task(self.connect())
+
+    def on_message(self, client, userdata, message):
+        parts = message.topic.split("/")
+        value = event_payload.decode_command(message.payload)
+        if len(parts) < 3 or value is None or self.command_handler is None:
+            log.warning("Ignoring command on %s: %r", message.topic, message.payload)
+            return
+        self.command_handler(parts[-3], value)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def stop(self):
+        self.stopping = True
+        if self.connect_task is not None:
+            self.connect_task.cancel()
+        self.client.publish(event_payload.gateway_topic(self.topic_prefix, "status"),
+                            event_payload.STATUS_OFFLINE, qos=1, retain=True)
+        self.client.disconnect()
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+
+
+class AsyncDeviceSession(object):
+    """
+    Connection of one device as a coroutine:
+
+      scanning -> connecting -> resolving -> notifying
+          ^                                      |
+          +------ disconnected (backoff) <-------+
+    """
+
+    def __init__(self, client, bdaddr, mqtt, scan_timeout,
+                 topic_prefix=mqtt_constants.topic_prefix,
+                 payload_format=mqtt_constants.payload_format):
+        self.client = client
+        self.mqtt = mqtt
+        self.scan_timeout = scan_timeout
+        self.bdaddr = bdaddr.upper()
+        self.device_path = bluetooth_utils.device_address_to_path(self.bdaddr, client.adapter_path)
+        self.payload_format = payload_format
+        self.button_topic = event_payload.device_topic(topic_prefix, self.bdaddr, "button")
+        self.status_topic = event_payload.device_topic(topic_prefix, self.bdaddr, "status")
+        self.led_topic = event_payload.device_topic(topic_prefix, self.bdaddr, "led")
+
+        self.state = STATE_DISCONNECTED
+        self.resolved = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        # characteristic paths by UUID, from InterfacesAdded or GetManagedObjects
+        self.characteristics = {}
+        self.button_path = None
+        self.led_path = None
+        self.led_flags = ()
+        self.led_wanted = None
+        self.led_written = None
+        self.led_task = None
+        self.reconnect_attempts = 0
+
+    def set_state(self, state):
+        if state != self.state:
+            log.info("%s: %s -> %s", self.bdaddr, self.state, state)
+            self.state = state
+
+    async def run(self):
+        await self.client.watch(self.device_path, self.signal_received)
+        try:
+            while True:
+                try:
+                    if await self.connect():
+                        self.reconnect_attempts = 0
+                        self.mqtt.publish(self.status_topic, event_payload.STATUS_ONLINE,
+                                          qos=1, retain=True)
+                        await self.disconnected.wait()
+                        log.info("%s: Link lost", self.bdaddr)
+                        metrics.link_losses.inc()
+                        self.mqtt.publish(self.status_topic, event_payload.STATUS_OFFLINE,
+                                          qos=1, retain=True)
+                except (BluezError, asyncio.TimeoutError) as e:
+                    log.error("%s: %s failed, %s", self.bdaddr, self.state, str(e) or "timeout")
+                    if self.state == STATE_CONNECTING:
+                        metrics.connect_failures.inc()
+                self.link_down()
+                delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * (2 ** self.reconnect_attempts))
+                delay = random.uniform(delay / 2, delay)
+                self.reconnect_attempts += 1
+                metrics.reconnects.inc()
+                log.info("%s: Reconnecting in %.1f s (attempt %d)", self.bdaddr, delay,
+                         self.reconnect_attempts)
+                await asyncio.sleep(delay)
+        finally:
+            self.link_down()
+            await self.client.unwatch(self.device_path)
+
+    def link_down(self):
+        self.set_state(STATE_DISCONNECTED)
+        self.button_path = None
+        self.led_path = None
+        self.led_written = None
+        if self.led_task is not None:
+            self.led_task.cancel()
+            self.led_task = None
+
+    # One attempt to bring the device to notifying, False if it was not found
+    async def connect(self):
+        self.set_state(STATE_SCANNING)
+        if not await self.client.find_device(self.device_path, self.scan_timeout):
+            log.error("%s: Device not found", self.bdaddr)
+            return False
+        # cleared before reading the properties, a signal arriving meanwhile
+        # is not lost
+        self.resolved.clear()
+        self.disconnected.clear()
+        self.characteristics = {}
+        properties = (await self.client.call(self.device_path, bluetooth_constants.DBUS_PROPERTIES,
+                                             "GetAll", "s",
+                                             [bluetooth_constants.DEVICE_INTERFACE]))[0]
+        if not properties["Connected"].value:
+            self.set_state(STATE_CONNECTING)
+            start = time.monotonic()
+            await self.client.call(self.device_path, bluetooth_constants.DEVICE_INTERFACE,
+                                   "Connect", timeout=CONNECT_TIMEOUT)
+            log.info("%s: Connected OK", self.bdaddr)
+            metrics.connect_seconds.observe(time.monotonic() - start)
+        elif properties["ServicesResolved"].value:
+            self.resolved.set()
+        self.set_state(STATE_RESOLVING)
+        await self.wait_connected(self.resolved, RESOLVE_TIMEOUT)
+
+        await self.find_characteristics()
+        if self.button_path is None:
+            raise BluezError("org.bluez.Error.DoesNotExist", "button characteristic not found")
+        start = time.monotonic()
+        await self.client.call(self.button_path, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                               "StartNotify")
+        metrics.start_notify_seconds.observe(time.monotonic() - start)
+        self.set_state(STATE_NOTIFYING)
+        if self.led_wanted is not None:
+            self.start_led_write()
+        return True
+
+    # wait for event while the link is up
+    async def wait_connected(self, event, timeout):
+        waiters = [asyncio.ensure_future(event.wait()), asyncio.ensure_future(self.disconnected.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        if self.disconnected.is_set():
+            raise BluezError("org.bluez.Error.NotConnected", "link lost")
+        if not event.is_set():
+            raise asyncio.TimeoutError()
+
+    # GATT objects announced while resolving, GetManagedObjects only when the
+    # device was resolved before the session watched it
+    async def find_characteristics(self):
+        if bluetooth_constants.BUTTON_CHR_UUID not in self.characteristics:
+            objects = (await self.client.call("/", bluetooth_constants.DBUS_OM_IFACE,
+                                              "GetManagedObjects"))[0]
+            prefix = self.device_path + "/"
+            for path, interfaces in objects.items():
+                if path.startswith(prefix):
+                    self.interfaces_added(path, interfaces)
+        self.button_path = self.characteristics.get(bluetooth_constants.BUTTON_CHR_UUID, (None,))[0]
+        self.led_path, self.led_flags = self.characteristics.get(bluetooth_constants.LED_CHR_UUID,
+                                                                 (None, ()))
+
+    def interfaces_added(self, path, interfaces):
+        properties = interfaces.get(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+        if properties is not None and "UUID" in properties:
+            flags = properties["Flags"].value if "Flags" in properties else ()
+            self.characteristics[properties["UUID"].value] = (path, flags)
+
+    def signal_received(self, message):
+        if message.member == "InterfacesAdded":
+            self.interfaces_added(*message.body)
+            return
+        interface, changed = message.body[0], message.body[1]
+        if message.path == self.device_path:
+            if interface != bluetooth_constants.DEVICE_INTERFACE:
+                return
+            if "Connected" in changed and not changed["Connected"].value:
+                self.disconnected.set()
+            if "ServicesResolved" in changed and changed["ServicesResolved"].value:
+                self.resolved.set()
+        elif message.path == self.button_path and "Value" in changed:
+            self.button_received(changed["Value"].value)
+
+    def button_received(self, value):
+        state = value[0]
+        metrics.notifications.inc()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s: Button State: %d", self.bdaddr, state)
+        self.mqtt.publish(self.button_topic,
+                          event_payload.encode_event(self.payload_format, time.time(), state),
+                          retain=True)
+
+    # LED command from MQTT, only the latest value is written
+    def set_led(self, value):
+        self.led_wanted = value
+        if self.state == STATE_NOTIFYING:
+            self.start_led_write()
+
+    def start_led_write(self):
+        if self.led_task is None or self.led_task.done():
+            self.led_task = asyncio.get_running_loop().create_task(self.write_led())
+
+    async def write_led(self):
+        if self.led_path is None:
+            log.error("%s: LED characteristic not found", self.bdaddr)
+            return
+        # write without response saves the ATT round trip where allowed
+        write_type = "command" if "write-without-response" in self.led_flags else "request"
+        while self.led_wanted != self.led_written:
+            value = self.led_wanted
+            start = time.monotonic()
+            try:
+                await self.client.call(self.led_path, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                                       "WriteValue", "aya{sv}",
+                                       [bytes([value]), {"type": Variant("s", write_type)}])
+            except (BluezError, asyncio.TimeoutError) as e:
+                log.error("%s: LED write failed, %s", self.bdaddr, e)
+                return
+            metrics.write_value_seconds.observe(time.monotonic() - start)
+            metrics.led_writes.inc()
+            self.led_written = value
+        self.mqtt.publish(self.led_topic,
+                          event_payload.encode_event(self.payload_format, time.time(),
+                                                     self.led_written),
+                          qos=1, retain=True)
+
+    async def disconnect(self):
+        try:
+            await self.client.call(self.device_path, bluetooth_constants.DEVICE_INTERFACE,
+                                   "Disconnect", timeout=5)
+        except (BluezError, asyncio.TimeoutError):
+            pass
+
+def read_device_list(filename):
+    addresses = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                addresses.append(line)
+    return addresses
+
+async def run_gateway(args, addresses):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+    adapter_path = bluetooth_constants.BLUEZ_NAMESPACE + bluetooth_constants.ADAPTER_NAME
+    client = BluezClient(bus, adapter_path)
+    await client.start()
+
+    mqtt = MqttLoop(mqtt_client.Client(mqtt_constants.client_id), args.broker, args.port,
+                    args.topic_prefix)
+    sessions = {}
+    for bdaddr in addresses:
+        session = AsyncDeviceSession(client, bdaddr, mqtt, args.scan_timeout,
+                                     topic_prefix=args.topic_prefix,
+                                     payload_format=args.payload_format)
+        sessions.setdefault(event_payload.device_id(session.bdaddr), session)
+
+    def command_received(device_id, value):
+        session = sessions.get(device_id)
+        if session is not None:
+            session.set_led(value)
+    mqtt.command_handler = command_received
+    mqtt.start()
+    if args.metrics_port:
+        metrics.serve(args.metrics_address, args.metrics_port)
+
+    tasks = [loop.create_task(session.run()) for session in sessions.values()]
+    await stop.wait()
+
+    log.info("Disconnecting from %d devices", len(sessions))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*(session.disconnect() for session in sessions.values()))
+    mqtt.stop()
+    bus.disconnect()
+
+def main():
+    parser = argparse.ArgumentParser(description="Thunderboard EFR32BG22 BLE to MQTT gateway, asyncio engine")
+    parser.add_argument("bdaddr", nargs="*", help="bluetooth device address(es) to connect")
+    parser.add_argument("-f", "--file", help="file listing device addresses, one per line")
+    parser.add_argument("-l", "--log-level", default="info",
+                        choices=["debug", "info", "warning", "error"],
+                        help="console log level, debug also prints every button event")
+    parser.add_argument("-t", "--scan-timeout", type=int, default=10,
+                        help="seconds per scan for devices BlueZ does not know yet")
+    parser.add_argument("--broker", default=mqtt_constants.broker, help="MQTT broker host")
+    parser.add_argument("--port", type=int, default=mqtt_constants.port, help="MQTT broker port")
+    parser.add_argument("--topic-prefix", default=mqtt_constants.topic_prefix,
+                        help="events are published to <prefix>/<device>/<characteristic>")
+    parser.add_argument("--payload-format", default=mqtt_constants.payload_format,
+                        choices=event_payload.PAYLOAD_FORMATS, help="event payload encoding")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics over HTTP on this port, 0 disables")
+    parser.add_argument("--metrics-address", default="127.0.0.1",
+                        help="address the metrics endpoint listens on")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=getattr(logging, args.log_level.upper()))
+
+    addresses = list(args.bdaddr)
+    if args.file:
+        addresses += read_device_list(args.file)
+    if not addresses:
+        parser.print_usage()
+        sys.exit(1)
+    asyncio.run(run_gateway(args, addresses))
+
+if __name__ == "__main__":
+    main()
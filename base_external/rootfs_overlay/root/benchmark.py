@@ -0,0 +1,682 @@
+#!/usr/bin/python3
+#
+# Microbenchmarks of the gateway hot paths, meant to be run on the target:
+#
+#   python3 benchmark.py [button|convert|decode|eventlog|gatt|metrics|publish|registry|signals ...]
+#                        [-n events]
+#
+# gatt and signals need a session bus, e.g. dbus-run-session python3 benchmark.py gatt
+#
+# Every benchmark prints the rate of the code path before and after the change
+# it was written for, both measured in the same process.
+
+import argparse
+import contextlib
+import json
+import os
+import time
+import types
+import dbus
+import bluetooth_utils
+import bluetooth_constants
+import characteristic_decoders
+import mqtt_constants
+import event_payload
+import sys
+sys.path.insert(0, '.')
+
+# Stand-in for the paho client, keeps the publish cost out of the measurement
+class NullClient(object):
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, key=None, state=None):
+        self.published += 1
+
+def report(name, count, elapsed):
+    print("%-50s %10d events %8.3f s %12.0f events/s" % (name, count, elapsed, count / elapsed))
+
+def run(name, handler, args, count):
+    start = time.perf_counter()
+    for i in range(count):
+        handler(*args[i & 1])
+    report(name, count, time.perf_counter() - start)
+
+LEGACY_TOPIC = 'client/btn_status'
+
+# button_received as it was before the fast path: full dbus_to_python conversion,
+# a print and a string payload per event
+def legacy_button_received(client, interface, changed, invalidated, path):
+    if 'Value' in changed:
+        button = bluetooth_utils.dbus_to_python(changed['Value'])
+        print("Button State: " + str(button[0]))
+        client.publish(LEGACY_TOPIC, str(button[0]))
+
+def bench_button(count):
+    import device_session
+    client = NullClient()
+    path = "/org/bluez/hci0/dev_00_0B_57_00_00_01/service000a/char000b"
+
+    # Value as delivered by a receiver without byte_arrays, an array of dbus.Byte
+    legacy_args = []
+    for state in (0, 1):
+        changed = dbus.Dictionary({'Value': dbus.Array([dbus.Byte(state)], signature='y')},
+                                  signature='sv')
+        legacy_args.append((client, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                            changed, dbus.Array([], signature='s'), path))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for i in range(count):
+            legacy_button_received(*legacy_args[i & 1])
+        elapsed = time.perf_counter() - start
+    report("button_received (dbus_to_python+print)", count, elapsed)
+
+    # Value as delivered with byte_arrays=True, a dbus.ByteArray
+    session = types.SimpleNamespace(bdaddr="00:0B:57:00:00:01", publisher=client,
+            payload_format=mqtt_constants.payload_format,
+            button_topic=event_payload.device_topic(mqtt_constants.topic_prefix,
+                                                    "00:0B:57:00:00:01", "button"),
+            button_decoder=characteristic_decoders.get_decoder(
+                bluetooth_constants.BUTTON_CHR_UUID).decode,
+            connect_time=None, gatt_state=None, aggregate_index=None, publish_events=True,
+            event_log=None)
+    args = []
+    for state in (0, 1):
+        changed = dbus.Dictionary({'Value': dbus.ByteArray(bytes([state]))}, signature='sv')
+        args.append((session, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                     changed, dbus.Array([], signature='s')))
+    run("button_received (fast path)", device_session.DeviceSession.button_received,
+        args, count)
+
+    # statistics instead of a message per edge
+    import event_aggregator
+    session.aggregator = event_aggregator.EventAggregator(client, mqtt_constants.topic_prefix)
+    session.aggregate_index = session.aggregator.add_device(session.bdaddr)
+    session.publish_events = False
+    run("button_received (aggregated, no raw events)", device_session.DeviceSession.button_received,
+        args, count)
+
+# dbus_to_python as it was before the type-dispatch table
+def legacy_dbus_to_python(data):
+    if isinstance(data, dbus.String):
+        data = str(data)
+    if isinstance(data, dbus.ObjectPath):
+        data = str(data)
+    elif isinstance(data, dbus.Boolean):
+        data = bool(data)
+    elif isinstance(data, dbus.Int64):
+        data = int(data)
+    elif isinstance(data, dbus.Int32):
+        data = int(data)
+    elif isinstance(data, dbus.Int16):
+        data = int(data)
+    elif isinstance(data, dbus.UInt16):
+        data = int(data)
+    elif isinstance(data, dbus.Byte):
+        data = int(data)
+    elif isinstance(data, dbus.Double):
+        data = float(data)
+    elif isinstance(data, dbus.Array):
+        data = [legacy_dbus_to_python(value) for value in data]
+    elif isinstance(data, dbus.Dictionary):
+        new_data = dict()
+        for key in data.keys():
+            new_data[key] = legacy_dbus_to_python(data[key])
+        data = new_data
+    return data
+
+def byte_array(values):
+    return dbus.Array([dbus.Byte(b) for b in values], signature='y', variant_level=1)
+
+# Device1 properties of an advertising Thunderboard as BlueZ reports them
+def device_properties(index, adapter_path):
+    bdaddr = "00:0B:57:00:%02X:%02X" % (index >> 8, index & 0xff)
+    return dbus.Dictionary({
+        'Address': dbus.String(bdaddr, variant_level=1),
+        'AddressType': dbus.String('public', variant_level=1),
+        'Name': dbus.String('Blinky Example', variant_level=1),
+        'Alias': dbus.String('Blinky Example', variant_level=1),
+        'Paired': dbus.Boolean(False, variant_level=1),
+        'Trusted': dbus.Boolean(False, variant_level=1),
+        'Blocked': dbus.Boolean(False, variant_level=1),
+        'LegacyPairing': dbus.Boolean(False, variant_level=1),
+        'RSSI': dbus.Int16(-60 - (index % 30), variant_level=1),
+        'TxPower': dbus.Int16(0, variant_level=1),
+        'Connected': dbus.Boolean(False, variant_level=1),
+        'UUIDs': dbus.Array([dbus.String(bluetooth_constants.BUTTON_SVC_UUID),
+                             dbus.String("00001801-0000-1000-8000-00805f9b34fb")],
+                            signature='s', variant_level=1),
+        'Adapter': dbus.ObjectPath(adapter_path, variant_level=1),
+        'ManufacturerData': dbus.Dictionary({dbus.UInt16(0x02ff): byte_array([index & 0xff, 0, 1, 2, 3, 4])},
+                                            signature='qv', variant_level=1),
+        'ServiceData': dbus.Dictionary({dbus.String(bluetooth_constants.BUTTON_SVC_UUID): byte_array([1, 2, 3, 4])},
+                                       signature='sv', variant_level=1),
+        'ServicesResolved': dbus.Boolean(False, variant_level=1),
+        'AdvertisingFlags': byte_array([6]),
+    }, signature='sv')
+
+def interfaces_added(index, adapter_path):
+    return dbus.Dictionary({
+        dbus.String(bluetooth_constants.DEVICE_INTERFACE): device_properties(index, adapter_path),
+        dbus.String("org.freedesktop.DBus.Introspectable"): dbus.Dictionary({}, signature='sv'),
+        dbus.String(bluetooth_constants.DBUS_PROPERTIES): dbus.Dictionary({}, signature='sv'),
+    }, signature='sa{sv}')
+
+# GetManagedObjects reply with the adapter, devices and the GATT tree of each device
+def managed_objects(device_count, adapter_path):
+    objects = {}
+    objects[dbus.ObjectPath(adapter_path)] = dbus.Dictionary({
+        dbus.String(bluetooth_constants.ADAPTER_INTERFACE): dbus.Dictionary({
+            'Address': dbus.String('DC:A6:32:00:00:01', variant_level=1),
+            'Powered': dbus.Boolean(True, variant_level=1),
+            'Discovering': dbus.Boolean(False, variant_level=1),
+            'UUIDs': dbus.Array([dbus.String("00001800-0000-1000-8000-00805f9b34fb")],
+                                signature='s', variant_level=1),
+        }, signature='sv')}, signature='sa{sv}')
+    for index in range(device_count):
+        bdaddr = "00:0B:57:00:%02X:%02X" % (index >> 8, index & 0xff)
+        device_path = bluetooth_utils.device_address_to_path(bdaddr, adapter_path)
+        objects[dbus.ObjectPath(device_path)] = interfaces_added(index, adapter_path)
+        service_path = device_path + "/service000a"
+        objects[dbus.ObjectPath(service_path)] = dbus.Dictionary({
+            dbus.String(bluetooth_constants.GATT_SERVICE_INTERFACE): dbus.Dictionary({
+                'UUID': dbus.String(bluetooth_constants.BUTTON_SVC_UUID, variant_level=1),
+                'Device': dbus.ObjectPath(device_path, variant_level=1),
+                'Primary': dbus.Boolean(True, variant_level=1),
+                'Includes': dbus.Array([], signature='o', variant_level=1),
+            }, signature='sv')}, signature='sa{sv}')
+        for chr_index, (uuid, flags) in enumerate(((bluetooth_constants.BUTTON_CHR_UUID, ['read', 'notify']),
+                                                   (bluetooth_constants.LED_CHR_UUID, ['read', 'write']))):
+            chr_path = service_path + "/char%04x" % (0xb + chr_index * 3)
+            objects[dbus.ObjectPath(chr_path)] = dbus.Dictionary({
+                dbus.String(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE): dbus.Dictionary({
+                    'UUID': dbus.String(uuid, variant_level=1),
+                    'Service': dbus.ObjectPath(service_path, variant_level=1),
+                    'Value': byte_array([0]),
+                    'Notifying': dbus.Boolean(False, variant_level=1),
+                    'Flags': dbus.Array([dbus.String(f) for f in flags], signature='s', variant_level=1),
+                    'MTU': dbus.UInt16(247, variant_level=1),
+                }, signature='sv')}, signature='sa{sv}')
+            objects[dbus.ObjectPath(chr_path + "/desc000d")] = dbus.Dictionary({
+                dbus.String(bluetooth_constants.GATT_DESCRIPTOR_INTERFACE): dbus.Dictionary({
+                    'UUID': dbus.String("00002902-0000-1000-8000-00805f9b34fb", variant_level=1),
+                    'Characteristic': dbus.ObjectPath(chr_path, variant_level=1),
+                    'Value': byte_array([0, 0]),
+                }, signature='sv')}, signature='sa{sv}')
+    return dbus.Dictionary(objects, signature='oa{sa{sv}}')
+
+def bench_convert(count):
+    adapter_path = bluetooth_constants.BLUEZ_NAMESPACE + bluetooth_constants.ADAPTER_NAME
+    payloads = (("InterfacesAdded", interfaces_added(1, adapter_path), count),
+                ("GetManagedObjects (40 devices)", managed_objects(40, adapter_path), max(1, count // 200)))
+    for name, payload, runs in payloads:
+        for label, convert in (("isinstance ladder", legacy_dbus_to_python),
+                               ("dispatch table", bluetooth_utils.dbus_to_python)):
+            start = time.perf_counter()
+            for i in range(runs):
+                convert(payload)
+            report(name + " " + label, runs, time.perf_counter() - start)
+
+def wait_idle(sink, timeout=10.0):
+    # wait until the sink stopped receiving for a moment
+    deadline = time.perf_counter() + timeout
+    last = -1
+    while time.perf_counter() < deadline and sink.received != last:
+        last = sink.received
+        time.sleep(0.2)
+    return time.perf_counter() - 0.2
+
+def bench_publish(count):
+    from paho.mqtt import client as mqtt_client
+    import mqtt_publisher
+    import mqtt_sink
+
+    sink = mqtt_sink.MqttSink()
+    sink.start()
+    topics = [event_payload.device_topic(mqtt_constants.topic_prefix, "00:0B:57:00:00:%02X" % i,
+                                         "button") for i in range(40)]
+    # every device repeats each state twice, as a bouncing button would
+    events = []
+    for i in range(count):
+        state = (i // 80) & 1
+        events.append((topics[i % 40], state,
+                       event_payload.encode_event(mqtt_constants.payload_format, time.time(), state)))
+
+    configs = (("client.publish from the main loop", None),
+               ("publish queue", {}),
+               ("publish queue, coalescing 50 ms", {"coalesce_interval": 0.05}),
+               ("publish queue, batches of 32 (json)", {"batch_size": 32, "batch_interval": 0.005}),
+               ("publish queue, batches of 32 (binary)", {"batch_size": 32, "batch_interval": 0.005,
+                                                         "batch_format": "binary"}))
+    for name, options in configs:
+        client = mqtt_client.Client("benchmark-%d" % len(name))
+        client.connect(sink.host, sink.port)
+        client.loop_start()
+        received = sink.received
+
+        if options is None:
+            start = time.perf_counter()
+            for topic, state, payload in events:
+                client.publish(topic, payload)
+            blocked = time.perf_counter() - start
+        else:
+            publisher = mqtt_publisher.MqttPublisher(client, queue_size=count, **options)
+            publisher.start()
+            start = time.perf_counter()
+            for topic, state, payload in events:
+                publisher.publish(topic, payload, key=topic, state=state)
+            blocked = time.perf_counter() - start
+            publisher.stop()
+        elapsed = wait_idle(sink) - start
+        messages = sink.received - received
+
+        client.loop_stop()
+        client.disconnect()
+        print("%-40s main loop %10.0f events/s, delivered %10.0f events/s in %d messages" %
+              (name, count / blocked, count / elapsed, messages))
+    sink.stop()
+
+GATT_CHARACTERISTICS = 300
+
+def gatt_application(bus):
+    import bluetooth_gatt
+
+    app = bluetooth_gatt.Application(bus, "/benchmark")
+    service = bluetooth_gatt.Service(bus, "/benchmark", 0,
+                                     bluetooth_constants.GATEWAY_SVC_UUID, True)
+    app.add_service(service)
+    for i in range(GATT_CHARACTERISTICS):
+        chrc = bluetooth_gatt.Characteristic(bus, i, bluetooth_constants.GATEWAY_STATE_CHR_UUID,
+                                             ['read', 'notify'], service)
+        chrc.add_descriptor(bluetooth_gatt.Descriptor(bus, 0,
+                bluetooth_constants.USER_DESCRIPTION_DSC_UUID, ['read'], chrc))
+        service.add_characteristic(chrc)
+    return app
+
+# what every GetManagedObjects cost before the property cache
+def drop_property_cache(app):
+    app.invalidate()
+    for service in app.get_services():
+        service.properties = None
+        for chrc in service.get_characteristics():
+            chrc.properties = None
+            for desc in chrc.get_descriptors():
+                desc.properties = None
+
+# Run the main loop until counter() stops changing, returns the time of its last change
+def run_until_idle(loop, counter):
+    from gi.repository import GLib
+
+    state = {"last": -1, "time": time.perf_counter()}
+    def check():
+        if counter() != state["last"]:
+            state["last"] = counter()
+            state["time"] = time.perf_counter()
+            return True
+        loop.quit()
+        return False
+    GLib.timeout_add(200, check)
+    loop.run()
+    return state["time"]
+
+def bench_gatt(count):
+    import dbus.bus
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+
+    address = os.environ.get("DBUS_SESSION_BUS_ADDRESS")
+    if not address:
+        print("gatt: no session bus, run it under dbus-run-session")
+        return
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    # server and client on separate connections, as BlueZ and the application are
+    server_bus = dbus.bus.BusConnection(address)
+    client_bus = dbus.bus.BusConnection(address)
+    app = gatt_application(server_bus)
+    characteristics = app.get_services()[0].get_characteristics()
+    loop = GLib.MainLoop()
+
+    om = dbus.Interface(client_bus.get_object(server_bus.get_unique_name(), "/benchmark",
+                                              introspect=False),
+                        bluetooth_constants.DBUS_OM_IFACE)
+    calls = max(10, count // 1000)
+    for label, rebuild in (("properties rebuilt per call", True), ("cached properties", False)):
+        state = {"left": calls}
+        def call():
+            if rebuild:
+                drop_property_cache(app)
+            om.GetManagedObjects(reply_handler=reply, error_handler=failed)
+            return False
+        def reply(objects):
+            state["left"] -= 1
+            if state["left"]:
+                call()
+            else:
+                loop.quit()
+        def failed(e):
+            print("GetManagedObjects failed: " + str(e))
+            loop.quit()
+        GLib.idle_add(call)
+        start = time.perf_counter()
+        loop.run()
+        report("GetManagedObjects (%d chrcs) %s" % (GATT_CHARACTERISTICS, label),
+               calls, time.perf_counter() - start)
+
+    received = [0]
+    def properties_changed(interface, changed, invalidated, path=None):
+        received[0] += 1
+    client_bus.add_signal_receiver(properties_changed,
+            dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
+            signal_name = "PropertiesChanged",
+            path_keyword = "path")
+    for chrc in characteristics:
+        chrc.StartNotify()
+
+    for interval in (0.0, 0.05):
+        for chrc in characteristics:
+            chrc.notify_interval = interval
+        progress = {"sent": 0}
+        # updates in chunks from the main loop, so rate limit timers can fire
+        def produce():
+            end = min(count, progress["sent"] + 1000)
+            for i in range(progress["sent"], end):
+                characteristics[i % GATT_CHARACTERISTICS].notify(bytes([1, (i // GATT_CHARACTERISTICS) & 1]))
+            progress["sent"] = end
+            if end < count:
+                return True
+            progress["done"] = time.perf_counter()
+            return False
+        before = received[0]
+        start = time.perf_counter()
+        GLib.idle_add(produce)
+        last = run_until_idle(loop, lambda: (progress["sent"], received[0]))
+        print("%-50s %10.0f updates/s, %d signals delivered at %.0f signals/s" %
+              ("notify, %d ms interval" % (interval * 1000),
+               count / (progress["done"] - start), received[0] - before,
+               (received[0] - before) / (last - start)))
+
+# busy bus: advertising devices, notifying boards and another service
+SIGNAL_DEVICES = 50
+SIGNAL_BOARDS = 20
+SIGNAL_OTHER = 30
+SIGNAL_SECONDS = 5
+
+def properties_changed_message(path, interface, changed):
+    import dbus.lowlevel
+
+    message = dbus.lowlevel.SignalMessage(path, bluetooth_constants.DBUS_PROPERTIES,
+                                          "PropertiesChanged")
+    message.append(interface, dbus.Dictionary(changed, signature='sv'),
+                   dbus.Array([], signature='s'), signature='sa{sv}as')
+    return message
+
+# Child process: every 100 ms an RSSI change of each device, two button
+# notifications of each board (both as org.bluez) and a change of each object
+# of another service
+def emit_signals(address, adapter_path, seconds):
+    import dbus.bus
+
+    bluez = dbus.bus.BusConnection(address)
+    bluez.request_name(bluetooth_constants.BLUEZ_SERVICE_NAME)
+    other = dbus.bus.BusConnection(address)
+    end = time.monotonic() + seconds
+    tick = 0
+    while time.monotonic() < end:
+        for i in range(SIGNAL_DEVICES):
+            path = bluetooth_utils.device_address_to_path("00:0B:57:00:01:%02X" % i, adapter_path)
+            bluez.send_message(properties_changed_message(path, bluetooth_constants.DEVICE_INTERFACE,
+                               {'RSSI': dbus.Int16(-60 - (tick + i) % 30)}))
+        for i in range(SIGNAL_BOARDS):
+            path = bluetooth_utils.device_address_to_path("00:0B:57:00:02:%02X" % i, adapter_path)
+            for state in (1, 0):
+                bluez.send_message(properties_changed_message(
+                        path + "/service001a/char001b", bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                        {'Value': dbus.ByteArray(bytes([state]))}))
+        for i in range(SIGNAL_OTHER):
+            other.send_message(properties_changed_message("/org/example/Network/Device%d" % i,
+                               "org.example.Network.Device", {'RxBytes': dbus.UInt64(tick * 1500)}))
+        bluez.flush()
+        other.flush()
+        tick += 1
+        time.sleep(0.1)
+
+# Discovery receivers as registered before and after the narrowed match rules,
+# CPU and deliveries of this process while another one loads the bus
+def bench_signals(count):
+    import multiprocessing
+    import resource
+    import dbus.bus
+    import dbus.lowlevel
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+
+    address = os.environ.get("DBUS_SESSION_BUS_ADDRESS")
+    if not address:
+        print("signals: no session bus, run it under dbus-run-session")
+        return
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    adapter_path = bluetooth_constants.BLUEZ_NAMESPACE + bluetooth_constants.ADAPTER_NAME
+    rate = SIGNAL_DEVICES * 10 + SIGNAL_BOARDS * 20 + SIGNAL_OTHER * 10
+    print("busy bus: %d signals/s, %d devices advertising, %d boards notifying, %d other objects" %
+          (rate, SIGNAL_DEVICES, SIGNAL_BOARDS, SIGNAL_OTHER))
+
+    for label in ("unscoped receivers", "path_namespace/arg0 rules"):
+        bus = dbus.bus.BusConnection(address)
+        counts = {"messages": 0, "handled": 0}
+        def count_message(bus, message):
+            counts["messages"] += 1
+            return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+        bus.add_message_filter(count_message)
+        def properties_changed(interface, changed, invalidated, path=None):
+            counts["handled"] += 1
+        def interfaces_added(path, interfaces):
+            counts["handled"] += 1
+        if label.startswith("unscoped"):
+            matches = [bus.add_signal_receiver(interfaces_added,
+                               dbus_interface = bluetooth_constants.DBUS_OM_IFACE,
+                               signal_name = "InterfacesAdded"),
+                       bus.add_signal_receiver(properties_changed,
+                               dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
+                               signal_name = "PropertiesChanged",
+                               path_keyword = "path")]
+        else:
+            matches = [bluetooth_utils.MatchRule(bus, interfaces_added,
+                               bluetooth_constants.DBUS_OM_IFACE, "InterfacesAdded",
+                               path = "/", arg0path = adapter_path + "/"),
+                       bluetooth_utils.MatchRule(bus, properties_changed,
+                               bluetooth_constants.DBUS_PROPERTIES, "PropertiesChanged",
+                               path_namespace = adapter_path,
+                               arg0 = bluetooth_constants.DEVICE_INTERFACE,
+                               path_keyword = "path")]
+        bus.flush()
+
+        emitter = multiprocessing.Process(target=emit_signals,
+                                          args=(address, adapter_path, SIGNAL_SECONDS))
+        loop = GLib.MainLoop()
+        def finished():
+            if emitter.is_alive():
+                return True
+            loop.quit()
+            return False
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        emitter.start()
+        GLib.timeout_add(100, finished)
+        loop.run()
+        elapsed = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+        print("%-50s %8.0f messages/s %8.0f handler calls/s %6.1f %% CPU" %
+              (label, counts["messages"] / elapsed, counts["handled"] / elapsed,
+               cpu / elapsed * 100))
+        for match in matches:
+            match.remove()
+        bus.close()
+
+REGISTRY_DEVICES = 500
+
+# RSSI updates of many advertising devices, as dd_properties_changed sees them
+def bench_registry(count):
+    import device_registry
+
+    adapter_path = bluetooth_constants.BLUEZ_NAMESPACE + bluetooth_constants.ADAPTER_NAME
+    paths = [bluetooth_utils.device_address_to_path("00:0B:57:00:%02X:%02X" % (i >> 8, i & 0xff),
+                                                    adapter_path)
+             for i in range(REGISTRY_DEVICES)]
+    updates = [dbus.Dictionary({'RSSI': dbus.Int16(-60 - (i % 30), variant_level=1)}, signature='sv')
+               for i in range(30)]
+
+    # the dict of Device1 properties copied on every update
+    devices = {}
+    for i, path in enumerate(paths):
+        devices[path] = device_properties(i, adapter_path)
+    start = time.perf_counter()
+    for i in range(count):
+        path = paths[i % REGISTRY_DEVICES]
+        devices[path] = dict(devices[path].items())
+        devices[path].update(updates[i % 30].items())
+    report("RSSI update, dict copy (%d devices)" % REGISTRY_DEVICES, count, time.perf_counter() - start)
+
+    registry = device_registry.DeviceRegistry(max_devices=REGISTRY_DEVICES)
+    for i, path in enumerate(paths):
+        registry.update(path, device_properties(i, adapter_path))
+    start = time.perf_counter()
+    for i in range(count):
+        registry.update(paths[i % REGISTRY_DEVICES], updates[i % 30])
+    report("RSSI update, registry record (%d devices)" % REGISTRY_DEVICES, count, time.perf_counter() - start)
+
+    # a stream of new devices through a full registry
+    start = time.perf_counter()
+    for i in range(count):
+        registry.update(paths[0] + "_%d" % i, updates[i % 30])
+    report("new device with eviction", count, time.perf_counter() - start)
+
+# appending to the local event log and a query of one device over an hour
+def bench_eventlog(count):
+    import event_log
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    try:
+        log = event_log.EventLog(directory)
+        addresses = ["00:0B:57:00:00:%02X" % i for i in range(50)]
+        day = 1760745600.0
+        start = time.perf_counter()
+        for i in range(count):
+            log.append(day + i * 0.1, addresses[i % 50], "button", i & 1)
+        log.close()
+        report("event log append", count, time.perf_counter() - start)
+
+        reader = event_log.EventLogReader(os.path.join(directory, os.listdir(directory)[0]))
+        end = day + min(count * 0.1, 3600)
+        start = time.perf_counter()
+        events = list(reader.query(int(day * 1000), int(end * 1000), addresses[3], "button"))
+        elapsed = time.perf_counter() - start
+        print("%-50s %10d events of %d records in %.2f ms" % (
+            "event log query, one device over an hour", len(events), reader.records, elapsed * 1000))
+        reader.close()
+    finally:
+        shutil.rmtree(directory)
+
+# cost of the instrumentation on the hot path
+def bench_metrics(count):
+    import metrics
+
+    counter = metrics.Counter("benchmark_total", "")
+    histogram = metrics.Histogram("benchmark_seconds", "")
+    start = time.perf_counter()
+    for i in range(count):
+        counter.inc()
+    report("Counter.inc", count, time.perf_counter() - start)
+    values = [(i % 1000) / 10000.0 for i in range(1000)]
+    start = time.perf_counter()
+    for i in range(count):
+        histogram.observe(values[i % 1000])
+    report("Histogram.observe", count, time.perf_counter() - start)
+
+# helpers of bluetooth_utils as they were, one Python step per byte
+def legacy_hex_string(data):
+    hex_string = ""
+    for byte in data:
+        hex_string = hex_string + '%02X' % byte
+    return hex_string
+
+# acceleration notifications: one decode per notification against buffering
+# the raw values and decoding a second of them at once
+def bench_decode(count):
+    decoder = characteristic_decoders.get_decoder(bluetooth_constants.ACCELERATION_CHR_UUID)
+    payloads = [dbus.ByteArray(decoder.struct.pack(i & 0x7fff, -i & 0x7fff, 1000))
+                for i in range(200)]
+
+    start = time.perf_counter()
+    for i in range(count):
+        value = bluetooth_utils.dbus_to_python(payloads[i % 200])
+        x = int.from_bytes(value[0:2], "little", signed=True) * 0.001
+        y = int.from_bytes(value[2:4], "little", signed=True) * 0.001
+        z = int.from_bytes(value[4:6], "little", signed=True) * 0.001
+    report("acceleration dbus_to_python+int.from_bytes", count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(count):
+        decoder.decode(payloads[i % 200])
+    report("acceleration decode() per notification", count, time.perf_counter() - start)
+
+    client = NullClient()
+    start = time.perf_counter()
+    for i in range(count):
+        x, y, z = decoder.decode(payloads[i % 200])
+        client.publish("thunderboard/000b57000001/acceleration",
+                       json.dumps({"ts": int(time.time() * 1000), "x": x, "y": y, "z": z}).encode())
+    report("acceleration decode()+publish per notification", count, time.perf_counter() - start)
+
+    streams = characteristic_decoders.SensorStreams(client, mqtt_constants.topic_prefix)
+    stream = streams.add_stream("00:0B:57:00:00:01", decoder)
+    now = time.time()
+    start = time.perf_counter()
+    for i in range(count):
+        stream.add(now, payloads[i % 200])
+        if i % 200 == 199:
+            streams.flush()
+    streams.flush()
+    report("acceleration SensorStream batches of 200", count, time.perf_counter() - start)
+
+    data = bytes(range(256)) * 4
+    start = time.perf_counter()
+    for i in range(count // 100):
+        legacy_hex_string(data)
+    report("byteArrayToHexString 1 KiB (per byte)", count // 100, time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(count // 100):
+        bluetooth_utils.byteArrayToHexString(data)
+    report("byteArrayToHexString 1 KiB (hex)", count // 100, time.perf_counter() - start)
+
+BENCHMARKS = {
+    "button" : bench_button,
+    "convert" : bench_convert,
+    "decode" : bench_decode,
+    "eventlog" : bench_eventlog,
+    "gatt" : bench_gatt,
+    "metrics" : bench_metrics,
+    "publish" : bench_publish,
+    "registry" : bench_registry,
+    "signals" : bench_signals,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gateway hot path microbenchmarks")
+    parser.add_argument("benchmark", nargs="*",
+                        help="benchmarks to run (" + ", ".join(sorted(BENCHMARKS)) + "), all if none given")
+    parser.add_argument("-n", "--count", type=int, default=100000, help="events per run")
+    args = parser.parse_args(argv)
+
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark " + name)
+
+    for name in (args.benchmark or sorted(BENCHMARKS)):
+        BENCHMARKS[name](args.count)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
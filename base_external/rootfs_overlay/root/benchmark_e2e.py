@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+#
+# End-to-end benchmark of the gateway against mock_bluez.py and mqtt_sink.py:
+#
+#   python3 benchmark_e2e.py [-n 1,10,40] [--rate 10] [--duration 10] [--engine asyncio]
+#   python3 benchmark_e2e.py --engine sharded --workers 1,2,3,4 [-n 40]
+#
+# For every device count a private dbus-daemon is started, the mock BlueZ and
+# the MQTT sink run in this process and thunderboard_EFR32BG22.py runs unchanged
+# as a child with DBUS_SYSTEM_BUS_ADDRESS pointing at the private bus. Once all
+# boards are notifying they send button events for the given duration. The k-th
+# button message of a device on the sink belongs to its k-th notification, so
+# the notification-to-publish latency is measured on one clock.
+#
+# Reported per device count: latency percentiles, delivered events per second,
+# events lost, the gateway's resident memory in total and per device, and the
+# CPU it used while the events were sent. Memory and CPU include the workers of
+# the sharded gateway, which is run once per --workers count.
+#
+# The mock runs in this process on one core, with several workers it can be the
+# bottleneck: raise --rate until the single process gateway loses events.
+
+import argparse
+import collections
+import os
+import signal
+import subprocess
+import tempfile
+import time
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+import event_payload
+import mqtt_constants
+import mqtt_sink
+import mock_bluez
+import sys
+sys.path.insert(0, '.')
+
+from gi.repository import GLib
+
+GATEWAYS = {
+    "glib" : "thunderboard_EFR32BG22.py",
+    "asyncio" : "async_gateway.py",
+    "sharded" : "sharded_gateway.py",
+}
+
+# seconds to wait for all boards to be notifying
+STARTUP_TIMEOUT = 60
+
+def start_bus():
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    address = daemon.stdout.readline().strip()
+    if not address:
+        daemon.kill()
+        raise RuntimeError("dbus-daemon did not start")
+    return daemon, address
+
+# pid and the pids of all its descendants
+def process_tree(pid):
+    pids = [pid]
+    index = 0
+    while index < len(pids):
+        try:
+            with open("/proc/%d/task/%d/children" % (pids[index], pids[index])) as f:
+                pids += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+        index += 1
+    return pids
+
+def rss_kb(pid):
+    total = 0
+    for tree_pid in process_tree(pid):
+        try:
+            with open("/proc/%d/status" % tree_pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+# user + system seconds of the process tree
+def cpu_seconds(pid):
+    total = 0
+    for tree_pid in process_tree(pid):
+        try:
+            with open("/proc/%d/stat" % tree_pid) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except OSError:
+            pass
+    return total / os.sysconf("SC_CLK_TCK")
+
+# the log is in a temporary directory, show its end when a run fails
+def print_tail(filename, lines=20):
+    with open(filename) as f:
+        for line in f.readlines()[-lines:]:
+            print("    " + line.rstrip())
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+# Run the main loop until done() is true or timeout seconds passed
+def run_loop(loop, timeout, done=None):
+    deadline = time.monotonic() + timeout
+    def check():
+        if (done is not None and done()) or time.monotonic() >= deadline:
+            loop.quit()
+            return False
+        return True
+    GLib.timeout_add(50, check)
+    loop.run()
+    return done is None or done()
+
+def run_case(device_count, workers, args, workdir):
+    daemon, address = start_bus()
+    addresses = mock_bluez.mock_addresses(device_count)
+    bus = dbus.bus.BusConnection(address)
+    mock = mock_bluez.MockBluez(bus, addresses)
+
+    # button topic -> receive times
+    received = collections.defaultdict(list)
+    def on_message(topic, payload, retain, receive_time):
+        if topic.endswith("/button"):
+            received[topic].append(receive_time)
+    sink = mqtt_sink.MqttSink(on_message=on_message)
+    sink.start()
+
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address)
+    command = [sys.executable, GATEWAYS[args.engine]] + addresses + [
+        "--broker", sink.host, "--port", str(sink.port), "-l", "warning"]
+    if args.engine == "glib":
+        command += ["--offline-dir", "", "--gatt-cache", os.path.join(workdir, "gatt_cache.json")]
+    elif args.engine == "sharded":
+        command += ["--workers", str(workers), "--gatt-cache",
+                    os.path.join(workdir, "gatt_cache.json")]
+    command += args.gateway_args
+    log_name = os.path.join(workdir, "gateway-%d-%d.log" % (device_count, workers))
+    log_file = open(log_name, "w")
+    gateway = subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    loop = GLib.MainLoop()
+    try:
+        if not run_loop(loop, STARTUP_TIMEOUT,
+                        lambda: mock.notifying_count() == device_count or gateway.poll() is not None):
+            print("%d devices: only %d notifying after %d s" %
+                  (device_count, mock.notifying_count(), STARTUP_TIMEOUT))
+            log_file.flush()
+            print_tail(log_name)
+            return None
+        if gateway.poll() is not None:
+            print("%d devices: gateway exited" % device_count)
+            log_file.flush()
+            print_tail(log_name)
+            return None
+        start = time.monotonic()
+        cpu_start = cpu_seconds(gateway.pid)
+        mock.start_events(args.rate)
+        run_loop(loop, args.duration)
+        mock.stop_events()
+        cpu = cpu_seconds(gateway.pid) - cpu_start
+        # let the gateway deliver what is in flight
+        sent = sum(len(device.sent) for device in mock.devices.values())
+        progress = {"count": -1, "time": time.monotonic()}
+        def settled():
+            count = sum(len(times) for times in received.values())
+            if count == sent:
+                return True
+            if count != progress["count"]:
+                progress["count"], progress["time"] = count, time.monotonic()
+            return time.monotonic() - progress["time"] > 1.0
+        run_loop(loop, 10, settled)
+        rss_load = rss_kb(gateway.pid)
+    finally:
+        gateway.send_signal(signal.SIGINT)
+        try:
+            gateway.wait(10)
+        except subprocess.TimeoutExpired:
+            gateway.kill()
+        log_file.close()
+        sink.stop()
+        bus.close()
+        daemon.kill()
+        daemon.wait()
+
+    latencies = []
+    delivered = 0
+    last_receive = start
+    for device in mock.devices.values():
+        topic = event_payload.device_topic(args.topic_prefix, device.properties['Address'], "button")
+        times = received.get(topic, [])
+        delivered += len(times)
+        for sent_time, receive_time in zip(device.sent, times):
+            latencies.append((receive_time - sent_time) * 1000)
+        if times:
+            last_receive = max(last_receive, times[-1])
+    latencies.sort()
+    return {
+        "devices": device_count,
+        "workers": workers,
+        "cpu": cpu * 100.0 / args.duration,
+        "sent": sent,
+        "delivered": delivered,
+        "rate": delivered / max(last_receive - start, 1e-9),
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0.0,
+        "rss_load": rss_load,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gateway end-to-end benchmark against a mock BlueZ")
+    parser.add_argument("-n", "--devices", default="1,10,40",
+                        help="comma separated device counts, one run each")
+    parser.add_argument("--rate", type=float, default=10.0, help="button events per second and device")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of events per run")
+    parser.add_argument("--topic-prefix", default=mqtt_constants.topic_prefix,
+                        help="topic prefix the gateway publishes to")
+    parser.add_argument("--engine", default="glib", choices=sorted(GATEWAYS),
+                        help="gateway to run, the GLib one, async_gateway.py or sharded_gateway.py")
+    parser.add_argument("--workers", default="1,2,3,4",
+                        help="with --engine sharded, comma separated worker counts, one run each")
+    parser.add_argument("gateway_args", nargs=argparse.REMAINDER,
+                        help="further gateway options, after --")
+    args = parser.parse_args(argv)
+    if args.gateway_args and args.gateway_args[0] == "--":
+        args.gateway_args = args.gateway_args[1:]
+    args.gateway_args += ["--topic-prefix", args.topic_prefix]
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    worker_counts = [int(n) for n in args.workers.split(",")] if args.engine == "sharded" else [1]
+
+    print("%8s %8s %8s %8s %10s %8s %8s %8s %8s %6s %10s %10s" %
+          ("workers", "devices", "sent", "lost", "events/s", "p50 ms", "p90 ms", "p99 ms", "max ms",
+           "CPU %", "RSS KB", "KB/device"))
+    previous = None
+    with tempfile.TemporaryDirectory() as workdir:
+        for workers, device_count in [(w, int(n)) for w in worker_counts
+                                      for n in args.devices.split(",")]:
+            result = run_case(device_count, workers, args, workdir)
+            if result is None:
+                continue
+            # memory a device adds, from the difference to the previous run
+            if previous is not None and previous["workers"] == workers and \
+                    device_count != previous["devices"]:
+                per_device = ((result["rss_load"] - previous["rss_load"]) /
+                              (device_count - previous["devices"]))
+            else:
+                per_device = result["rss_load"] / device_count
+            print("%8d %8d %8d %8d %10.0f %8.1f %8.1f %8.1f %8.1f %6.0f %10d %10.0f" %
+                  (workers, device_count, result["sent"], result["sent"] - result["delivered"],
+                   result["rate"], result["p50"], result["p90"], result["p99"], result["max"],
+                   result["cpu"], result["rss_load"], per_device))
+            previous = result
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
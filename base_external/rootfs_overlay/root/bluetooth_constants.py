@@ -1,56 +1,90 @@
-#!/usr/bin/python3
-
-# This file contains all the constants needed for this project
-
-ADAPTER_NAME = "hci0"
-BLUEZ_SERVICE_NAME = "org.bluez"
-BLUEZ_NAMESPACE = "/org/bluez/"
-DBUS_PROPERTIES="org.freedesktop.DBus.Properties"
-DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
-ADAPTER_INTERFACE = BLUEZ_SERVICE_NAME + ".Adapter1"
-DEVICE_INTERFACE = BLUEZ_SERVICE_NAME + ".Device1"
-GATT_MANAGER_INTERFACE = BLUEZ_SERVICE_NAME + ".GattManager1"
-GATT_SERVICE_INTERFACE = BLUEZ_SERVICE_NAME + ".GattService1"
-GATT_CHARACTERISTIC_INTERFACE = BLUEZ_SERVICE_NAME + ".GattCharacteristic1"
-GATT_DESCRIPTOR_INTERFACE = BLUEZ_SERVICE_NAME + ".GattDescriptor1"
-
-RESULT_OK = 0
-RESULT_ERR = 1
-RESULT_ERR_NOT_CONNECTED = 2
-RESULT_ERR_NOT_SUPPORTED = 3
-RESULT_ERR_SERVICES_NOT_RESOLVED = 4
-RESULT_ERR_WRONG_STATE = 5
-RESULT_ERR_ACCESS_DENIED = 6
-RESULT_EXCEPTION = 7
-RESULT_ERR_BAD_ARGS = 8
-RESULT_ERR_NOT_FOUND = 9
-
-UUID_NAMES = {
-    "00001801-0000-1000-8000-00805f9b34fb" : "Generic Attribute Service",
-    "0000180a-0000-1000-8000-00805f9b34fb" : "Device Information Service",
-    "e95d93b0-251d-470a-a062-fa1922dfa9a8" : "DFU Control Service",
-    "e95d93af-251d-470a-a062-fa1922dfa9a8" : "Event Service",
-    "e95d9882-251d-470a-a062-fa1922dfa9a8" : "Button Service",
-    "e95d6100-251d-470a-a062-fa1922dfa9a8" : "Temperature Service",
-    "e95dd91d-251d-470a-a062-fa1922dfa9a8" : "LED Service",
-    "00002a05-0000-1000-8000-00805f9b34fb" : "Service Changed",
-    "e95d93b1-251d-470a-a062-fa1922dfa9a8" : "DFU Control",
-    "00002a05-0000-1000-8000-00805f9b34fb" : "Service Changed",
-    "00002a24-0000-1000-8000-00805f9b34fb" : "Model Number String",
-    "00002a25-0000-1000-8000-00805f9b34fb" : "Serial Number String",
-    "00002a26-0000-1000-8000-00805f9b34fb" : "Firmware Revision String",
-    "e95d9775-251d-470a-a062-fa1922dfa9a8" : "micro:bit Event",
-    "e95d5404-251d-470a-a062-fa1922dfa9a8" : "Client Event",
-    "e95d23c4-251d-470a-a062-fa1922dfa9a8" : "Client Requirements",
-    "e95db84c-251d-470a-a062-fa1922dfa9a8" : "micro:bit Requirements",
-    "e95dda90-251d-470a-a062-fa1922dfa9a8" : "Button A State",
-    "e95dda91-251d-470a-a062-fa1922dfa9a8" : "Button B State",
-    "e95d9250-251d-470a-a062-fa1922dfa9a8" : "Temperature",
-    "e95d93ee-251d-470a-a062-fa1922dfa9a8" : "LED Text",
-    "00002902-0000-1000-8000-00805f9b34fb" : "Client Characteristic Configuration",
-}
-
-# These UUIDs are unique for EFR32BG22 Thunderboard Kit SoC Blinky example
-BUTTON_SVC_UUID = "de8a5aac-a99b-c315-0c80-60d4cbb51224"
-BUTTON_CHR_UUID = "61a885a4-41c3-60d0-9a53-6d652a70d29c"
-LED_CHR_UUID    = "5b026510-4088-c297-46d8-be6c736a087a"
+#!/usr/bin/python3
+
+# This file contains all the constants needed for this project
+
+ADAPTER_NAME = "hci0"
+BLUEZ_SERVICE_NAME = "org.bluez"
+BLUEZ_NAMESPACE = "/org/bluez/"
+DBUS_PROPERTIES="org.freedesktop.DBus.Properties"
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+ADAPTER_INTERFACE = BLUEZ_SERVICE_NAME + ".Adapter1"
+DEVICE_INTERFACE = BLUEZ_SERVICE_NAME + ".Device1"
+GATT_MANAGER_INTERFACE = BLUEZ_SERVICE_NAME + ".GattManager1"
+GATT_SERVICE_INTERFACE = BLUEZ_SERVICE_NAME + ".GattService1"
+GATT_CHARACTERISTIC_INTERFACE = BLUEZ_SERVICE_NAME + ".GattCharacteristic1"
+GATT_DESCRIPTOR_INTERFACE = BLUEZ_SERVICE_NAME + ".GattDescriptor1"
+
+RESULT_OK = 0
+RESULT_ERR = 1
+RESULT_ERR_NOT_CONNECTED = 2
+RESULT_ERR_NOT_SUPPORTED = 3
+RESULT_ERR_SERVICES_NOT_RESOLVED = 4
+RESULT_ERR_WRONG_STATE = 5
+RESULT_ERR_ACCESS_DENIED = 6
+RESULT_EXCEPTION = 7
+RESULT_ERR_BAD_ARGS = 8
+RESULT_ERR_NOT_FOUND = 9
+
+UUID_NAMES = {
+    "00001801-0000-1000-8000-00805f9b34fb" : "Generic Attribute Service",
+    "0000180a-0000-1000-8000-00805f9b34fb" : "Device Information Service",
+    "e95d93b0-251d-470a-a062-fa1922dfa9a8" : "DFU Control Service",
+    "e95d93af-251d-470a-a062-fa1922dfa9a8" : "Event Service",
+    "e95d9882-251d-470a-a062-fa1922dfa9a8" : "Button Service",
+    "e95d6100-251d-470a-a062-fa1922dfa9a8" : "Temperature Service",
+    "e95dd91d-251d-470a-a062-fa1922dfa9a8" : "LED Service",
+    "00002a05-0000-1000-8000-00805f9b34fb" : "Service Changed",
+    "e95d93b1-251d-470a-a062-fa1922dfa9a8" : "DFU Control",
+    "00002a05-0000-1000-8000-00805f9b34fb" : "Service Changed",
+    "00002a24-0000-1000-8000-00805f9b34fb" : "Model Number String",
+    "00002a25-0000-1000-8000-00805f9b34fb" : "Serial Number String",
+    "00002a26-0000-1000-8000-00805f9b34fb" : "Firmware Revision String",
+    "e95d9775-251d-470a-a062-fa1922dfa9a8" : "micro:bit Event",
+    "e95d5404-251d-470a-a062-fa1922dfa9a8" : "Client Event",
+    "e95d23c4-251d-470a-a062-fa1922dfa9a8" : "Client Requirements",
+    "e95db84c-251d-470a-a062-fa1922dfa9a8" : "micro:bit Requirements",
+    "e95dda90-251d-470a-a062-fa1922dfa9a8" : "Button A State",
+    "e95dda91-251d-470a-a062-fa1922dfa9a8" : "Button B State",
+    "e95d9250-251d-470a-a062-fa1922dfa9a8" : "Temperature",
+    "e95d93ee-251d-470a-a062-fa1922dfa9a8" : "LED Text",
+    "00002902-0000-1000-8000-00805f9b34fb" : "Client Characteristic Configuration",
+    "0000181a-0000-1000-8000-00805f9b34fb" : "Environmental Sensing Service",
+    "00002a6e-0000-1000-8000-00805f9b34fb" : "Temperature",
+    "00002a6f-0000-1000-8000-00805f9b34fb" : "Humidity",
+    "00002a6d-0000-1000-8000-00805f9b34fb" : "Pressure",
+    "00002a76-0000-1000-8000-00805f9b34fb" : "UV Index",
+    "c8546913-bfd9-45eb-8dde-9f8754f4a32e" : "Ambient Light",
+    "a4e649f4-4be5-11e5-885d-feff819cdc9f" : "Inertial Measurement Service",
+    "c4c1f6e2-4be5-11e5-885d-feff819cdc9f" : "Acceleration",
+    "b7c4b694-bee3-45dd-ba9f-f3b5e994f49a" : "Orientation",
+    "00002a19-0000-1000-8000-00805f9b34fb" : "Battery Level",
+}
+
+# These UUIDs are unique for EFR32BG22 Thunderboard Kit SoC Blinky example
+BUTTON_SVC_UUID = "de8a5aac-a99b-c315-0c80-60d4cbb51224"
+BUTTON_CHR_UUID = "61a885a4-41c3-60d0-9a53-6d652a70d29c"
+LED_CHR_UUID    = "5b026510-4088-c297-46d8-be6c736a087a"
+
+SERVICE_CHANGED_CHR_UUID = "00002a05-0000-1000-8000-00805f9b34fb"
+
+# Sensor characteristics of the Thunderboard demo firmware, decoded by
+# characteristic_decoders.py
+ENVIRONMENTAL_SENSING_SVC_UUID = "0000181a-0000-1000-8000-00805f9b34fb"
+TEMPERATURE_CHR_UUID    = "00002a6e-0000-1000-8000-00805f9b34fb"
+HUMIDITY_CHR_UUID       = "00002a6f-0000-1000-8000-00805f9b34fb"
+PRESSURE_CHR_UUID       = "00002a6d-0000-1000-8000-00805f9b34fb"
+UV_INDEX_CHR_UUID       = "00002a76-0000-1000-8000-00805f9b34fb"
+AMBIENT_LIGHT_CHR_UUID  = "c8546913-bfd9-45eb-8dde-9f8754f4a32e"
+INERTIAL_SVC_UUID       = "a4e649f4-4be5-11e5-885d-feff819cdc9f"
+ACCELERATION_CHR_UUID   = "c4c1f6e2-4be5-11e5-885d-feff819cdc9f"
+ORIENTATION_CHR_UUID    = "b7c4b694-bee3-45dd-ba9f-f3b5e994f49a"
+BATTERY_LEVEL_CHR_UUID  = "00002a19-0000-1000-8000-00805f9b34fb"
+
+# UUID to object path map of discovered GATT attributes, see gatt_cache.py
+GATT_CACHE_FILE = "/var/lib/thunderboard/gatt_cache.json"
+
+# GATT service of the gateway itself, see gatt_server.py
+GATEWAY_SVC_UUID        = "8c2f1a00-6b3e-4d5a-9f1e-2a7c5b0e4d10"
+GATEWAY_DEVICES_CHR_UUID = "8c2f1a01-6b3e-4d5a-9f1e-2a7c5b0e4d10"
+GATEWAY_STATE_CHR_UUID  = "8c2f1a02-6b3e-4d5a-9f1e-2a7c5b0e4d10"
+USER_DESCRIPTION_DSC_UUID = "00002901-0000-1000-8000-00805f9b34fb"
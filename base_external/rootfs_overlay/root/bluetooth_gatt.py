@@ -1,186 +1,344 @@
-#!/usr/bin/python3
-#
-# Defines Services, Characteristic and Descriptor classes which should be extended to make concrete
-# GATT attributes of specific types by Applications
-#
-# This code largely originates from test/example-gatt-server in the BlueZ source
-
-import dbus
-import dbus.exceptions
-import dbus.service
-import bluetooth_constants
-import bluetooth_exceptions
-import sys
-sys.path.insert(0, '.')
-
-class Service(dbus.service.Object):
-    """
-    org.bluez.GattService1 interface implementation
-    """
-
-    def __init__(self, bus, path_base, index, uuid, primary):
-        self.path = path_base + "/service" + str(index)
-        self.bus = bus
-        self.uuid = uuid
-        self.primary = primary
-        self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
-                bluetooth_constants.GATT_SERVICE_INTERFACE: {
-                        'UUID': self.uuid,
-                        'Primary': self.primary,
-                        'Characteristics': dbus.Array(
-                                self.get_characteristic_paths(),
-                                signature='o')
-                }
-        }
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_characteristic(self, characteristic):
-        self.characteristics.append(characteristic)
-
-    def get_characteristic_paths(self):
-        result = []
-        for chrc in self.characteristics:
-            result.append(chrc.get_path())
-        return result
-
-    def get_characteristics(self):
-        return self.characteristics
-
-    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != bluetooth_constants.GATT_SERVICE_INTERFACE:
-            raise bluetooth_exceptions.bluetooth_exceptions.InvalidArgsException()
-
-        return self.get_properties()[bluetooth_constants.GATT_SERVICE_INTERFACE]
-
-
-class Characteristic(dbus.service.Object):
-    """
-    org.bluez.GattCharacteristic1 interface implementation
-    """
-    def __init__(self, bus, index, uuid, flags, service):
-        self.path = service.path + '/char' + str(index)
-        print("creating Characteristic with path="+self.path)
-        self.bus = bus
-        self.uuid = uuid
-        self.service = service
-        self.flags = flags
-        self.descriptors = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
-                bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
-        }
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_descriptor(self, descriptor):
-        self.descriptors.append(descriptor)
-
-    def get_descriptor_paths(self):
-        result = []
-        for desc in self.descriptors:
-            result.append(desc.get_path())
-        return result
-
-    def get_descriptors(self):
-        return self.descriptors
-
-    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE:
-            raise bluetooth_exceptions.bluetooth_exceptions.InvalidArgsException()
-
-        return self.get_properties()[bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE]
-
-    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
-                        in_signature='a{sv}',
-                        out_signature='ay')
-    def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
-        raise bluetooth_exceptions.NotSupportedException()
-
-    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, in_signature='aya{sv}')
-    def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise bluetooth_exceptions.NotSupportedException()
-
-    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
-    def StartNotify(self):
-        print('Default StartNotify called, returning error')
-        raise bluetooth_exceptions.NotSupportedException()
-
-    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
-    def StopNotify(self):
-        print('Default StopNotify called, returning error')
-        raise bluetooth_exceptions.NotSupportedException()
-
-    @dbus.service.signal(bluetooth_constants.DBUS_PROPERTIES,
-                         signature='sa{sv}as')
-    def PropertiesChanged(self, interface, changed, invalidated):
-        pass
-
-
-class Descriptor(dbus.service.Object):
-    """
-    org.bluez.GattDescriptor1 interface implementation
-    """
-    def __init__(self, bus, index, uuid, flags, characteristic):
-        self.path = characteristic.path + '/desc' + str(index)
-        self.bus = bus
-        self.uuid = uuid
-        self.flags = flags
-        self.chrc = characteristic
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
-                bluetooth_constants.GATT_DESCRIPTOR_INTERFACE: {
-                        'Characteristic': self.chrc.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                }
-        }
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != bluetooth_constants.GATT_DESCRIPTOR_INTERFACE:
-            raise bluetooth_exceptions.InvalidArgsException()
-
-        return self.get_properties()[bluetooth_constants.GATT_DESCRIPTOR_INTERFACE]
-
-    @dbus.service.method(bluetooth_constants.GATT_DESCRIPTOR_INTERFACE,
-                        in_signature='a{sv}',
-                        out_signature='ay')
-    def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
-        raise bluetooth_exceptions.NotSupportedException()
-
-    @dbus.service.method(bluetooth_constants.GATT_DESCRIPTOR_INTERFACE, in_signature='aya{sv}')
-    def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise bluetooth_exceptions.NotSupportedException()
+#!/usr/bin/python3
+#
+# Defines Services, Characteristic and Descriptor classes which should be extended to make concrete
+# GATT attributes of specific types by Applications
+#
+# This code largely originates from test/example-gatt-server in the BlueZ source
+#
+# Property dictionaries are built once and kept until the object tree changes
+# (a characteristic or descriptor is added), so GetAll and GetManagedObjects
+# only marshal what is cached. Characteristic values are not part of the
+# properties, they are served by ReadValue and sent by notify().
+
+import dbus
+import dbus.exceptions
+import dbus.service
+import logging
+import time
+import bluetooth_constants
+import bluetooth_exceptions
+import sys
+sys.path.insert(0, '.')
+
+from gi.repository import GLib
+
+log = logging.getLogger("thunderboard")
+
+class Application(dbus.service.Object):
+    """
+    org.freedesktop.DBus.ObjectManager implementation, the root object of the
+    services registered with GattManager1.RegisterApplication
+    """
+
+    def __init__(self, bus, path='/'):
+        self.path = path
+        self.bus = bus
+        self.services = []
+        self.managed_objects = None
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_service(self, service):
+        service.application = self
+        self.services.append(service)
+        self.invalidate()
+
+    def get_services(self):
+        return self.services
+
+    # called whenever an object below the application is added
+    def invalidate(self):
+        self.managed_objects = None
+
+    def get_managed_objects(self):
+        if self.managed_objects is None:
+            objects = {}
+            for service in self.services:
+                objects[service.get_path()] = service.get_properties()
+                for chrc in service.get_characteristics():
+                    objects[chrc.get_path()] = chrc.get_properties()
+                    for desc in chrc.get_descriptors():
+                        objects[desc.get_path()] = desc.get_properties()
+            self.managed_objects = objects
+        return self.managed_objects
+
+    @dbus.service.method(bluetooth_constants.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return self.get_managed_objects()
+
+    # BlueZ calls GetManagedObjects before it replies to RegisterApplication,
+    # so the call has to be asynchronous while the main loop serves us
+    def register(self, adapter_path, reply_handler, error_handler):
+        manager = dbus.Interface(self.bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME,
+                                                     adapter_path),
+                                 bluetooth_constants.GATT_MANAGER_INTERFACE)
+        manager.RegisterApplication(self.get_path(), {},
+                                    reply_handler=reply_handler,
+                                    error_handler=error_handler)
+
+    def unregister(self, adapter_path):
+        manager = dbus.Interface(self.bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME,
+                                                     adapter_path),
+                                 bluetooth_constants.GATT_MANAGER_INTERFACE)
+        try:
+            manager.UnregisterApplication(self.get_path())
+        except dbus.exceptions.DBusException as e:
+            log.warning("UnregisterApplication failed, %s", e.get_dbus_message())
+
+
+class Service(dbus.service.Object):
+    """
+    org.bluez.GattService1 interface implementation
+    """
+
+    def __init__(self, bus, path_base, index, uuid, primary):
+        self.path = path_base + "/service" + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+        self.application = None
+        self.properties = None
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
+        return {
+                bluetooth_constants.GATT_SERVICE_INTERFACE: {
+                        'UUID': self.uuid,
+                        'Primary': self.primary,
+                        'Characteristics': dbus.Array(
+                                self.get_characteristic_paths(),
+                                signature='o')
+                }
+        }
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+        self.invalidate()
+
+    def invalidate(self):
+        self.properties = None
+        if self.application is not None:
+            self.application.invalidate()
+
+    def get_characteristic_paths(self):
+        result = []
+        for chrc in self.characteristics:
+            result.append(chrc.get_path())
+        return result
+
+    def get_characteristics(self):
+        return self.characteristics
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != bluetooth_constants.GATT_SERVICE_INTERFACE:
+            raise bluetooth_exceptions.InvalidArgsException()
+
+        return self.get_properties()[bluetooth_constants.GATT_SERVICE_INTERFACE]
+
+
+class Characteristic(dbus.service.Object):
+    """
+    org.bluez.GattCharacteristic1 interface implementation
+
+    With 'read' in flags ReadValue returns value, with 'notify' or 'indicate'
+    StartNotify enables notify(), which sends PropertiesChanged at most once
+    per notify_interval seconds and coalesces faster updates to the latest one.
+    """
+    def __init__(self, bus, index, uuid, flags, service, notify_interval=0.0):
+        self.path = service.path + '/char' + str(index)
+        log.debug("creating Characteristic with path=%s", self.path)
+        self.bus = bus
+        self.uuid = uuid
+        self.service = service
+        self.flags = flags
+        self.descriptors = []
+        self.properties = None
+
+        self.value = b''
+        self.notifying = False
+        self.notify_interval = notify_interval
+        self.notify_time = 0
+        self.notify_timer_id = None
+        self.notifications = 0
+        self.coalesced = 0
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
+        return {
+                bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE: {
+                        'Service': self.service.get_path(),
+                        'UUID': self.uuid,
+                        'Flags': self.flags,
+                        'Descriptors': dbus.Array(
+                                self.get_descriptor_paths(),
+                                signature='o')
+                }
+        }
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_descriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+        self.invalidate()
+
+    def invalidate(self):
+        self.properties = None
+        if self.service.application is not None:
+            self.service.application.invalidate()
+
+    def get_descriptor_paths(self):
+        result = []
+        for desc in self.descriptors:
+            result.append(desc.get_path())
+        return result
+
+    def get_descriptors(self):
+        return self.descriptors
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE:
+            raise bluetooth_exceptions.InvalidArgsException()
+
+        return self.get_properties()[bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE]
+
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                        in_signature='a{sv}',
+                        out_signature='ay')
+    def ReadValue(self, options):
+        if 'read' not in self.flags:
+            log.debug("Default ReadValue called, returning error")
+            raise bluetooth_exceptions.NotSupportedException()
+        return dbus.ByteArray(self.value)
+
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, in_signature='aya{sv}')
+    def WriteValue(self, value, options):
+        log.debug("Default WriteValue called, returning error")
+        raise bluetooth_exceptions.NotSupportedException()
+
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+    def StartNotify(self):
+        if 'notify' not in self.flags and 'indicate' not in self.flags:
+            log.debug("Default StartNotify called, returning error")
+            raise bluetooth_exceptions.NotSupportedException()
+        self.notifying = True
+
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+    def StopNotify(self):
+        if 'notify' not in self.flags and 'indicate' not in self.flags:
+            log.debug("Default StopNotify called, returning error")
+            raise bluetooth_exceptions.NotSupportedException()
+        self.notifying = False
+        if self.notify_timer_id is not None:
+            GLib.source_remove(self.notify_timer_id)
+            self.notify_timer_id = None
+
+    @dbus.service.signal(bluetooth_constants.DBUS_PROPERTIES,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    # Set the value (bytes) and send it to the subscribed client. Within
+    # notify_interval of the last notification only the timer for the next
+    # one is armed, it sends whatever the value is by then.
+    def notify(self, value):
+        self.value = value
+        if not self.notifying:
+            return
+        if self.notify_timer_id is not None:
+            self.coalesced += 1
+            return
+        wait = self.notify_time + self.notify_interval - time.monotonic()
+        if wait > 0:
+            self.notify_timer_id = GLib.timeout_add(int(wait * 1000) + 1, self.notify_pending)
+            return
+        self.send_notification()
+
+    def notify_pending(self):
+        self.notify_timer_id = None
+        if self.notifying:
+            self.send_notification()
+        return False
+
+    def send_notification(self):
+        self.notify_time = time.monotonic()
+        self.notifications += 1
+        self.PropertiesChanged(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                               {'Value': dbus.ByteArray(self.value)}, [])
+
+
+class Descriptor(dbus.service.Object):
+    """
+    org.bluez.GattDescriptor1 interface implementation
+    """
+    def __init__(self, bus, index, uuid, flags, characteristic):
+        self.path = characteristic.path + '/desc' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.flags = flags
+        self.chrc = characteristic
+        self.properties = None
+        self.value = b''
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
+        return {
+                bluetooth_constants.GATT_DESCRIPTOR_INTERFACE: {
+                        'Characteristic': self.chrc.get_path(),
+                        'UUID': self.uuid,
+                        'Flags': self.flags,
+                }
+        }
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != bluetooth_constants.GATT_DESCRIPTOR_INTERFACE:
+            raise bluetooth_exceptions.InvalidArgsException()
+
+        return self.get_properties()[bluetooth_constants.GATT_DESCRIPTOR_INTERFACE]
+
+    @dbus.service.method(bluetooth_constants.GATT_DESCRIPTOR_INTERFACE,
+                        in_signature='a{sv}',
+                        out_signature='ay')
+    def ReadValue(self, options):
+        if 'read' not in self.flags:
+            log.debug("Default ReadValue called, returning error")
+            raise bluetooth_exceptions.NotSupportedException()
+        return dbus.ByteArray(self.value)
+
+    @dbus.service.method(bluetooth_constants.GATT_DESCRIPTOR_INTERFACE, in_signature='aya{sv}')
+    def WriteValue(self, value, options):
+        log.debug("Default WriteValue called, returning error")
+        raise bluetooth_exceptions.NotSupportedException()
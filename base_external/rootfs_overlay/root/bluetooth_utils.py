@@ -1,63 +1,183 @@
-#!/usr/bin/python3
-import dbus
-import sys
-from sys import stdin, stdout
-sys.path.insert(0, '.')
-import bluetooth_constants
-
-def byteArrayToHexString(bytes):
-    hex_string = ""
-    for byte in bytes:
-        hex_byte = '%02X' % byte
-        hex_string = hex_string + hex_byte
-    return hex_string
-
-def dbus_to_python(data):
-    if isinstance(data, dbus.String):
-        data = str(data)
-    if isinstance(data, dbus.ObjectPath):
-        data = str(data)
-    elif isinstance(data, dbus.Boolean):
-        data = bool(data)
-    elif isinstance(data, dbus.Int64):
-        data = int(data)
-    elif isinstance(data, dbus.Int32):
-        data = int(data)
-    elif isinstance(data, dbus.Int16):
-        data = int(data)
-    elif isinstance(data, dbus.UInt16):
-        data = int(data)
-    elif isinstance(data, dbus.Byte):
-        data = int(data)
-    elif isinstance(data, dbus.Double):
-        data = float(data)
-    elif isinstance(data, dbus.Array):
-        data = [dbus_to_python(value) for value in data]
-    elif isinstance(data, dbus.Dictionary):
-        new_data = dict()
-        for key in data.keys():
-            new_data[key] = dbus_to_python(data[key])
-        data = new_data
-    return data
-
-def device_address_to_path(bdaddr, adapter_path):
-    # e.g.convert 12:34:44:00:66:D5 on adapter hci0 to /org/bluez/hci0/dev_12_34_44_00_66_D5
-    path = adapter_path + "/dev_" + bdaddr.replace(":","_")
-    return path
-
-def get_name_from_uuid(uuid):
-    if uuid in bluetooth_constants.UUID_NAMES:
-        return bluetooth_constants.UUID_NAMES[uuid]
-    else:
-        return "Unknown"
-
-def text_to_ascii_array(text):
-    ascii_values = []
-    for character in text:
-        ascii_values.append(ord(character))
-    return ascii_values
-
-def print_properties(props):
-    # dbus.Dictionary({dbus.String('SupportedInstances'): dbus.Byte(4, variant_level=1), dbus.String('ActiveInstances'): dbus.Byte(1, variant_level=1)}, signature=dbus.Signature('sv'))
-    for key in props:
+#!/usr/bin/python3
+import dbus
+import dbus.lowlevel
+import sys
+from sys import stdin, stdout
+sys.path.insert(0, '.')
+import bluetooth_constants
+
+def byteArrayToHexString(bytes):
+    return bytearray(bytes).hex().upper()
+
+# dbus types converted to a python value in one call, looked up by exact type
+DBUS_SCALAR_TYPES = {
+    dbus.String: str,
+    dbus.ObjectPath: str,
+    dbus.Signature: str,
+    dbus.Boolean: bool,
+    dbus.Byte: int,
+    dbus.Int16: int,
+    dbus.UInt16: int,
+    dbus.Int32: int,
+    dbus.UInt32: int,
+    dbus.Int64: int,
+    dbus.UInt64: int,
+    dbus.Double: float,
+    dbus.ByteArray: bytes,
+}
+
+DBUS_CONTAINER_TYPES = (dbus.Array, dbus.Dictionary, dbus.Struct)
+
+# Convert dbus types to plain python types. Containers are walked with an explicit
+# stack instead of recursion, byte arrays ('ay') become bytes in one call and
+# structs become tuples. Values which are not dbus types are returned unchanged.
+def dbus_to_python(data):
+    data_type = type(data)
+    convert = DBUS_SCALAR_TYPES.get(data_type)
+    if convert is not None:
+        return convert(data)
+    if data_type not in DBUS_CONTAINER_TYPES:
+        return data
+
+    scalars = DBUS_SCALAR_TYPES
+    containers = DBUS_CONTAINER_TYPES
+    root = [data]
+    stack = [(root, 0, data)]
+    structs = []
+    while stack:
+        parent, key, source = stack.pop()
+        source_type = type(source)
+        if source_type is dbus.Dictionary:
+            target = {}
+            for item_key, value in source.items():
+                convert = scalars.get(type(item_key))
+                if convert is not None:
+                    item_key = convert(item_key)
+                value_type = type(value)
+                convert = scalars.get(value_type)
+                if convert is not None:
+                    target[item_key] = convert(value)
+                else:
+                    target[item_key] = value
+                    if value_type in containers:
+                        stack.append((target, item_key, value))
+        elif source_type is dbus.Array and source.signature == 'y':
+            target = bytes(source)
+        else:
+            target = list(source)
+            for index, value in enumerate(target):
+                value_type = type(value)
+                convert = scalars.get(value_type)
+                if convert is not None:
+                    target[index] = convert(value)
+                elif value_type in containers:
+                    stack.append((target, index, value))
+            if source_type is dbus.Struct:
+                structs.append((parent, key, target))
+        parent[key] = target
+
+    # structs were collected parents first, so inner ones are frozen before
+    # the struct or array holding them
+    for parent, key, target in reversed(structs):
+        parent[key] = tuple(target)
+    return root[0]
+
+def device_address_to_path(bdaddr, adapter_path):
+    # e.g.convert 12:34:44:00:66:D5 on adapter hci0 to /org/bluez/hci0/dev_12_34_44_00_66_D5
+    path = adapter_path + "/dev_" + bdaddr.replace(":","_")
+    return path
+
+def device_path_to_address(path):
+    # e.g. convert /org/bluez/hci0/dev_12_34_44_00_66_D5 to 12:34:44:00:66:D5
+    return path[path.rfind("/dev_") + 5:].replace("_", ":")
+
+def object_path_to_device_path(path):
+    # e.g. convert /org/bluez/hci0/dev_12_34_44_00_66_D5/service000a/char000b to /org/bluez/hci0/dev_12_34_44_00_66_D5
+    index = path.find("/dev_")
+    if index < 0:
+        return None
+    end = path.find("/", index + 1)
+    if end < 0:
+        return path
+    return path[:end]
+
+# arg0path semantics of the D-Bus specification: equal, or one of them ends
+# with '/' and is a prefix of the other
+def path_matches(rule, path):
+    if path == rule:
+        return True
+    if rule.endswith("/") and path.startswith(rule):
+        return True
+    return path.endswith("/") and rule.startswith(path)
+
+class MatchRule(object):
+    """
+    Signal receiver with the match keys add_signal_receiver cannot express:
+    path_namespace (an object and everything below it) and arg0path (first
+    argument, an object path, below a prefix ending in '/'). The rule is added
+    on the bus daemon, so signals outside it never reach the process; the
+    message filter checks the same keys for signals other rules let in.
+    """
+
+    def __init__(self, bus, handler, dbus_interface, signal_name, path=None,
+                 path_namespace=None, arg0=None, arg0path=None,
+                 bus_name=bluetooth_constants.BLUEZ_SERVICE_NAME, path_keyword=None):
+        self.bus = bus
+        self.handler = handler
+        self.dbus_interface = dbus_interface
+        self.signal_name = signal_name
+        self.path = path
+        self.path_namespace = path_namespace
+        self.arg0 = arg0
+        self.arg0path = arg0path
+        self.path_keyword = path_keyword
+        keys = [("type", "signal"), ("sender", bus_name), ("interface", dbus_interface),
+                ("member", signal_name), ("path", path), ("path_namespace", path_namespace),
+                ("arg0", arg0), ("arg0path", arg0path)]
+        self.rule = ",".join("%s='%s'" % (key, value) for key, value in keys if value is not None)
+        # the same bound method object is needed to remove the filter again
+        self.filter_func = self.filter
+        bus.add_match_string_non_blocking(self.rule)
+        bus.add_message_filter(self.filter_func)
+
+    def matches(self, message):
+        if (message.get_type() != dbus.lowlevel.MESSAGE_TYPE_SIGNAL or
+                message.get_member() != self.signal_name or
+                message.get_interface() != self.dbus_interface):
+            return False
+        path = message.get_path()
+        if self.path is not None and path != self.path:
+            return False
+        if self.path_namespace is not None and path != self.path_namespace and \
+                not path.startswith(self.path_namespace + "/"):
+            return False
+        return True
+
+    def filter(self, bus, message):
+        if self.matches(message):
+            args = message.get_args_list(byte_arrays=True)
+            if ((self.arg0 is None or (args and args[0] == self.arg0)) and
+                    (self.arg0path is None or (args and path_matches(self.arg0path, args[0])))):
+                if self.path_keyword is not None:
+                    self.handler(*args, **{self.path_keyword: message.get_path()})
+                else:
+                    self.handler(*args)
+        return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+    def remove(self):
+        self.bus.remove_message_filter(self.filter_func)
+        self.bus.remove_match_string_non_blocking(self.rule)
+
+def get_name_from_uuid(uuid):
+    if uuid in bluetooth_constants.UUID_NAMES:
+        return bluetooth_constants.UUID_NAMES[uuid]
+    else:
+        return "Unknown"
+
+def text_to_ascii_array(text):
+    return list(map(ord, text))
+
+def print_properties(props):
+    # dbus.Dictionary({dbus.String('SupportedInstances'): dbus.Byte(4, variant_level=1), dbus.String('ActiveInstances'): dbus.Byte(1, variant_level=1)}, signature=dbus.Signature('sv'))
+    for key in props:
         print(key+"="+str(props[key]))
\ No newline at end of file
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+#
+# Payload layouts of the characteristics the gateway understands. Every
+# decoder is declared as a struct layout with a name and scale per field,
+# e.g. the temperature of the Environmental Sensing service is one little
+# endian sint16 in 0.01 degrees Celsius:
+#
+#   register(CharacteristicDecoder(TEMPERATURE_CHR_UUID, "temperature", "<h",
+#                                  ("celsius",), (0.01,), stream=True))
+#
+# decode() turns one notification into a value (one field) or a tuple.
+# Characteristics declared with stream=True (environmental and IMU data, tens
+# to hundreds of notifications per second) are not decoded one by one: their
+# raw payloads are buffered in SensorStreams and every interval the payloads
+# of a stream are joined, unpacked with one struct.iter_unpack call and
+# published as one message per stream with a column per field:
+#
+#   <prefix>/<device>/<name>  {"fields":["x","y","z"],"scale":[0.001,0.001,0.001],
+#                              "ts":[<ms>,...],"values":[[x,...],[y,...],[z,...]]}
+#
+# The values are the raw integers of the payload, a consumer multiplies them
+# by the scale of the field. The target image has no NumPy, iter_unpack and
+# zip are the batch path.
+
+import collections
+import json
+import struct
+import event_payload
+import bluetooth_constants
+import sys
+sys.path.insert(0, '.')
+
+class CharacteristicDecoder(object):
+    """
+    Struct layout of a characteristic value with the name and scale of every field
+    """
+
+    def __init__(self, uuid, name, layout, fields, scales=None, stream=False):
+        self.uuid = uuid
+        self.name = name
+        self.struct = struct.Struct(layout)
+        self.fields = tuple(fields)
+        self.scales = tuple(scales) if scales else None
+        self.stream = stream
+        if len(self.fields) != len(self.struct.unpack(bytes(self.struct.size))):
+            raise ValueError("%s: %d fields for layout %s" % (name, len(self.fields), layout))
+
+    # One raw value (bytes or dbus.ByteArray), extra bytes are ignored
+    def decode(self, value):
+        values = self.struct.unpack_from(value)
+        if self.scales is not None:
+            values = tuple(v * s for v, s in zip(values, self.scales))
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    # Raw field values of a list of payloads as one column per field, decoded
+    # with one iter_unpack over their concatenation and transposed by zip, no
+    # Python step per sample. Payloads of the wrong size are skipped; returns
+    # the columns and the payloads used.
+    def decode_batch(self, payloads):
+        size = self.struct.size
+        data = b"".join(payloads)
+        if len(data) != size * len(payloads):
+            payloads = [payload for payload in payloads if len(payload) == size]
+            data = b"".join(payloads)
+        columns = list(zip(*self.struct.iter_unpack(data)))
+        if not columns:
+            columns = [()] * len(self.fields)
+        return columns, payloads
+
+
+# uuid -> CharacteristicDecoder
+DECODERS = {}
+
+def register(decoder):
+    DECODERS[decoder.uuid] = decoder
+    return decoder
+
+def get_decoder(uuid):
+    return DECODERS.get(str(uuid))
+
+# decoder by UUID or by name, e.g. for command line options
+def find_decoder(name):
+    decoder = DECODERS.get(name.lower())
+    if decoder is not None:
+        return decoder
+    for decoder in DECODERS.values():
+        if decoder.name == name:
+            return decoder
+    return None
+
+# uuids of the characteristics decoded as streams
+def stream_uuids():
+    return tuple(uuid for uuid, decoder in DECODERS.items() if decoder.stream)
+
+register(CharacteristicDecoder(bluetooth_constants.BUTTON_CHR_UUID, "button", "<B", ("state",)))
+register(CharacteristicDecoder(bluetooth_constants.LED_CHR_UUID, "led", "<B", ("state",)))
+register(CharacteristicDecoder(bluetooth_constants.BATTERY_LEVEL_CHR_UUID, "battery", "<B",
+                               ("percent",)))
+register(CharacteristicDecoder(bluetooth_constants.TEMPERATURE_CHR_UUID, "temperature", "<h",
+                               ("celsius",), (0.01,), stream=True))
+register(CharacteristicDecoder(bluetooth_constants.HUMIDITY_CHR_UUID, "humidity", "<H",
+                               ("percent",), (0.01,), stream=True))
+register(CharacteristicDecoder(bluetooth_constants.PRESSURE_CHR_UUID, "pressure", "<I",
+                               ("pascal",), (0.1,), stream=True))
+register(CharacteristicDecoder(bluetooth_constants.UV_INDEX_CHR_UUID, "uv", "<B",
+                               ("index",), stream=True))
+register(CharacteristicDecoder(bluetooth_constants.AMBIENT_LIGHT_CHR_UUID, "light", "<I",
+                               ("lux",), (0.01,), stream=True))
+register(CharacteristicDecoder(bluetooth_constants.ACCELERATION_CHR_UUID, "acceleration", "<hhh",
+                               ("x", "y", "z"), (0.001, 0.001, 0.001), stream=True))
+register(CharacteristicDecoder(bluetooth_constants.ORIENTATION_CHR_UUID, "orientation", "<hhh",
+                               ("x", "y", "z"), (0.01, 0.01, 0.01), stream=True))
+
+
+class SensorStreams(object):
+    """
+    Raw payloads of the stream characteristics of all devices, decoded and
+    published per stream every flush
+    """
+
+    def __init__(self, publisher, topic_prefix, max_samples=1000):
+        self.publisher = publisher
+        self.topic_prefix = topic_prefix
+        # payloads kept per stream between flushes, the oldest are dropped
+        self.max_samples = max_samples
+        # (bdaddr, uuid) -> SensorStream
+        self.streams = {}
+        self.samples = 0
+        self.dropped = 0
+        self.malformed = 0
+
+    def add_stream(self, bdaddr, decoder):
+        key = (bdaddr, decoder.uuid)
+        stream = self.streams.get(key)
+        if stream is None:
+            topic = event_payload.device_topic(self.topic_prefix, bdaddr, decoder.name)
+            stream = self.streams[key] = SensorStream(self, decoder, topic)
+        return stream
+
+    # GLib timer callback
+    def flush(self):
+        for stream in self.streams.values():
+            if stream.payloads:
+                stream.flush()
+        return True
+
+
+class SensorStream(object):
+    """
+    Buffered notifications of one characteristic of one device
+    """
+
+    def __init__(self, streams, decoder, topic):
+        self.streams = streams
+        self.decoder = decoder
+        self.topic = topic
+        self.scales = list(decoder.scales or (1,) * len(decoder.fields))
+        self.timestamps = collections.deque(maxlen=streams.max_samples)
+        self.payloads = collections.deque(maxlen=streams.max_samples)
+        self.added = 0
+
+    # Notification callback path, only appends; timestamp is time.time()
+    def add(self, timestamp, payload):
+        self.timestamps.append(timestamp)
+        self.payloads.append(payload)
+        self.added += 1
+
+    def flush(self):
+        decoder = self.decoder
+        timestamps = self.timestamps
+        payloads = self.payloads
+        self.streams.dropped += self.added - len(payloads)
+        self.added = 0
+        self.timestamps = collections.deque(maxlen=self.streams.max_samples)
+        self.payloads = collections.deque(maxlen=self.streams.max_samples)
+        columns, used = decoder.decode_batch(payloads)
+        if len(used) != len(payloads):
+            self.streams.malformed += len(payloads) - len(used)
+            size = decoder.struct.size
+            timestamps = [t for t, payload in zip(timestamps, payloads) if len(payload) == size]
+        if not used:
+            return
+        self.streams.samples += len(used)
+        self.streams.publisher.publish(self.topic, json.dumps(
+            {"fields": decoder.fields, "scale": self.scales,
+             "ts": list(map(int, map((1000.0).__mul__, timestamps))),
+             "values": columns}, separators=(",", ":")).encode())
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+#
+# Device registry and scanning of one adapter. The registry is seeded once from
+# ObjectManager.GetManagedObjects and kept up to date with InterfacesAdded,
+# InterfacesRemoved and PropertiesChanged while a scan runs. Sessions ask for a
+# device with find(); scanning runs only while some device is still wanted and
+# stops as soon as the last one shows up, or when the timeout expires.
+#
+# In passive mode (start_passive()) the scan runs for good and advertising data
+# (ManufacturerData, ServiceData) of every device is handed to a callback
+# instead of connecting to the devices.
+
+import dbus
+import logging
+import time
+import bluetooth_constants
+import bluetooth_utils
+import metrics
+import sys
+sys.path.insert(0, '.')
+
+from device_registry import DeviceRegistry
+from gi.repository import GLib
+
+log = logging.getLogger("thunderboard")
+
+# seconds between removals of devices not seen for max_age while scanning
+EXPIRE_INTERVAL = 30
+
+class DeviceDiscovery(object):
+    """
+    Device registry of one adapter, fed from GetManagedObjects and on demand scanning
+    """
+
+    def __init__(self, bus, adapter_path, scan_timeout, max_devices=1024, max_age=300.0):
+        self.bus = bus
+        self.adapter_path = adapter_path
+        self.scan_timeout = scan_timeout
+        adapter_object = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_path)
+        self.adapter_interface = dbus.Interface(adapter_object, bluetooth_constants.ADAPTER_INTERFACE)
+
+        self.devices = DeviceRegistry(max_devices, max_age)
+        # device path -> callback(record) of the devices a scan waits for
+        self.wanted = {}
+        self.matches = []
+        self.scanning = False
+        self.timer_id = None
+        self.expire_timer_id = None
+        self.scan_start = None
+        # passive mode: keep scanning, advert_callback(path, changed, record)
+        self.passive = False
+        self.advert_callback = None
+        # rssi_callback(record) on every RSSI update while scanning
+        self.rssi_callback = None
+
+    # Seed the device cache from what BlueZ already knows (cached, bonded or still
+    # connected devices) with a single call. Objects which are not devices are
+    # handed to other_objects(path, interfaces), e.g. the GATT tree of connected
+    # devices. objects is the GetManagedObjects reply if the caller has it already.
+    def load_managed_objects(self, other_objects=None, objects=None):
+        if objects is None:
+            om = dbus.Interface(self.bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, "/"),
+                                bluetooth_constants.DBUS_OM_IFACE)
+            objects = om.GetManagedObjects(byte_arrays=True)
+        for path, interfaces in objects.items():
+            if bluetooth_constants.DEVICE_INTERFACE in interfaces:
+                if path.startswith(self.adapter_path + "/"):
+                    self.devices.update(path, interfaces[bluetooth_constants.DEVICE_INTERFACE])
+            elif other_objects is not None:
+                other_objects(path, interfaces)
+
+    # DeviceRecord of a known device, None if BlueZ has not seen it
+    def get(self, device_path):
+        return self.devices.get(device_path)
+
+    # Call callback(record) once the device is known, immediately if it is
+    # already, or callback(None) if a scan does not find it in time. The
+    # device is kept in the registry from now on.
+    def find(self, device_path, callback):
+        self.devices.pin(device_path)
+        record = self.devices.get(device_path)
+        if record is not None:
+            callback(record)
+            return
+        self.wanted[device_path] = callback
+        self.start_scan()
+
+    def cancel(self, device_path):
+        self.wanted.pop(device_path, None)
+        if not self.wanted:
+            self.stop_scan()
+
+    def dd_interfaces_added(self, path, interfaces):
+        # interfaces is an array of dictionary entries
+        if not bluetooth_constants.DEVICE_INTERFACE in interfaces:
+            return
+        device_properties = interfaces[bluetooth_constants.DEVICE_INTERFACE]
+        record = self.devices.update(path, device_properties)
+        if self.advert_callback is not None:
+            self.advert_callback(path, device_properties, record)
+        callback = self.wanted.pop(path, None)
+        if callback is not None:
+            if not self.wanted:
+                log.info("All devices found after %.3f s", time.monotonic() - self.scan_start)
+                metrics.discovery_seconds.observe(time.monotonic() - self.scan_start)
+                self.stop_scan()
+            callback(record)
+
+    def dd_interfaces_removed(self, path, interfaces):
+        # interfaces is an array of dictionary strings in this signal
+        if not bluetooth_constants.DEVICE_INTERFACE in interfaces:
+            return
+        self.devices.remove(path)
+
+    # updates the record in place, an RSSI change costs one attribute store
+    def dd_properties_changed(self, interface, changed, invalidated, path):
+        record = self.devices.update(path, changed)
+        if self.rssi_callback is not None and 'RSSI' in changed:
+            self.rssi_callback(record)
+        if self.advert_callback is not None and ('ManufacturerData' in changed or
+                                                 'ServiceData' in changed):
+            self.advert_callback(path, changed, record)
+
+    def expire_devices(self):
+        expired = self.devices.expire()
+        if expired:
+            log.debug("Expired %d device(s), %d known", expired, len(self.devices))
+        return True
+
+    # Tune what BlueZ reports while scanning: LE only, devices above an RSSI
+    # threshold (dBm, None for all), and with duplicate_data every advertisement
+    # rather than only changes the controller lets through
+    def set_discovery_filter(self, rssi=None, duplicate_data=True, uuids=None):
+        scan_filter = {'Transport': 'le', 'DuplicateData': dbus.Boolean(duplicate_data)}
+        if rssi is not None:
+            scan_filter['RSSI'] = dbus.Int16(rssi)
+        if uuids:
+            scan_filter['UUIDs'] = dbus.Array(uuids, signature='s')
+        try:
+            self.adapter_interface.SetDiscoveryFilter(dbus.Dictionary(scan_filter, signature='sv'))
+        except dbus.exceptions.DBusException as e:
+            log.warning("SetDiscoveryFilter failed, %s", e.get_dbus_message())
+
+    def start_passive(self, callback):
+        self.passive = True
+        self.advert_callback = callback
+        self.start_scan()
+
+    def stop_passive(self):
+        self.passive = False
+        self.advert_callback = None
+        if not self.wanted:
+            self.stop_scan()
+
+    # discover devices using d-bus signals (InterfacesAdded, InterfacesRemoved,
+    # and PropertiesChanged) and callback interface
+    def start_scan(self):
+        if self.wanted and self.timer_id is None:
+            log.info("Scanning for %d device(s)", len(self.wanted))
+            self.scan_start = time.monotonic()
+            self.timer_id = GLib.timeout_add(self.scan_timeout * 1000, self.discovery_timeout)
+        if self.scanning:
+            return
+        self.scanning = True
+
+        # The rules below are matched by the bus daemon: signals of other
+        # services, other adapters and of GATT objects (every button
+        # notification of a connected board) do not wake the process up.
+
+        # InterfacesAdded signal is emitted by BlueZ when an advertising packet from a device it doesn't
+        # already know about is received
+        self.matches.append(bluetooth_utils.MatchRule(self.bus, self.dd_interfaces_added,
+                bluetooth_constants.DBUS_OM_IFACE, "InterfacesAdded",
+                path = "/", arg0path = self.adapter_path + "/"))
+
+        # InterfacesRemoved signal is emitted by BlueZ when a device "goes away"
+        self.matches.append(bluetooth_utils.MatchRule(self.bus, self.dd_interfaces_removed,
+                bluetooth_constants.DBUS_OM_IFACE, "InterfacesRemoved",
+                path = "/", arg0path = self.adapter_path + "/"))
+
+        # PropertiesChanged signal is emitted by BlueZ when something re: a device already encountered
+        # changes e.g. the RSSI value
+        self.matches.append(bluetooth_utils.MatchRule(self.bus, self.dd_properties_changed,
+                bluetooth_constants.DBUS_PROPERTIES, "PropertiesChanged",
+                path_namespace = self.adapter_path, arg0 = bluetooth_constants.DEVICE_INTERFACE,
+                path_keyword = "path"))
+
+        self.expire_timer_id = GLib.timeout_add_seconds(EXPIRE_INTERVAL, self.expire_devices)
+        try:
+            self.adapter_interface.StartDiscovery()
+        except dbus.exceptions.DBusException as e:
+            # e.g. org.bluez.Error.InProgress when another client scans
+            log.warning("StartDiscovery failed, %s", e.get_dbus_message())
+
+    # we don't need the signals registered when device discovery ends,
+    # either on timeout or when the last wanted device showed up, unless
+    # passive mode keeps the scan running
+    def stop_scan(self):
+        if self.timer_id is not None:
+            GLib.source_remove(self.timer_id)
+            self.timer_id = None
+        if not self.scanning or self.passive:
+            return
+        self.scanning = False
+        GLib.source_remove(self.expire_timer_id)
+        self.expire_timer_id = None
+        for match in self.matches:
+            match.remove()
+        self.matches = []
+        try:
+            self.adapter_interface.StopDiscovery()
+        except dbus.exceptions.DBusException as e:
+            log.warning("StopDiscovery failed, %s", e.get_dbus_message())
+
+    def discovery_timeout(self):
+        self.timer_id = None
+        metrics.discovery_seconds.observe(time.monotonic() - self.scan_start)
+        wanted = self.wanted
+        self.wanted = {}
+        self.stop_scan()
+        for path, callback in wanted.items():
+            log.info("Not found: %s", path)
+            callback(None)
+        return False
+
+    # drop a device BlueZ no longer knows (Connect failed with UnknownObject)
+    # so the next find() scans for it
+    def forget(self, device_path):
+        self.devices.remove(device_path)
+
+    def remove_device(self, device_path):
+        try:
+            self.adapter_interface.RemoveDevice(device_path)
+        except dbus.exceptions.DBusException as e:
+            log.error(e.get_dbus_message())
+        self.devices.unpin(device_path)
+        self.devices.remove(device_path)
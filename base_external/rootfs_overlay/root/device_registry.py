@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+#
+# Bounded store of the devices seen on an adapter. Each device is a fixed set of
+# fields converted from the Device1 properties once, updated in place on
+# PropertiesChanged (an RSSI update is one attribute store, not a dict copy)
+# and indexed by address, advertised service UUID and name.
+#
+# The registry holds at most max_devices records. Records are kept in least
+# recently updated order; when a new device does not fit, or when a record has
+# not been updated for max_age seconds, the oldest one goes, except for pinned
+# devices (the ones sessions connect to) and connected ones.
+
+import collections
+import time
+import sys
+sys.path.insert(0, '.')
+
+def convert_uuids(value):
+    return tuple(str(uuid) for uuid in value)
+
+def convert_manufacturer_data(value):
+    return dict((int(company), bytes(data)) for company, data in value.items())
+
+def convert_service_data(value):
+    return dict((str(uuid), bytes(data)) for uuid, data in value.items())
+
+# Device1 property -> (record field, conversion from the dbus type)
+FIELDS = {
+    'Address' : ('address', str),
+    'Name' : ('name', str),
+    'Alias' : ('alias', str),
+    'RSSI' : ('rssi', int),
+    'TxPower' : ('tx_power', int),
+    'Paired' : ('paired', bool),
+    'Connected' : ('connected', bool),
+    'ServicesResolved' : ('services_resolved', bool),
+    'UUIDs' : ('uuids', convert_uuids),
+    'ManufacturerData' : ('manufacturer_data', convert_manufacturer_data),
+    'ServiceData' : ('service_data', convert_service_data),
+}
+
+class DeviceRecord(object):
+    """
+    Device1 state of one device
+    """
+    __slots__ = ("path", "address", "name", "alias", "rssi", "tx_power", "paired",
+                 "connected", "services_resolved", "uuids", "manufacturer_data",
+                 "service_data", "last_seen")
+
+    def __init__(self, path):
+        self.path = path
+        self.address = None
+        self.name = None
+        self.alias = None
+        self.rssi = None
+        self.tx_power = None
+        self.paired = False
+        self.connected = False
+        self.services_resolved = False
+        self.uuids = ()
+        self.manufacturer_data = None
+        self.service_data = None
+        self.last_seen = 0
+
+
+class DeviceRegistry(object):
+    """
+    Device records by object path with address, UUID and name indexes
+    """
+
+    def __init__(self, max_devices=1024, max_age=300.0):
+        self.max_devices = max_devices
+        self.max_age = max_age
+        # path -> DeviceRecord, least recently updated first
+        self.records = collections.OrderedDict()
+        self.by_address = {}
+        self.by_uuid = {}
+        self.by_name = {}
+        self.pinned = set()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, path):
+        return path in self.records
+
+    def get(self, path):
+        return self.records.get(path)
+
+    def get_by_address(self, address):
+        return self.by_address.get(address.upper())
+
+    # records advertising the service UUID
+    def find_by_uuid(self, uuid):
+        return [self.records[path] for path in self.by_uuid.get(uuid, ())]
+
+    def find_by_name(self, name):
+        return [self.records[path] for path in self.by_name.get(name, ())]
+
+    # Merge Device1 properties (all of them or the changed ones) into the
+    # record of path, creating it if needed
+    def update(self, path, properties, now=None):
+        record = self.records.get(path)
+        if record is None:
+            if len(self.records) >= self.max_devices:
+                self.evict_oldest()
+            record = DeviceRecord(path)
+            self.records[path] = record
+        else:
+            self.records.move_to_end(path)
+        record.last_seen = time.monotonic() if now is None else now
+
+        for key, value in properties.items():
+            field = FIELDS.get(key)
+            if field is None:
+                continue
+            name, convert = field
+            value = convert(value)
+            if name == 'address':
+                if record.address is not None:
+                    self.by_address.pop(record.address, None)
+                value = value.upper()
+                self.by_address[value] = record
+            elif name == 'name':
+                self.unindex(self.by_name, record.name, path)
+                self.index(self.by_name, value, path)
+            elif name == 'uuids':
+                for uuid in record.uuids:
+                    self.unindex(self.by_uuid, uuid, path)
+                for uuid in value:
+                    self.index(self.by_uuid, uuid, path)
+            setattr(record, name, value)
+        return record
+
+    def index(self, index, key, path):
+        index.setdefault(key, set()).add(path)
+
+    def unindex(self, index, key, path):
+        paths = index.get(key)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del index[key]
+
+    def remove(self, path):
+        record = self.records.pop(path, None)
+        if record is None:
+            return
+        if record.address is not None and self.by_address.get(record.address) is record:
+            del self.by_address[record.address]
+        self.unindex(self.by_name, record.name, path)
+        for uuid in record.uuids:
+            self.unindex(self.by_uuid, uuid, path)
+
+    def pin(self, path):
+        self.pinned.add(path)
+
+    def unpin(self, path):
+        self.pinned.discard(path)
+
+    def evictable(self, record):
+        return record.path not in self.pinned and not record.connected
+
+    def evict_oldest(self):
+        for i in range(len(self.records)):
+            path = next(iter(self.records))
+            if self.evictable(self.records[path]):
+                self.remove(path)
+                self.evicted += 1
+                return
+            self.records.move_to_end(path)
+
+    # Drop records not updated for max_age seconds, returns how many
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        expired = 0
+        for i in range(len(self.records)):
+            path = next(iter(self.records))
+            record = self.records[path]
+            if now - record.last_seen < self.max_age:
+                break
+            if self.evictable(record):
+                self.remove(path)
+                expired += 1
+            else:
+                self.records.move_to_end(path)
+        self.evicted += expired
+        return expired
@@ -0,0 +1,732 @@
+#!/usr/bin/python3
+#
+# Per-device state of the Thunderboard client. Everything that used to be a module
+# global in thunderboard_EFR32BG22.py (device proxy, GATT object paths, found flags)
+# lives in a DeviceSession so that one process, one D-Bus connection, one MQTT
+# client and one GLib main loop can serve any number of boards.
+
+import dbus
+import functools
+import json
+import logging
+import random
+import struct
+import time
+import bluetooth_utils
+import bluetooth_constants
+import characteristic_decoders
+import event_payload
+import metrics
+import mqtt_constants
+import sys
+sys.path.insert(0, '.')
+
+from gatt_scheduler import GattQueue
+from gi.repository import GLib
+
+log = logging.getLogger("thunderboard")
+
+# Connection states of a session
+STATE_DISCONNECTED = "disconnected"
+STATE_SCANNING = "scanning"
+STATE_CONNECTING = "connecting"
+STATE_RESOLVING = "resolving"
+STATE_NOTIFYING = "notifying"
+
+# Reconnect delay doubles per failed attempt from RECONNECT_MIN_DELAY up to
+# RECONNECT_MAX_DELAY seconds, the actual delay is drawn from the upper half of
+# that range so a fleet of boards losing the link together spreads its retries
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+CONNECT_TIMEOUT = 20
+# seconds from the connection to ServicesResolved before the attempt is given up
+RESOLVE_TIMEOUT = 30
+
+# GATT attributes whose object paths are remembered in the GATT cache
+CACHED_UUIDS = (
+    bluetooth_constants.BUTTON_SVC_UUID,
+    bluetooth_constants.BUTTON_CHR_UUID,
+    bluetooth_constants.LED_CHR_UUID,
+    bluetooth_constants.SERVICE_CHANGED_CHR_UUID,
+) + characteristic_decoders.stream_uuids()
+
+# sensor characteristics whose notifications go to the SensorStreams
+STREAM_UUIDS = characteristic_decoders.stream_uuids()
+
+class DeviceSession(object):
+    """
+    Connection, service discovery and button notification handling of one device
+
+    The connection is a state machine driven by Connect replies and by
+    PropertiesChanged (Connected, ServicesResolved) of the Device1 object:
+
+      scanning -> connecting -> resolving -> notifying
+          ^                                      |
+          +------ disconnected (backoff) <-------+
+
+    Any failure and every link loss ends in disconnected, from where a timer
+    with exponential backoff and jitter starts the next attempt.
+    """
+
+    def __init__(self, bus, discovery, bdaddr, publisher, gatt_cache=None,
+                 topic_prefix=mqtt_constants.topic_prefix,
+                 payload_format=mqtt_constants.payload_format, gatt_state=None,
+                 aggregator=None, publish_events=True, event_log=None, sensor_streams=None,
+                 gatt_scheduler=None, polls=None):
+        self.bus = bus
+        self.discovery = discovery
+        self.publisher = publisher
+        self.gatt_cache = gatt_cache
+        # DeviceState characteristic of the gateway's GATT server, if enabled
+        self.gatt_state = gatt_state
+        # windowed statistics, with publish_events False instead of every edge
+        self.aggregator = aggregator
+        self.aggregate_index = None
+        self.publish_events = publish_events
+        # local EventLog of every button and LED state, if enabled
+        self.event_log = event_log
+        # SensorStreams buffering environmental and IMU notifications, None
+        # to leave the sensors alone
+        self.sensor_streams = sensor_streams
+        self.bdaddr = bdaddr.upper()
+        # GATT operations of the device, polled through the scheduler's tick
+        if gatt_scheduler is not None:
+            self.gatt = gatt_scheduler.add_device(self.bdaddr)
+        else:
+            self.gatt = GattQueue(bus, self.bdaddr)
+        # uuid -> seconds between reads, shared with the gateway so a reload
+        # reaches every session, and the paths of those the device has
+        self.polls = polls if polls is not None else {}
+        self.poll_paths = {}
+        self.device_path = bluetooth_utils.device_address_to_path(self.bdaddr,
+                                                                  discovery.adapter_path)
+        if aggregator is not None:
+            self.aggregate_index = aggregator.add_device(self.bdaddr)
+        self.payload_format = payload_format
+        self.topic_prefix = topic_prefix
+        self.button_topic = event_payload.device_topic(topic_prefix, self.bdaddr, "button")
+        self.status_topic = event_payload.device_topic(topic_prefix, self.bdaddr, "status")
+        self.led_topic = event_payload.device_topic(topic_prefix, self.bdaddr, "led")
+
+        # LED command state: the value last asked for over MQTT, the value the
+        # device has and whether a WriteValue is in flight
+        self.led_wanted = None
+        self.led_written = None
+        self.led_writing = False
+        self.led_command_time = None
+        self.led_write_time = None
+        self.device_proxy = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME,
+                                           self.device_path, introspect=False)
+        self.device_interface = dbus.Interface(self.device_proxy,
+                                               bluetooth_constants.DEVICE_INTERFACE)
+
+        self.found_bs = False
+        self.found_bc = False
+        self.found_lc = False
+        self.bs_path = None
+        self.bc_path = None
+        self.lc_path = None
+        self.lc_flags = []
+        # uuid -> path of the sensor characteristics, path -> signal match of
+        # those with notifications started
+        self.sensor_paths = {}
+        self.sensor_matches = {}
+
+        # paths of CACHED_UUIDS seen during service discovery, and the entry
+        # loaded from the GATT cache while it has not been proven stale
+        self.gatt_paths = {}
+        self.cached_paths = self.load_cached_paths()
+        if self.cached_paths:
+            self.apply_gatt_paths(self.cached_paths)
+
+        self.state = STATE_DISCONNECTED
+        self.device_match = None
+        self.sc_match = None
+        self.button_match = None
+        self.button_decoder = characteristic_decoders.get_decoder(
+            bluetooth_constants.BUTTON_CHR_UUID).decode
+        self.notify_path = None
+        self.connect_time = None
+        self.disconnect_time = None
+        self.reconnect_attempts = 0
+        self.reconnect_timer_id = None
+        self.resolve_timer_id = None
+        # ServicesResolved seen before the Connect reply
+        self.services_resolved = False
+
+    # Resolving is bounded by RESOLVE_TIMEOUT, the timer runs while in that state
+    def set_state(self, state):
+        if state != self.state:
+            log.info("%s: %s -> %s", self.bdaddr, self.state, state)
+            if state == STATE_RESOLVING:
+                self.resolve_timer_id = GLib.timeout_add_seconds(RESOLVE_TIMEOUT,
+                                                                 self.resolve_timeout)
+            elif self.state == STATE_RESOLVING:
+                self.cancel_resolve_timeout()
+            self.state = state
+
+    def resolve_timeout(self):
+        self.resolve_timer_id = None
+        if self.state == STATE_RESOLVING:
+            log.error("%s: Services not resolved after %d s", self.bdaddr, RESOLVE_TIMEOUT)
+            # the next attempt starts from the current Connected and
+            # ServicesResolved of the device
+            self.schedule_reconnect()
+        return False
+
+    def cancel_resolve_timeout(self):
+        if self.resolve_timer_id is not None:
+            GLib.source_remove(self.resolve_timer_id)
+            self.resolve_timer_id = None
+
+    def is_connected(self):
+        props_interface = dbus.Interface(self.device_proxy, bluetooth_constants.DBUS_PROPERTIES)
+        connected = props_interface.Get(bluetooth_constants.DEVICE_INTERFACE, "Connected")
+        return connected
+
+    # Watch the device for Connected and ServicesResolved and bring the link up.
+    # GATT objects of the device are fed in by the gateway through
+    # sd_interfaces_added, either from GetManagedObjects or as InterfacesAdded
+    # during service discovery.
+    def start(self):
+        self.device_match = self.bus.add_signal_receiver(self.device_properties_changed,
+                dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
+                signal_name = "PropertiesChanged",
+                path = self.device_path,
+                arg0 = bluetooth_constants.DEVICE_INTERFACE)
+        self.reconnect()
+
+    def stop(self):
+        self.cancel_reconnect()
+        self.cancel_resolve_timeout()
+        self.discovery.cancel(self.device_path)
+        if self.device_match is not None:
+            self.device_match.remove()
+            self.device_match = None
+        if self.sc_match is not None:
+            self.sc_match.remove()
+            self.sc_match = None
+        if self.button_match is not None:
+            self.button_match.remove()
+            self.button_match = None
+        self.remove_sensor_matches()
+        # StopNotify calls of stop_notifications() are still sent
+        self.gatt.reset(keep_stops=True)
+
+    # Next connection attempt: look the device up (scanning if BlueZ does not
+    # know it) and connect
+    def reconnect(self):
+        self.reconnect_timer_id = None
+        self.set_state(STATE_SCANNING)
+        self.discovery.find(self.device_path, self.device_found)
+        return False
+
+    def device_found(self, record):
+        if self.state != STATE_SCANNING:
+            return
+        if record is None:
+            log.error("%s: Device not found", self.bdaddr)
+            self.schedule_reconnect()
+            return
+        # the registry may be behind, Connected and ServicesResolved have to
+        # be current; asynchronous like Connect, the main loop is shared
+        props_interface = dbus.Interface(self.device_proxy, bluetooth_constants.DBUS_PROPERTIES)
+        props_interface.GetAll(bluetooth_constants.DEVICE_INTERFACE,
+                               reply_handler=self.device_properties_read,
+                               error_handler=self.device_properties_failed)
+
+    def device_properties_read(self, properties):
+        if self.state != STATE_SCANNING:
+            return
+        if properties.get('Connected', False) == False:
+            self.connect()
+            return
+        self.set_state(STATE_RESOLVING)
+        if properties.get('ServicesResolved', False) == True:
+            # still connected from an earlier run, the GATT tree is already known
+            log.info("%s: Services already resolved", self.bdaddr)
+            self.service_discovery_completed()
+
+    def device_properties_failed(self, e):
+        if self.state != STATE_SCANNING:
+            return
+        log.error("%s: Device not found, %s", self.bdaddr, e.get_dbus_message())
+        self.discovery.forget(self.device_path)
+        self.schedule_reconnect()
+
+    # Connect is issued asynchronously so that a slow or absent device does not
+    # stall the other sessions sharing the main loop
+    def connect(self):
+        self.set_state(STATE_CONNECTING)
+        self.connect_time = time.monotonic()
+        self.services_resolved = False
+        self.device_interface.Connect(reply_handler=self.connect_done,
+                                      error_handler=self.connect_failed,
+                                      timeout=CONNECT_TIMEOUT)
+        return bluetooth_constants.RESULT_OK
+
+    def connect_done(self):
+        if self.state != STATE_CONNECTING:
+            return
+        log.info("%s: Connected OK", self.bdaddr)
+        metrics.connect_seconds.observe(time.monotonic() - self.connect_time)
+        self.set_state(STATE_RESOLVING)
+        if self.cached_paths and self.notify_path is None:
+            # BlueZ exports the attributes from its own cache right after the
+            # connection, try the cached paths before services are resolved
+            log.info("%s: Using cached GATT paths", self.bdaddr)
+            self.start_notifications()
+        if self.services_resolved and self.state == STATE_RESOLVING:
+            # ServicesResolved came in before the reply
+            self.service_discovery_completed()
+
+    def connect_failed(self, e):
+        if self.state != STATE_CONNECTING:
+            return
+        log.error("%s: Failed to connect", self.bdaddr)
+        metrics.connect_failures.inc()
+        log.error(e.get_dbus_name())
+        log.error(e.get_dbus_message())
+        if ("UnknownObject" in e.get_dbus_name()):
+            # BlueZ dropped the device, the next attempt scans for it
+            self.discovery.forget(self.device_path)
+        self.schedule_reconnect()
+
+    def device_properties_changed(self, interface, changed, invalidated):
+        if 'Connected' in changed and changed['Connected'] == False:
+            self.link_lost()
+            return
+        if 'ServicesResolved' in changed:
+            sr = bluetooth_utils.dbus_to_python(changed['ServicesResolved'])
+            log.info("%s: ServicesResolved  : %s", self.bdaddr, sr)
+            if sr == True and self.state == STATE_RESOLVING:
+                self.service_discovery_completed()
+            elif self.state == STATE_CONNECTING:
+                self.services_resolved = sr == True
+
+    # The link went down. BlueZ removes the GATT objects with it, notifications
+    # have to be started again after the next connect.
+    def link_lost(self):
+        if self.state in (STATE_DISCONNECTED, STATE_SCANNING):
+            return
+        log.info("%s: Link lost", self.bdaddr)
+        metrics.link_losses.inc()
+        if self.button_match is not None:
+            self.button_match.remove()
+            self.button_match = None
+        if self.sc_match is not None:
+            self.sc_match.remove()
+            self.sc_match = None
+        self.remove_sensor_matches()
+        self.gatt.reset()
+        self.notify_path = None
+        self.gatt_paths = {}
+        self.poll_paths = {}
+        self.led_written = None
+        self.led_writing = False
+        self.cached_paths = self.load_cached_paths()
+        self.apply_gatt_paths(self.cached_paths or {})
+        if self.state == STATE_NOTIFYING:
+            self.disconnect_time = time.monotonic()
+            self.reconnect_attempts = 0
+            self.publish_status(event_payload.STATUS_OFFLINE)
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        self.set_state(STATE_DISCONNECTED)
+        self.cancel_reconnect()
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * (2 ** self.reconnect_attempts))
+        delay = random.uniform(delay / 2, delay)
+        self.reconnect_attempts += 1
+        metrics.reconnects.inc()
+        log.info("%s: Reconnecting in %.1f s (attempt %d)", self.bdaddr, delay,
+                 self.reconnect_attempts)
+        self.reconnect_timer_id = GLib.timeout_add(int(delay * 1000), self.reconnect)
+
+    def cancel_reconnect(self):
+        if self.reconnect_timer_id is not None:
+            GLib.source_remove(self.reconnect_timer_id)
+            self.reconnect_timer_id = None
+
+    # retained, so a subscriber learns the link state of every board at once
+    def publish_status(self, status):
+        self.publisher.publish(self.status_topic, status, qos=1, retain=True)
+        if self.gatt_state is not None:
+            self.gatt_state.set_online(status == event_payload.STATUS_ONLINE)
+
+    def notifying(self):
+        self.set_state(STATE_NOTIFYING)
+        self.publish_status(event_payload.STATUS_ONLINE)
+        # a command received while the link was down is applied now
+        self.write_led()
+        self.start_polls()
+        self.reconnect_attempts = 0
+        if self.disconnect_time is not None:
+            log.info("%s: Link recovered after %.1f s", self.bdaddr,
+                     time.monotonic() - self.disconnect_time)
+            self.disconnect_time = None
+
+    def sd_interfaces_added(self, path, interfaces):
+        if bluetooth_constants.GATT_SERVICE_INTERFACE in interfaces:
+            properties = interfaces[bluetooth_constants.GATT_SERVICE_INTERFACE]
+            log.debug("--------------------------------------------------------------------------------")
+            log.debug("SVC path   : %s", path)
+            if 'UUID' in properties:
+                uuid = properties['UUID']
+                if uuid == bluetooth_constants.BUTTON_SVC_UUID:
+                    self.found_bs = True
+                    self.bs_path = path
+                    self.gatt_paths[uuid] = str(path)
+                log.debug("SVC UUID   : %s", bluetooth_utils.dbus_to_python(uuid))
+                log.debug("SVC name   : %s", bluetooth_utils.get_name_from_uuid(uuid))
+            return
+        if bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE in interfaces:
+            properties = interfaces[bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE]
+            log.debug("  CHR path   : %s", path)
+            if 'UUID' in properties:
+                uuid = properties['UUID']
+                if uuid == bluetooth_constants.BUTTON_CHR_UUID:
+                    self.found_bc = True
+                    self.bc_path = path
+                elif uuid == bluetooth_constants.LED_CHR_UUID:
+                    self.found_lc = True
+                    self.lc_path = path
+                    self.lc_flags = [str(flag) for flag in properties['Flags']]
+                if uuid in self.polls and 'read' in properties['Flags']:
+                    self.poll_paths[uuid] = str(path)
+                if uuid in CACHED_UUIDS and (uuid not in STREAM_UUIDS or
+                                             'notify' in properties['Flags']):
+                    self.gatt_paths[uuid] = str(path)
+                log.debug("  CHR UUID   : %s", bluetooth_utils.dbus_to_python(uuid))
+                log.debug("  CHR name   : %s", bluetooth_utils.get_name_from_uuid(uuid))
+                log.debug("  CHR flags  : %s", ",".join(properties['Flags']))
+            return
+        if bluetooth_constants.GATT_DESCRIPTOR_INTERFACE in interfaces:
+            properties = interfaces[bluetooth_constants.GATT_DESCRIPTOR_INTERFACE]
+            log.debug("    DSC path   : %s", path)
+            if 'UUID' in properties:
+                uuid = properties['UUID']
+                log.debug("    DSC UUID   : %s", bluetooth_utils.dbus_to_python(uuid))
+                log.debug("    DSC name   : %s", bluetooth_utils.get_name_from_uuid(uuid))
+            return
+
+    # The paths follow the attribute handles, an entry written while the device
+    # was on another adapter only needs the device path swapped
+    def load_cached_paths(self):
+        if self.gatt_cache is None:
+            return None
+        paths = self.gatt_cache.get(self.bdaddr)
+        if not paths:
+            return paths
+        return dict((uuid, self.device_path +
+                     path[len(bluetooth_utils.object_path_to_device_path(path)):])
+                    for uuid, path in paths.items())
+
+    def apply_gatt_paths(self, paths):
+        self.bs_path = paths.get(bluetooth_constants.BUTTON_SVC_UUID)
+        self.bc_path = paths.get(bluetooth_constants.BUTTON_CHR_UUID)
+        self.lc_path = paths.get(bluetooth_constants.LED_CHR_UUID)
+        self.found_bs = self.bs_path is not None
+        self.found_bc = self.bc_path is not None
+        self.found_lc = self.lc_path is not None
+        self.sensor_paths = dict((uuid, paths[uuid]) for uuid in STREAM_UUIDS if uuid in paths)
+
+    # Store what service discovery found. A cache entry that does not match the
+    # discovered paths is replaced, and notifications started on a stale
+    # button path are moved to the right one.
+    def update_gatt_cache(self):
+        if not self.gatt_paths:
+            return
+        self.apply_gatt_paths(self.gatt_paths)
+        if self.gatt_cache is not None and self.gatt_cache.put(self.bdaddr, self.gatt_paths):
+            log.info("%s: GATT cache updated", self.bdaddr)
+        self.cached_paths = dict(self.gatt_paths)
+        if self.notify_path is not None and self.notify_path != self.bc_path:
+            log.info("%s: Cached button path was stale, restarting notifications", self.bdaddr)
+            self.stop_notifications()
+            self.start_notifications()
+
+    def invalidate_gatt_cache(self):
+        self.cached_paths = None
+        if not self.gatt_paths:
+            self.apply_gatt_paths({})
+        if self.gatt_cache is not None:
+            self.gatt_cache.invalidate(self.bdaddr)
+
+    # BlueZ reports an indication of the Service Changed characteristic as a new
+    # Value, the attribute handles of the device may have moved
+    def service_changed(self, interface, changed, invalidated):
+        if 'Value' in changed:
+            log.info("%s: Service Changed, invalidating GATT cache", self.bdaddr)
+            self.invalidate_gatt_cache()
+
+    def watch_service_changed(self):
+        sc_path = self.gatt_paths.get(bluetooth_constants.SERVICE_CHANGED_CHR_UUID)
+        if sc_path is None or self.sc_match is not None:
+            return
+        self.sc_match = self.bus.add_signal_receiver(self.service_changed,
+                dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
+                signal_name = "PropertiesChanged",
+                path = sc_path,
+                arg0 = bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+
+    def service_discovery_completed(self):
+        self.update_gatt_cache()
+        self.watch_service_changed()
+        if self.notify_path is None:
+            self.start_notifications()
+        else:
+            self.start_sensor_notifications()
+            self.start_polls()
+
+    # Button state notification callback, runs for every notification so it stays
+    # on the raw bytes and only formats a log line when debug output is enabled
+    def button_received(self, interface, changed, invalidated):
+        value = changed.get('Value')
+        if value is None:
+            return
+        state = self.button_decoder(value)
+        metrics.notifications.inc()
+        if self.connect_time is not None:
+            log.info("%s: First notification %.0f ms after connect", self.bdaddr,
+                     (time.monotonic() - self.connect_time) * 1000)
+            self.connect_time = None
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s: Button State: %d", self.bdaddr, state)
+        if self.aggregate_index is not None:
+            self.aggregator.button(self.aggregate_index, state, time.monotonic())
+        # retained so a new subscriber gets the last state right away
+        if self.publish_events:
+            self.publisher.publish(self.button_topic,
+                                   event_payload.encode_event(self.payload_format, time.time(), state),
+                                   retain=True, key=self.button_topic, state=state)
+        if self.gatt_state is not None:
+            self.gatt_state.set_button(state)
+        if self.event_log is not None:
+            self.event_log.append(time.time(), self.bdaddr, "button", state)
+
+    # Enable notification for button state characteristics. StartNotify goes
+    # through the GattQueue, notify_path is set while it is outstanding so a
+    # second call does not start it again.
+    def start_notifications(self):
+        if not self.found_bc:
+            log.error("%s: Button characteristic not found", self.bdaddr)
+            return bluetooth_constants.RESULT_ERR_NOT_FOUND
+
+        self.button_match = self.bus.add_signal_receiver(self.button_received,
+                dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
+                signal_name = "PropertiesChanged",
+                path = self.bc_path,
+                arg0 = bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                byte_arrays = True)
+        log.info("%s: Starting notifications", self.bdaddr)
+        self.notify_path = self.bc_path
+        self.gatt.start_notify(self.bc_path,
+                               functools.partial(self.button_notify_started, self.bc_path,
+                                                 time.monotonic()),
+                               functools.partial(self.button_notify_failed, self.bc_path))
+        return bluetooth_constants.RESULT_OK
+
+    def button_notify_started(self, path, started):
+        if path != self.notify_path:
+            # restarted on another path meanwhile
+            return
+        metrics.start_notify_seconds.observe(time.monotonic() - started)
+        log.info("%s: Done starting notifications", self.bdaddr)
+        self.start_sensor_notifications()
+        self.notifying()
+        if self.connect_time is not None:
+            log.info("%s: Notifications enabled %.0f ms after connect", self.bdaddr,
+                     (time.monotonic() - self.connect_time) * 1000)
+
+    def button_notify_failed(self, path, e):
+        if path != self.notify_path:
+            log.debug("%s: StartNotify of %s failed, %s", self.bdaddr, path, e.get_dbus_message())
+            return
+        self.notify_path = None
+        if self.button_match is not None:
+            self.button_match.remove()
+            self.button_match = None
+        if self.cached_paths and not self.gatt_paths:
+            # the cached path does not exist (yet), fall back to waiting
+            # for ServicesResolved
+            log.info("%s: Cached GATT paths not usable, waiting for service discovery",
+                     self.bdaddr)
+            self.invalidate_gatt_cache()
+            return
+        log.error("%s: Failed to start button notifications", self.bdaddr)
+        log.error(e.get_dbus_name())
+        log.error(e.get_dbus_message())
+        self.schedule_reconnect()
+
+    # Sensor notifications are buffered raw and decoded in batches by the
+    # SensorStreams. StartNotify is asynchronous, a board without a sensor
+    # must not delay the button.
+    def start_sensor_notifications(self):
+        if self.sensor_streams is None:
+            return
+        paths = set(self.sensor_paths.values())
+        for path in list(self.sensor_matches):
+            if path not in paths:
+                # stale cached path, the match is all that is left of it
+                self.sensor_matches.pop(path).remove()
+        for uuid, path in self.sensor_paths.items():
+            if path in self.sensor_matches:
+                continue
+            decoder = characteristic_decoders.get_decoder(uuid)
+            stream = self.sensor_streams.add_stream(self.bdaddr, decoder)
+            self.sensor_matches[path] = self.bus.add_signal_receiver(
+                    functools.partial(self.sensor_received, stream),
+                    dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
+                    signal_name = "PropertiesChanged",
+                    path = path,
+                    arg0 = bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE,
+                    byte_arrays = True)
+            self.gatt.start_notify(path, functools.partial(self.sensor_notify_started, decoder),
+                                   functools.partial(self.sensor_notify_failed, decoder, path))
+
+    def sensor_notify_started(self, decoder):
+        log.info("%s: Streaming %s", self.bdaddr, decoder.name)
+
+    def sensor_notify_failed(self, decoder, path, e):
+        log.error("%s: Failed to start %s notifications, %s", self.bdaddr, decoder.name,
+                  e.get_dbus_message())
+        match = self.sensor_matches.pop(path, None)
+        if match is not None:
+            match.remove()
+
+    def remove_sensor_matches(self):
+        for match in self.sensor_matches.values():
+            match.remove()
+        self.sensor_matches = {}
+
+    # Sensor notification callback, only buffers the raw value
+    def sensor_received(self, stream, interface, changed, invalidated):
+        value = changed.get('Value')
+        if value is not None:
+            stream.add(time.time(), value)
+
+    # Characteristics without notify are read every interval by the GattQueue
+    def start_polls(self):
+        if self.state != STATE_NOTIFYING:
+            return
+        for uuid, path in self.poll_paths.items():
+            self.gatt.poll(path, self.polls[uuid], functools.partial(self.poll_received, uuid))
+
+    # The poll intervals of the gateway changed: polls of characteristics
+    # found during service discovery follow at once, newly polled ones start
+    # after the next connect
+    def update_polls(self):
+        self.poll_paths = dict((uuid, path) for uuid, path in self.poll_paths.items()
+                               if uuid in self.polls)
+        self.gatt.cancel_polls()
+        self.start_polls()
+
+    # Values of stream characteristics join their SensorStream, others are
+    # published as {"ts":<ms>,"value":<decoded value or hex string>}
+    def poll_received(self, uuid, value):
+        decoder = characteristic_decoders.get_decoder(uuid)
+        if decoder is not None and decoder.stream and self.sensor_streams is not None:
+            self.sensor_streams.add_stream(self.bdaddr, decoder).add(time.time(), value)
+            return
+        name = uuid
+        try:
+            if decoder is not None:
+                name = decoder.name
+                value = decoder.decode(value)
+            else:
+                value = value.hex()
+        except struct.error:
+            log.debug("%s: Malformed %s value %r", self.bdaddr, name, value)
+            return
+        self.publisher.publish(event_payload.device_topic(self.topic_prefix, self.bdaddr, name),
+                               json.dumps({"ts": int(time.time() * 1000), "value": value},
+                                          separators=(",", ":")).encode())
+
+    def stop_notifications(self):
+        if self.button_match is not None:
+            self.button_match.remove()
+            self.button_match = None
+        for path in list(self.sensor_matches):
+            self.sensor_matches.pop(path).remove()
+            self.gatt.stop_notify(path, error_callback=self.stop_notify_failed)
+        if self.notify_path is None:
+            return
+        self.gatt.stop_notify(self.notify_path, error_callback=self.stop_notify_failed)
+        self.notify_path = None
+
+    def stop_notify_failed(self, e):
+        log.debug("%s: StopNotify failed, %s", self.bdaddr, e.get_dbus_message())
+
+    # LED command from MQTT, runs on the main loop. command_time is the
+    # time.monotonic() the command was received, for the round-trip report.
+    def set_led(self, value, command_time=None):
+        self.led_wanted = value
+        self.led_command_time = command_time
+        self.write_led()
+        return False
+
+    # Write the wanted LED state unless the device has it already. While a write
+    # is in flight newer commands only update led_wanted, the completion writes
+    # the latest one, so a burst of commands costs at most two writes.
+    def write_led(self):
+        if self.led_wanted is None or self.led_writing or self.state != STATE_NOTIFYING:
+            return
+        if self.led_wanted == self.led_written:
+            self.led_done()
+            return
+        if not self.found_lc:
+            log.error("%s: LED characteristic not found", self.bdaddr)
+            return
+        # write without response saves the ATT round trip where allowed
+        if "write-without-response" in self.lc_flags:
+            write_type = "command"
+        else:
+            write_type = "request"
+        value = self.led_wanted
+        self.led_writing = True
+        self.led_write_time = time.monotonic()
+        self.gatt.write(self.lc_path, [dbus.Byte(value)], write_type,
+                        lambda: self.led_write_done(value), self.led_write_failed)
+
+    def led_write_done(self, value):
+        self.led_writing = False
+        metrics.write_value_seconds.observe(time.monotonic() - self.led_write_time)
+        metrics.led_writes.inc()
+        self.led_written = value
+        if self.led_wanted != value:
+            self.write_led()
+            return
+        self.led_done()
+
+    def led_write_failed(self, e):
+        self.led_writing = False
+        log.error("%s: LED write failed, %s", self.bdaddr, e.get_dbus_message())
+
+    # report the state the device has, and how long the command took
+    def led_done(self):
+        if self.led_command_time is not None:
+            log.info("%s: LED %d, %.1f ms after the command", self.bdaddr, self.led_written,
+                     (time.monotonic() - self.led_command_time) * 1000)
+            self.led_command_time = None
+        if self.event_log is not None:
+            self.event_log.append(time.time(), self.bdaddr, "led", self.led_written)
+        self.publisher.publish(self.led_topic,
+                               event_payload.encode_event(self.payload_format, time.time(),
+                                                          self.led_written),
+                               qos=1, retain=True)
+
+    # disconnect from device
+    # this is needed when we are running this script again to connect
+    # to the same device
+    def disconnect(self):
+        try:
+            self.device_interface.Disconnect()
+        except Exception as e:
+            log.error("%s: Failed to disconnect", self.bdaddr)
+            log.error(e.get_dbus_name())
+            log.error(e.get_dbus_message())
+            return bluetooth_constants.RESULT_EXCEPTION
+        else:
+            log.info("%s: Disconnected OK", self.bdaddr)
+            return bluetooth_constants.RESULT_OK
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+#
+# Windowed statistics per device, published as one summary per window instead
+# of every button edge:
+#
+#   <prefix>/<device>/summary  {"ts":<ms>,"window":<s>,"presses":<n>,
+#                               "press_ms":{"avg":..,"max":..},
+#                               "interval_ms":{"avg":..,"min":..},
+#                               "rssi":{"avg":..,"min":..,"max":..}}
+#
+# A window of window seconds is split into buckets of interval seconds. Events
+# are accumulated into the current bucket, and every interval a summary over
+# all buckets of the window is published and the oldest bucket is reused, so
+# interval == window gives tumbling windows and a shorter interval sliding ones.
+#
+# The statistics are kept as one array per field over all devices (device
+# index * buckets + bucket), a device costs a fixed number of array slots and
+# nothing is allocated per event. The target image has no NumPy, the tick walks
+# the arrays once for all devices instead.
+
+import array
+import json
+import time
+import event_payload
+import sys
+sys.path.insert(0, '.')
+
+# fields of a bucket
+PRESSES = 0
+DURATION_COUNT = 1
+DURATION_SUM = 2
+DURATION_MAX = 3
+INTERVAL_COUNT = 4
+INTERVAL_SUM = 5
+INTERVAL_MIN = 6
+RSSI_COUNT = 7
+RSSI_SUM = 8
+RSSI_MIN = 9
+RSSI_MAX = 10
+FIELD_COUNT = 11
+
+class EventAggregator(object):
+    """
+    Sliding or tumbling window statistics of button presses and RSSI per device
+    """
+
+    def __init__(self, publisher, topic_prefix, window=60.0, interval=None, max_devices=1024,
+                 auto_add=False):
+        if interval is None or interval <= 0 or interval > window:
+            interval = window
+        self.publisher = publisher
+        self.topic_prefix = topic_prefix
+        self.window = window
+        self.interval = interval
+        self.buckets = max(1, int(round(window / interval)))
+        self.max_devices = max_devices
+        # add devices on their first RSSI report (passive mode)
+        self.auto_add = auto_add
+        self.bucket = 0
+
+        self.stats = [array.array('d') for i in range(FIELD_COUNT)]
+        self.topics = []
+        self.index_by_address = {}
+        # per device: button held, time.monotonic() of the last press
+        self.pressed = array.array('b')
+        self.press_time = array.array('d')
+
+    # index of a device, used for button(); None when max_devices are taken
+    def add_device(self, bdaddr):
+        bdaddr = bdaddr.upper()
+        index = self.index_by_address.get(bdaddr)
+        if index is not None:
+            return index
+        if len(self.topics) >= self.max_devices:
+            return None
+        index = len(self.topics)
+        self.index_by_address[bdaddr] = index
+        self.topics.append(event_payload.device_topic(self.topic_prefix, bdaddr, "summary"))
+        zeros = array.array('d', bytes(8 * self.buckets))
+        for values in self.stats:
+            values.extend(zeros)
+        self.pressed.append(0)
+        self.press_time.append(0.0)
+        return index
+
+    # A button state, a press is a 0 -> 1 edge and lasts until the 1 -> 0 edge
+    def button(self, index, state, now):
+        slot = index * self.buckets + self.bucket
+        stats = self.stats
+        if state and not self.pressed[index]:
+            self.pressed[index] = 1
+            stats[PRESSES][slot] += 1
+            last = self.press_time[index]
+            if last:
+                gap = now - last
+                count = stats[INTERVAL_COUNT][slot] + 1
+                stats[INTERVAL_COUNT][slot] = count
+                stats[INTERVAL_SUM][slot] += gap
+                if count == 1 or gap < stats[INTERVAL_MIN][slot]:
+                    stats[INTERVAL_MIN][slot] = gap
+            self.press_time[index] = now
+        elif not state and self.pressed[index]:
+            self.pressed[index] = 0
+            duration = now - self.press_time[index]
+            stats[DURATION_COUNT][slot] += 1
+            stats[DURATION_SUM][slot] += duration
+            if duration > stats[DURATION_MAX][slot]:
+                stats[DURATION_MAX][slot] = duration
+
+    # DeviceDiscovery RSSI callback
+    def rssi(self, record):
+        if record.address is None or record.rssi is None:
+            return
+        index = self.index_by_address.get(record.address)
+        if index is None:
+            if not self.auto_add:
+                return
+            index = self.add_device(record.address)
+            if index is None:
+                return
+        slot = index * self.buckets + self.bucket
+        stats = self.stats
+        rssi = record.rssi
+        count = stats[RSSI_COUNT][slot] + 1
+        stats[RSSI_COUNT][slot] = count
+        stats[RSSI_SUM][slot] += rssi
+        if count == 1 or rssi < stats[RSSI_MIN][slot]:
+            stats[RSSI_MIN][slot] = rssi
+        if count == 1 or rssi > stats[RSSI_MAX][slot]:
+            stats[RSSI_MAX][slot] = rssi
+
+    # GLib timer every interval seconds: publish the window of every device
+    # that had events in it, then start the next bucket
+    def tick(self):
+        timestamp = int(time.time() * 1000)
+        buckets = self.buckets
+        (presses, duration_count, duration_sum, duration_max, interval_count, interval_sum,
+         interval_min, rssi_count, rssi_sum, rssi_min, rssi_max) = self.stats
+        for index, topic in enumerate(self.topics):
+            base = index * buckets
+            slots = range(base, base + buckets)
+            press_total = sum(presses[slot] for slot in slots)
+            rssi_total = sum(rssi_count[slot] for slot in slots)
+            if not press_total and not rssi_total:
+                continue
+            summary = {"ts": timestamp, "window": self.window, "presses": int(press_total)}
+            count = sum(duration_count[slot] for slot in slots)
+            if count:
+                summary["press_ms"] = {
+                    "avg": round(sum(duration_sum[slot] for slot in slots) / count * 1000, 1),
+                    "max": round(max(duration_max[slot] for slot in slots) * 1000, 1)}
+            count = sum(interval_count[slot] for slot in slots)
+            if count:
+                summary["interval_ms"] = {
+                    "avg": round(sum(interval_sum[slot] for slot in slots) / count * 1000, 1),
+                    "min": round(min(interval_min[slot] for slot in slots
+                                     if interval_count[slot]) * 1000, 1)}
+            if rssi_total:
+                used = [slot for slot in slots if rssi_count[slot]]
+                summary["rssi"] = {
+                    "avg": round(sum(rssi_sum[slot] for slot in used) / rssi_total, 1),
+                    "min": int(min(rssi_min[slot] for slot in used)),
+                    "max": int(max(rssi_max[slot] for slot in used))}
+            self.publisher.publish(topic, json.dumps(summary, separators=(",", ":")).encode())
+
+        self.bucket = (self.bucket + 1) % buckets
+        for index in range(len(self.topics)):
+            slot = index * buckets + self.bucket
+            for values in self.stats:
+                values[slot] = 0
+        return True
@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+#
+# Local log of every decoded event, so events are kept even when nobody was
+# subscribed to the broker. One file per UTC day, events-YYYYMMDD.log:
+#
+#   header (12 KiB)
+#     magic "TBEV", version, record size, day start (ms since epoch),
+#     number of devices, number of minutes indexed,
+#     device table: up to 1024 bluetooth addresses (6 bytes each),
+#     minute index: for every minute of the day the number of records
+#     written before it
+#   records, 12 bytes each
+#     uint32 ms since the day start, uint16 device, uint8 characteristic,
+#     pad, int32 value
+#
+# Records are appended in time order (a clock stepping back is clamped to the
+# last record), so a query reads the minute index to find the first and last
+# record of its time range and only walks the records in between, through an
+# mmap of the file. 50 boards sending one event per second for a week take
+# about 360 MB.
+#
+# Appends are collected in memory and written every flush_interval seconds or
+# write_batch bytes to keep SD card writes few and large.
+#
+#   python3 event_log.py [-d dir] [--device addr] [--characteristic button]
+#                        [--from 2026-10-18T08:00] [--to 2026-10-18T09:00] [--count]
+
+import argparse
+import calendar
+import mmap
+import os
+import struct
+import time
+import sys
+sys.path.insert(0, '.')
+
+MAGIC = b"TBEV"
+VERSION = 1
+HEADER = struct.Struct("<4sHHQHH8x")
+RECORD = struct.Struct("<IHBxi")
+MAX_DEVICES = 1024
+ADDRESS_SIZE = 6
+MINUTES = 24 * 60
+DEVICES_OFFSET = HEADER.size
+INDEX_OFFSET = DEVICES_OFFSET + MAX_DEVICES * ADDRESS_SIZE
+INDEX_ENTRY = struct.Struct("<I")
+HEADER_SIZE = 12288
+DAY_MS = 24 * 60 * 60 * 1000
+MINUTE_MS = 60 * 1000
+
+CHARACTERISTICS = ("button", "led")
+CHARACTERISTIC_IDS = dict((name, index) for index, name in enumerate(CHARACTERISTICS))
+
+FILE_FORMAT = "events-%s.log"
+
+def address_to_bytes(bdaddr):
+    return bytes.fromhex(bdaddr.replace(":", ""))
+
+def bytes_to_address(data):
+    return ":".join("%02X" % b for b in data)
+
+def day_file(directory, day_ms):
+    return os.path.join(directory, FILE_FORMAT % time.strftime("%Y%m%d", time.gmtime(day_ms / 1000)))
+
+class EventLog(object):
+    """
+    Appends events to the file of the current day
+    """
+
+    def __init__(self, directory, keep_days=14, write_batch=4096, flush_interval=1.0):
+        self.directory = directory
+        self.keep_days = keep_days
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self.fd = None
+        self.day_ms = None
+        self.pending = bytearray()
+        self.pending_since = 0
+        self.written = 0
+
+    def open_day(self, day_ms):
+        self.close()
+        self.day_ms = day_ms
+        filename = day_file(self.directory, day_ms)
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size < HEADER_SIZE:
+            header = bytearray(HEADER_SIZE)
+            HEADER.pack_into(header, 0, MAGIC, VERSION, RECORD.size, day_ms, 0, 0)
+            os.pwrite(self.fd, header, 0)
+            size = HEADER_SIZE
+        header = os.pread(self.fd, HEADER_SIZE, 0)
+        magic, version, record_size, base, device_count, index_count = HEADER.unpack_from(header)
+        self.devices = {}
+        for device in range(device_count):
+            offset = DEVICES_OFFSET + device * ADDRESS_SIZE
+            self.devices[bytes_to_address(header[offset:offset + ADDRESS_SIZE])] = device
+        self.index_count = index_count
+        # a partial record at the end from a power cut is overwritten
+        self.records = (size - HEADER_SIZE) // RECORD.size
+        self.write_offset = HEADER_SIZE + self.records * RECORD.size
+        self.last_offset = 0
+        if self.records:
+            self.last_offset = RECORD.unpack(os.pread(self.fd, RECORD.size,
+                                                      self.write_offset - RECORD.size))[0]
+        self.remove_old_files()
+
+    def remove_old_files(self):
+        oldest = FILE_FORMAT % time.strftime("%Y%m%d", time.gmtime(
+            self.day_ms / 1000 - self.keep_days * 24 * 60 * 60))
+        for name in os.listdir(self.directory):
+            if name.startswith("events-") and name.endswith(".log") and name < oldest:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def device_id(self, bdaddr):
+        device = self.devices.get(bdaddr)
+        if device is None:
+            if len(self.devices) >= MAX_DEVICES:
+                return None
+            device = len(self.devices)
+            self.devices[bdaddr] = device
+            os.pwrite(self.fd, address_to_bytes(bdaddr), DEVICES_OFFSET + device * ADDRESS_SIZE)
+            os.pwrite(self.fd, struct.pack("<H", len(self.devices)), 16)
+        return device
+
+    # timestamp is time.time(), characteristic one of CHARACTERISTICS
+    def append(self, timestamp, bdaddr, characteristic, value):
+        ms = int(timestamp * 1000)
+        if self.fd is None or ms >= self.day_ms + DAY_MS or ms < self.day_ms - MINUTE_MS:
+            self.flush()
+            self.open_day(ms - ms % DAY_MS)
+        device = self.device_id(bdaddr)
+        if device is None:
+            return
+        offset = max(ms - self.day_ms, self.last_offset)
+        self.last_offset = offset
+        # records before this one for every minute not indexed yet
+        minute = min(offset // MINUTE_MS, MINUTES - 1)
+        if minute >= self.index_count:
+            records = self.records + len(self.pending) // RECORD.size
+            entries = INDEX_ENTRY.pack(records) * (minute + 1 - self.index_count)
+            os.pwrite(self.fd, entries, INDEX_OFFSET + self.index_count * INDEX_ENTRY.size)
+            self.index_count = minute + 1
+            os.pwrite(self.fd, struct.pack("<H", self.index_count), 18)
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending += RECORD.pack(offset, device, CHARACTERISTIC_IDS[characteristic], value)
+        if len(self.pending) >= self.write_batch:
+            self.flush()
+
+    # write what is pending, without force only once it is flush_interval old;
+    # usable as a GLib timer callback
+    def flush(self, force=True):
+        if self.pending and (force or time.monotonic() - self.pending_since >= self.flush_interval):
+            os.pwrite(self.fd, self.pending, self.write_offset)
+            self.write_offset += len(self.pending)
+            self.records += len(self.pending) // RECORD.size
+            self.written += len(self.pending) // RECORD.size
+            self.pending = bytearray()
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+
+class EventLogReader(object):
+    """
+    Read access to one day file through mmap
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.day_ms, device_count, self.index_count = \
+            HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self.map.close()
+            raise ValueError(filename + " is not an event log")
+        self.devices = []
+        for device in range(device_count):
+            offset = DEVICES_OFFSET + device * ADDRESS_SIZE
+            self.devices.append(bytes_to_address(self.map[offset:offset + ADDRESS_SIZE]))
+        self.records = (len(self.map) - HEADER_SIZE) // RECORD.size
+
+    def close(self):
+        self.map.close()
+
+    # first record at or after minute, from the minute index
+    def minute_start(self, minute):
+        if minute <= 0:
+            return 0
+        if minute >= self.index_count:
+            return self.records
+        return min(INDEX_ENTRY.unpack_from(self.map, INDEX_OFFSET + minute * INDEX_ENTRY.size)[0],
+                   self.records)
+
+    # (ms since epoch, address, characteristic, value) of the records in
+    # [start_ms, end_ms), optionally of one device and characteristic
+    def query(self, start_ms=None, end_ms=None, bdaddr=None, characteristic=None):
+        start = 0 if start_ms is None else max(0, start_ms - self.day_ms)
+        end = DAY_MS if end_ms is None else min(DAY_MS, end_ms - self.day_ms)
+        if end <= start:
+            return
+        device = None
+        if bdaddr is not None:
+            if bdaddr not in self.devices:
+                return
+            device = self.devices.index(bdaddr)
+        char_id = None if characteristic is None else CHARACTERISTIC_IDS[characteristic]
+
+        first = self.minute_start(start // MINUTE_MS)
+        last = self.minute_start(end // MINUTE_MS + 1)
+        view = memoryview(self.map)[HEADER_SIZE + first * RECORD.size:
+                                    HEADER_SIZE + last * RECORD.size]
+        try:
+            for offset, record_device, record_char, value in RECORD.iter_unpack(view):
+                if offset < start:
+                    continue
+                if offset >= end:
+                    break
+                if device is not None and record_device != device:
+                    continue
+                if char_id is not None and record_char != char_id:
+                    continue
+                yield (self.day_ms + offset, self.devices[record_device],
+                       CHARACTERISTICS[record_char], value)
+        finally:
+            view.release()
+
+# YYYY-MM-DDTHH:MM[:SS] in UTC or seconds since epoch, to ms since epoch
+def parse_time(text):
+    try:
+        return int(float(text) * 1000)
+    except ValueError:
+        pass
+    for time_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(text, time_format)) * 1000
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("bad time " + text)
+
+def format_time(ms):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ms // 1000)) + ".%03dZ" % (ms % 1000)
+
+if __name__ == "__main__":
+    import mqtt_constants
+
+    parser = argparse.ArgumentParser(description="Query the gateway event log")
+    parser.add_argument("-d", "--directory", default=mqtt_constants.event_log_dir,
+                        help="event log directory")
+    parser.add_argument("--device", help="bluetooth address of the device")
+    parser.add_argument("--characteristic", choices=CHARACTERISTICS)
+    parser.add_argument("--from", dest="start", type=parse_time,
+                        help="UTC time (YYYY-MM-DDTHH:MM[:SS]) or seconds since epoch")
+    parser.add_argument("--to", dest="end", type=parse_time, help="end of the range, exclusive")
+    parser.add_argument("--count", action="store_true", help="only print the number of events")
+    args = parser.parse_args()
+
+    bdaddr = args.device.upper() if args.device else None
+    names = sorted(name for name in os.listdir(args.directory)
+                   if name.startswith("events-") and name.endswith(".log"))
+    count = 0
+    for name in names:
+        reader = EventLogReader(os.path.join(args.directory, name))
+        try:
+            # skip days outside the range without reading them
+            if args.start is not None and reader.day_ms + DAY_MS <= args.start:
+                continue
+            if args.end is not None and reader.day_ms >= args.end:
+                continue
+            for ms, address, characteristic, value in reader.query(args.start, args.end,
+                                                                   bdaddr, args.characteristic):
+                count += 1
+                if not args.count:
+                    print("%s %s %s %d" % (format_time(ms), address, characteristic, value))
+        finally:
+            reader.close()
+    if args.count:
+        print(count)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+#
+# MQTT topic and payload schema of the gateway.
+#
+# Topics are derived per device and characteristic:
+#   <prefix>/<device>/<characteristic>   events, e.g. thunderboard/000b57a1b2c3/button
+#   <prefix>/<device>/status             "online"/"offline", retained
+#   <prefix>/<device>/led/set            commands, "0"/"1", "on"/"off" or {"value":<int>}
+#   <prefix>/<device>/led                LED state acknowledged by the device, retained
+#   <prefix>/gateway/status              "online"/"offline", retained (last will)
+# where <device> is the bluetooth address in lower case hex without colons, so
+# consumers can subscribe to one device or to thunderboard/+/button.
+#
+# Event payload formats:
+#   json    {"ts":<ms since epoch>,"value":<int>}
+#   struct  big endian uint64 ms since epoch + int32 value (12 bytes)
+#   text    the bare value, the format of the original client/btn_status topic
+
+import json
+import struct
+import sys
+sys.path.insert(0, '.')
+
+PAYLOAD_FORMATS = ("json", "struct", "text")
+
+EVENT_STRUCT = struct.Struct("!Qi")
+
+STATUS_ONLINE = b"online"
+STATUS_OFFLINE = b"offline"
+
+def device_id(bdaddr):
+    return bdaddr.replace(":", "").lower()
+
+def device_topic(prefix, bdaddr, name):
+    return prefix + "/" + device_id(bdaddr) + "/" + name
+
+def gateway_topic(prefix, name):
+    return prefix + "/gateway/" + name
+
+# timestamp is time.time() of the notification
+def encode_event(payload_format, timestamp, value):
+    if payload_format == "json":
+        return b'{"ts":%d,"value":%d}' % (int(timestamp * 1000), value)
+    if payload_format == "struct":
+        return EVENT_STRUCT.pack(int(timestamp * 1000), value)
+    return b"%d" % value
+
+# LED command payload to the byte to write, None if it is not understood
+def decode_command(payload):
+    text = payload.strip().lower()
+    if text in (b"on", b"true"):
+        return 1
+    if text in (b"off", b"false"):
+        return 0
+    try:
+        if text.startswith(b"{"):
+            value = int(json.loads(text)["value"])
+        else:
+            value = int(text)
+    except (ValueError, KeyError, TypeError):
+        return None
+    if value < 0 or value > 255:
+        return None
+    return value
+
+# returns (ms since epoch, value), ms is None for the text format
+def decode_event(payload_format, payload):
+    if payload_format == "json":
+        event = json.loads(payload)
+        return event["ts"], event["value"]
+    if payload_format == "struct":
+        return EVENT_STRUCT.unpack(payload)
+    return None, int(payload)
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+#
+# Fixed size event records in shared memory between the processes of the
+# sharded gateway (sharded_gateway.py). A ring has one producer and one
+# consumer and each index is written by one side only, so neither takes a lock:
+#
+#   offset   0  uint64 write index, written by the producer
+#   offset  64  uint64 read index, written by the consumer
+#   offset 128  uint64 records dropped on a full ring, producer
+#   offset 136  uint64 capacity in records
+#   offset 192  capacity records of RECORD
+#
+# The indices count records since creation, index i lives in slot
+# i % capacity. A record is a sequence number (index + 1, low 32 bits), the
+# time.time() of the event, the 6 byte bluetooth address, the kind, a reserved
+# byte and the value:
+#
+#   <I d 6s B B i>  24 bytes
+#
+# The producer writes the record body, then its sequence number, then the new
+# write index. Python has no memory barriers, so the consumer also checks the
+# sequence number of what it read and stops at a slot that is not complete
+# yet; it is read again on the next poll.
+#
+# A consumer does not have to poll an idle ring: given the write end of a
+# non-blocking pipe, the producer writes a byte to it when it puts a record
+# into an empty ring. The consumer waits for the read end, empties it with
+# clear_wakeup() and then drains the ring until get() comes back empty.
+#
+# Workers feed button, LED and status events into their ring, the publisher
+# process sends LED commands back through a second ring per worker.
+
+import os
+import struct
+import time
+import event_payload
+import sys
+sys.path.insert(0, '.')
+
+from multiprocessing import resource_tracker, shared_memory
+
+INDEX = struct.Struct("<Q")
+WRITE_OFFSET = 0
+READ_OFFSET = 64
+DROPPED_OFFSET = 128
+CAPACITY_OFFSET = 136
+DATA_OFFSET = 192
+
+RECORD = struct.Struct("<Id6sBBi")
+SEQUENCE = struct.Struct("<I")
+BODY = struct.Struct("<d6sBBi")
+
+KIND_BUTTON = 0
+KIND_LED = 1
+KIND_STATUS = 2
+KIND_COMMAND = 3
+
+# last topic level -> kind, for RingPublisher
+TOPIC_KINDS = {
+    "button": KIND_BUTTON,
+    "led": KIND_LED,
+    "status": KIND_STATUS,
+}
+
+# Non-blocking pipe (read fd, write fd) for the wakeup of a ring
+def wakeup_pipe():
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    os.set_blocking(write_fd, False)
+    return read_fd, write_fd
+
+# Consumer side, empty the wakeup pipe before draining the ring
+def clear_wakeup(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+class EventRing(object):
+    """
+    Single producer, single consumer ring of event records in shared memory
+    """
+
+    def __init__(self, name, capacity=None, wakeup_fd=None):
+        if capacity is not None:
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                                                  size=DATA_OFFSET + capacity * RECORD.size)
+            self.shm.buf[:DATA_OFFSET] = bytes(DATA_OFFSET)
+            INDEX.pack_into(self.shm.buf, CAPACITY_OFFSET, capacity)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+            # only the creator unlinks, the tracker of an attaching process
+            # would remove the segment when that process exits
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+            self.owner = False
+        self.name = name
+        self.wakeup_fd = wakeup_fd
+        self.buf = self.shm.buf
+        self.capacity = INDEX.unpack_from(self.buf, CAPACITY_OFFSET)[0]
+        # each side caches the index it owns
+        self.write_index = INDEX.unpack_from(self.buf, WRITE_OFFSET)[0]
+        self.read_index = INDEX.unpack_from(self.buf, READ_OFFSET)[0]
+        self.dropped = INDEX.unpack_from(self.buf, DROPPED_OFFSET)[0]
+
+    # Producer side, False if the ring is full and the event was dropped
+    def put(self, timestamp, address, kind, value):
+        index = self.write_index
+        if index - INDEX.unpack_from(self.buf, READ_OFFSET)[0] >= self.capacity:
+            self.dropped += 1
+            INDEX.pack_into(self.buf, DROPPED_OFFSET, self.dropped)
+            return False
+        offset = DATA_OFFSET + (index % self.capacity) * RECORD.size
+        BODY.pack_into(self.buf, offset + SEQUENCE.size, timestamp, address, kind, 0, value)
+        SEQUENCE.pack_into(self.buf, offset, (index + 1) & 0xffffffff)
+        self.write_index = index + 1
+        INDEX.pack_into(self.buf, WRITE_OFFSET, self.write_index)
+        if self.wakeup_fd is not None and INDEX.unpack_from(self.buf, READ_OFFSET)[0] == index:
+            # the ring was empty, the consumer may be waiting
+            try:
+                os.write(self.wakeup_fd, b"\0")
+            except BlockingIOError:
+                # a full pipe wakes it anyway
+                pass
+        return True
+
+    # Consumer side, up to max_records (sequence, timestamp, address, kind,
+    # reserved, value) tuples
+    def get(self, max_records=1024):
+        start = self.read_index
+        count = min(INDEX.unpack_from(self.buf, WRITE_OFFSET)[0] - start, max_records)
+        if count <= 0:
+            return []
+        slot = start % self.capacity
+        first = min(count, self.capacity - slot)
+        offset = DATA_OFFSET + slot * RECORD.size
+        records = list(RECORD.iter_unpack(self.buf[offset:offset + first * RECORD.size]))
+        if first < count:
+            records += RECORD.iter_unpack(
+                self.buf[DATA_OFFSET:DATA_OFFSET + (count - first) * RECORD.size])
+        if records[-1][0] != (start + count) & 0xffffffff:
+            # a slot is not complete yet, keep what is
+            for index, record in enumerate(records):
+                if record[0] != (start + index + 1) & 0xffffffff:
+                    del records[index:]
+                    break
+            count = len(records)
+        self.read_index = start + count
+        INDEX.pack_into(self.buf, READ_OFFSET, self.read_index)
+        return records
+
+    def pending(self):
+        return INDEX.unpack_from(self.buf, WRITE_OFFSET)[0] - self.read_index
+
+    def producer_dropped(self):
+        return INDEX.unpack_from(self.buf, DROPPED_OFFSET)[0]
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingPublisher(object):
+    """
+    Stand-in for MqttPublisher in a worker of the sharded gateway: button, LED
+    and status messages of the sessions go into the event ring as decoded
+    events, anything else (statistics, sensor batches) is not forwarded
+    """
+
+    def __init__(self, ring, payload_format):
+        self.ring = ring
+        self.payload_format = payload_format
+        # topic -> (address, kind), None for topics without a kind
+        self.topics = {}
+        self.queued = 0
+        self.unsupported = 0
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=5.0):
+        self.ring.close()
+
+    def set_connected(self, connected):
+        pass
+
+    def queue_depth(self):
+        return 0
+
+    def target(self, topic):
+        parts = topic.split("/")
+        kind = TOPIC_KINDS.get(parts[-1])
+        if kind is None or len(parts) < 3 or len(parts[-2]) != 12:
+            return None
+        try:
+            return bytes.fromhex(parts[-2]), kind
+        except ValueError:
+            return None
+
+    def publish(self, topic, payload=None, qos=0, retain=False, key=None, state=None):
+        target = self.topics.get(topic, False)
+        if target is False:
+            target = self.topics[topic] = self.target(topic)
+        if target is None:
+            self.unsupported += 1
+            return
+        address, kind = target
+        if state is not None:
+            value = state
+        elif kind == KIND_STATUS:
+            value = 1 if payload == event_payload.STATUS_ONLINE else 0
+        else:
+            value = event_payload.decode_event(self.payload_format, payload)[1]
+        if self.ring.put(time.time(), address, kind, value):
+            self.queued += 1
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#
+# Persistent map of GATT attribute UUIDs to BlueZ object paths per device, so a
+# reconnect can enable notifications on the known paths right after Connect
+# instead of waiting for ServicesResolved and walking every InterfacesAdded.
+#
+# The cache is a small JSON file { bdaddr: { uuid: path } }. It is rewritten only
+# when an entry changes, i.e. after the first discovery of a device, when the
+# discovered paths no longer match or when the device indicated Service Changed.
+
+import json
+import logging
+import os
+import sys
+sys.path.insert(0, '.')
+
+log = logging.getLogger("thunderboard")
+
+class GattCache(object):
+    """
+    UUID to object path map of the GATT attributes of each device
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    # write to a temporary file and rename so a power cut never leaves a
+    # truncated cache behind
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        tmp_filename = self.filename + ".tmp"
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_filename, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+        except OSError as e:
+            log.error("Failed to save GATT cache %s: %s", self.filename, e)
+
+    def get(self, bdaddr):
+        return self.entries.get(bdaddr)
+
+    # returns True if the stored entry changed
+    def put(self, bdaddr, paths):
+        paths = dict(paths)
+        if self.entries.get(bdaddr) == paths:
+            return False
+        self.entries[bdaddr] = paths
+        self.save()
+        return True
+
+    def invalidate(self, bdaddr):
+        if bdaddr in self.entries:
+            del self.entries[bdaddr]
+            self.save()
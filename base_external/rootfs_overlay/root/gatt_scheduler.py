@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+#
+# GATT operations of the sessions. Every device has a GattQueue of reads,
+# writes and notification subscriptions, issued as asynchronous D-Bus calls
+# (reply_handler/error_handler) with at most max_outstanding of them in flight
+# per link, the rest wait ordered by deadline:
+#
+#   - writes and subscriptions are due at once,
+#   - a poll read is due by the time the next read of the same characteristic
+#     would be queued, so it goes behind everything more urgent.
+#
+# Characteristics without notify (device information, battery, sensors) are
+# polled: the GattScheduler ticks every 50 ms over the polls of all queues and
+# queues a read for every poll that is due. Polls start at a random phase and
+# every period is jittered by POLL_JITTER, so devices with the same interval do
+# not read in lock step. A poll whose last read has not completed yet when it
+# is due again is counted as missed instead of queueing a second read.
+#
+# Time in queue and per operation are histograms in metrics.py, the scheduler
+# keeps the achieved poll rate.
+
+import dbus
+import functools
+import heapq
+import itertools
+import logging
+import random
+import time
+import bluetooth_constants
+import metrics
+import sys
+sys.path.insert(0, '.')
+
+log = logging.getLogger("thunderboard")
+
+OP_READ = "read"
+OP_WRITE = "write"
+OP_START_NOTIFY = "start-notify"
+OP_STOP_NOTIFY = "stop-notify"
+
+# seconds of a D-Bus call before BlueZ is given up on
+GATT_TIMEOUT = 10
+# fraction of the interval a poll period varies by
+POLL_JITTER = 0.05
+# seconds between poll ticks, and over which the poll rate is measured
+POLL_TICK = 0.05
+RATE_INTERVAL = 5.0
+
+class GattOperation(object):
+    """
+    One queued read, write or notification subscription
+    """
+
+    def __init__(self, kind, path, deadline, callback=None, error_callback=None,
+                 value=None, options=None):
+        self.kind = kind
+        self.path = path
+        self.deadline = deadline
+        self.callback = callback
+        self.error_callback = error_callback
+        self.value = value
+        self.options = options
+        self.queued = None
+        self.issued = None
+
+
+class Poll(object):
+    """
+    Periodic read of one characteristic
+    """
+
+    def __init__(self, path, interval, callback, now):
+        self.path = path
+        self.interval = interval
+        self.callback = callback
+        self.next_due = now + random.uniform(0, interval)
+        self.pending = False
+
+
+class GattQueue(object):
+    """
+    Pending and outstanding GATT operations of one device
+    """
+
+    def __init__(self, bus, bdaddr, max_outstanding=1, timeout=GATT_TIMEOUT):
+        self.bus = bus
+        self.bdaddr = bdaddr
+        self.max_outstanding = max_outstanding
+        self.timeout = timeout
+        # heap of (deadline, sequence, GattOperation)
+        self.pending = []
+        self.sequence = itertools.count()
+        self.outstanding = 0
+        # replies to calls issued before the last reset() are ignored
+        self.generation = 0
+        self.interfaces = {}
+        # path -> Poll
+        self.polls = {}
+
+    def interface(self, path):
+        interface = self.interfaces.get(path)
+        if interface is None:
+            proxy = self.bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, path,
+                                        introspect=False)
+            interface = dbus.Interface(proxy, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+            self.interfaces[path] = interface
+        return interface
+
+    def submit(self, operation):
+        operation.queued = time.monotonic()
+        if operation.deadline is None:
+            operation.deadline = operation.queued
+        heapq.heappush(self.pending, (operation.deadline, next(self.sequence), operation))
+        self.pump()
+        return operation
+
+    # callback(value) with the value as bytes
+    def read(self, path, callback, error_callback=None, deadline=None):
+        return self.submit(GattOperation(OP_READ, path, deadline, callback, error_callback))
+
+    def write(self, path, value, write_type="request", callback=None, error_callback=None):
+        return self.submit(GattOperation(OP_WRITE, path, None, callback, error_callback,
+                                         value=value, options={"type": write_type}))
+
+    def start_notify(self, path, callback=None, error_callback=None):
+        return self.submit(GattOperation(OP_START_NOTIFY, path, None, callback, error_callback))
+
+    def stop_notify(self, path, callback=None, error_callback=None):
+        return self.submit(GattOperation(OP_STOP_NOTIFY, path, None, callback, error_callback))
+
+    def pump(self):
+        while self.pending and self.outstanding < self.max_outstanding:
+            deadline, sequence, operation = heapq.heappop(self.pending)
+            self.issue(operation)
+
+    def issue(self, operation):
+        operation.issued = time.monotonic()
+        metrics.gatt_queue_seconds.observe(operation.issued - operation.queued)
+        self.outstanding += 1
+        reply = functools.partial(self.done, self.generation, operation)
+        error = functools.partial(self.failed, self.generation, operation)
+        interface = self.interface(operation.path)
+        if operation.kind == OP_READ:
+            interface.ReadValue(dbus.Dictionary({}, signature='sv'), byte_arrays=True,
+                                reply_handler=reply, error_handler=error, timeout=self.timeout)
+        elif operation.kind == OP_WRITE:
+            interface.WriteValue(dbus.Array(operation.value, signature='y'),
+                                 dbus.Dictionary(operation.options, signature='sv'),
+                                 reply_handler=reply, error_handler=error, timeout=self.timeout)
+        elif operation.kind == OP_START_NOTIFY:
+            interface.StartNotify(reply_handler=reply, error_handler=error, timeout=self.timeout)
+        else:
+            interface.StopNotify(reply_handler=reply, error_handler=error, timeout=self.timeout)
+
+    def done(self, generation, operation, *result):
+        if generation != self.generation:
+            return
+        self.outstanding -= 1
+        metrics.gatt_operation_seconds.observe(time.monotonic() - operation.issued)
+        if operation.callback is not None:
+            if operation.kind == OP_READ:
+                operation.callback(bytes(result[0]))
+            else:
+                operation.callback()
+        self.pump()
+
+    def failed(self, generation, operation, e):
+        if generation != self.generation:
+            return
+        self.outstanding -= 1
+        metrics.gatt_failures.inc()
+        if operation.error_callback is not None:
+            operation.error_callback(e)
+        else:
+            log.error("%s: GATT %s of %s failed, %s", self.bdaddr, operation.kind,
+                      operation.path, e.get_dbus_message())
+        self.pump()
+
+    # Read path every interval seconds while the link is up, callback(value)
+    def poll(self, path, interval, callback):
+        if path not in self.polls:
+            self.polls[path] = Poll(path, interval, callback, time.monotonic())
+
+    def poll_due(self, now):
+        for poll in self.polls.values():
+            if now < poll.next_due:
+                continue
+            deadline = poll.next_due + poll.interval
+            poll.next_due += poll.interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            if poll.next_due < now:
+                # fell behind, e.g. after a long D-Bus call, skip the lost periods
+                poll.next_due = now + poll.interval
+            if poll.pending:
+                metrics.gatt_poll_misses.inc()
+                continue
+            poll.pending = True
+            self.read(poll.path, functools.partial(self.poll_done, poll),
+                      functools.partial(self.poll_failed, poll), deadline)
+
+    def poll_done(self, poll, value):
+        poll.pending = False
+        metrics.gatt_polls.inc()
+        poll.callback(value)
+
+    def poll_failed(self, poll, e):
+        poll.pending = False
+        log.debug("%s: Poll of %s failed, %s", self.bdaddr, poll.path, e.get_dbus_message())
+
+    def cancel_polls(self):
+        self.polls = {}
+
+    # The link went down, BlueZ fails whatever was in flight and the object
+    # paths may change: drop everything. A session being closed passes
+    # keep_stops, the StopNotify calls it queued still go out.
+    def reset(self, keep_stops=False):
+        self.generation += 1
+        self.pending = [entry for entry in self.pending
+                        if keep_stops and entry[2].kind == OP_STOP_NOTIFY]
+        heapq.heapify(self.pending)
+        self.outstanding = 0
+        self.interfaces = {}
+        self.polls = {}
+        self.pump()
+
+
+class GattScheduler(object):
+    """
+    GattQueue of every device and the tick polling them
+    """
+
+    def __init__(self, bus, max_outstanding=1):
+        self.bus = bus
+        self.max_outstanding = max_outstanding
+        self.queues = {}
+        self.poll_rate = 0.0
+        self.rate_start = time.monotonic()
+        self.rate_polls = metrics.gatt_polls.value
+
+    def add_device(self, bdaddr):
+        queue = self.queues.get(bdaddr)
+        if queue is None:
+            queue = self.queues[bdaddr] = GattQueue(self.bus, bdaddr, self.max_outstanding)
+        return queue
+
+    # GLib timer callback, every POLL_TICK seconds
+    def tick(self):
+        now = time.monotonic()
+        for queue in self.queues.values():
+            if queue.polls:
+                queue.poll_due(now)
+        if now - self.rate_start >= RATE_INTERVAL:
+            self.poll_rate = (metrics.gatt_polls.value - self.rate_polls) / (now - self.rate_start)
+            self.rate_polls = metrics.gatt_polls.value
+            self.rate_start = now
+        return True
+
+    def depth(self):
+        return sum(len(queue.pending) + queue.outstanding for queue in self.queues.values())
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#
+# GATT service of the gateway, exposing the aggregated state of the Thunderboards
+# it serves to phones connecting to the gateway's own adapter:
+#
+#   Devices    read, notify   uint8 boards online, uint8 boards configured
+#   State      read, notify   one per board: uint8 online, uint8 button state,
+#                             with a user description holding the board address
+#
+# Notifications of each characteristic are rate limited to notify_interval
+# seconds, a board bouncing its button sends the latest state once per interval.
+#
+# BlueZ reads the object tree of the application only on RegisterApplication,
+# a board added after that (e.g. by a reload) registers the application again.
+
+import functools
+import logging
+import bluetooth_constants
+import sys
+sys.path.insert(0, '.')
+
+from bluetooth_gatt import Application, Service, Characteristic, Descriptor
+from gi.repository import GLib
+
+log = logging.getLogger("thunderboard")
+
+class DeviceState(Characteristic):
+    """
+    Online and button state of one Thunderboard
+    """
+
+    def __init__(self, bus, index, service, bdaddr, notify_interval):
+        Characteristic.__init__(self, bus, index, bluetooth_constants.GATEWAY_STATE_CHR_UUID,
+                                ['read', 'notify'], service, notify_interval)
+        self.bdaddr = bdaddr
+        self.online = 0
+        self.button = 0
+        self.value = bytes([self.online, self.button])
+        description = Descriptor(bus, 0, bluetooth_constants.USER_DESCRIPTION_DSC_UUID,
+                                 ['read'], self)
+        description.value = bdaddr.encode()
+        self.add_descriptor(description)
+
+    def set_online(self, online):
+        online = int(bool(online))
+        if online != self.online:
+            self.online = online
+            self.notify(bytes([self.online, self.button]))
+            self.service.update_devices()
+
+    def set_button(self, button):
+        self.button = button
+        self.notify(bytes([self.online, self.button]))
+
+
+class GatewayService(Service):
+    """
+    Primary service with the Devices characteristic and a State
+    characteristic per board
+    """
+
+    def __init__(self, bus, path_base, index, notify_interval):
+        Service.__init__(self, bus, path_base, index, bluetooth_constants.GATEWAY_SVC_UUID, True)
+        self.notify_interval = notify_interval
+        self.devices = Characteristic(bus, 0, bluetooth_constants.GATEWAY_DEVICES_CHR_UUID,
+                                      ['read', 'notify'], self, notify_interval)
+        self.devices.value = bytes([0, 0])
+        self.add_characteristic(self.devices)
+        self.states = []
+
+    # add a State characteristic for a board, GatewayApplication.add_device
+    # takes care of an application that is registered already
+    def add_device(self, bdaddr):
+        state = DeviceState(self.bus, len(self.characteristics), self, bdaddr,
+                            self.notify_interval)
+        self.add_characteristic(state)
+        self.states.append(state)
+        self.update_devices()
+        return state
+
+    def update_devices(self):
+        online = sum(state.online for state in self.states)
+        self.devices.notify(bytes([min(online, 255), min(len(self.states), 255)]))
+
+
+class GatewayApplication(Application):
+    """
+    GATT application with the GatewayService
+    """
+
+    def __init__(self, bus, notify_interval=0.1, path='/org/bluez/thunderboard'):
+        Application.__init__(self, bus, path)
+        self.service = GatewayService(bus, path, 0, notify_interval)
+        self.add_service(self.service)
+        # adapter registered with, None while not registered
+        self.adapter_path = None
+        self.handlers = None
+        self.registering = False
+        self.changed = False
+        self.reregister_id = None
+
+    def register(self, adapter_path, reply_handler, error_handler):
+        self.adapter_path = adapter_path
+        self.handlers = (reply_handler, error_handler)
+        self.registering = True
+        self.changed = False
+        Application.register(self, adapter_path,
+                             reply_handler=functools.partial(self.register_done, reply_handler),
+                             error_handler=functools.partial(self.register_failed, error_handler))
+
+    def register_done(self, reply_handler):
+        self.registering = False
+        reply_handler()
+        if self.changed:
+            self.schedule_reregister()
+
+    def register_failed(self, error_handler, e):
+        self.registering = False
+        self.adapter_path = None
+        error_handler(e)
+
+    def unregister(self, adapter_path):
+        if self.reregister_id is not None:
+            GLib.source_remove(self.reregister_id)
+            self.reregister_id = None
+        self.adapter_path = None
+        Application.unregister(self, adapter_path)
+
+    # State characteristic for a board, exported at once if the application
+    # is registered
+    def add_device(self, bdaddr):
+        state = self.service.add_device(bdaddr)
+        if self.registering:
+            self.changed = True
+        elif self.adapter_path is not None:
+            self.schedule_reregister()
+        return state
+
+    # boards added in one go register once
+    def schedule_reregister(self):
+        if self.reregister_id is None:
+            self.reregister_id = GLib.idle_add(self.reregister)
+
+    def reregister(self):
+        self.reregister_id = None
+        log.info("GATT application changed, registering it again")
+        adapter_path = self.adapter_path
+        Application.unregister(self, adapter_path)
+        self.register(adapter_path, *self.handlers)
+        return False
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+#
+# Counters and histograms of the gateway hot paths. All metrics are created
+# once at import (or at startup for the ones reading another object), updating
+# one is an integer addition, and a histogram observation a bisect into fixed
+# bucket bounds, so they stay enabled under full load.
+#
+# The registry is rendered in the Prometheus text format by a small HTTP
+# server (serve()) and/or published as a JSON object to the gateway stats topic
+# (snapshot()). Both read the values from other threads without locking, a
+# scrape may see one counter a few events ahead of another.
+
+import bisect
+import json
+import threading
+import sys
+sys.path.insert(0, '.')
+
+# seconds, for D-Bus calls and scans
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Counter(object):
+    """
+    Monotonic count, or the value of a callback for counts kept elsewhere
+    """
+    __slots__ = ("name", "help", "value", "func")
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.func = func
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+    def render(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s counter" % self.name)
+        lines.append("%s %s" % (self.name, self.get()))
+
+
+class Gauge(Counter):
+    """
+    Current value read from a callback at scrape time, e.g. a queue depth
+    """
+    __slots__ = ()
+
+    def render(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s gauge" % self.name)
+        lines.append("%s %s" % (self.name, self.get()))
+
+
+class Histogram(object):
+    """
+    Distribution over fixed bucket bounds, the counts are preallocated
+    """
+    __slots__ = ("name", "help", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name, help, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        # one more than bounds for values above the last bound (+Inf)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of the bucket holding the q quantile, None if it lies above
+    # the last bound
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return self.bounds[index] if index < len(self.bounds) else None
+        return None
+
+    def render(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s histogram" % self.name)
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append('%s_bucket{le="%g"} %d' % (self.name, bound, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+        lines.append("%s_sum %f" % (self.name, self.sum))
+        lines.append("%s_count %d" % (self.name, self.count))
+
+
+class Registry(object):
+    """
+    All metrics of the process, in creation order
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, func=None):
+        return self.add(Counter(name, help, func))
+
+    def gauge(self, name, help, func):
+        return self.add(Gauge(name, help, func))
+
+    def histogram(self, name, help, bounds=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, bounds))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+    # name -> value, histograms as count, sum, p50 and p99
+    def snapshot(self):
+        values = {}
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                values[metric.name] = {"count": metric.count, "sum": round(metric.sum, 6),
+                                       "p50": metric.quantile(0.5), "p99": metric.quantile(0.99)}
+            else:
+                values[metric.name] = metric.get()
+        return values
+
+    def snapshot_json(self):
+        return json.dumps(self.snapshot(), separators=(",", ":")).encode()
+
+registry = Registry()
+
+notifications = registry.counter("thunderboard_notifications_total",
+        "Button notifications received from the boards")
+reconnects = registry.counter("thunderboard_reconnects_total",
+        "Reconnect attempts scheduled after a failure or link loss")
+link_losses = registry.counter("thunderboard_link_losses_total",
+        "Connections to a board that went down")
+connect_failures = registry.counter("thunderboard_connect_failures_total",
+        "Device1.Connect calls that failed")
+led_writes = registry.counter("thunderboard_led_writes_total",
+        "LED characteristic writes completed")
+adverts = registry.counter("thunderboard_adverts_total",
+        "Advertising data updates received in passive mode")
+advert_duplicates = registry.counter("thunderboard_advert_duplicates_total",
+        "Advertising data updates dropped as repeats of the last one")
+gatt_polls = registry.counter("thunderboard_gatt_polls_total",
+        "Poll reads of characteristics completed")
+gatt_poll_misses = registry.counter("thunderboard_gatt_poll_misses_total",
+        "Polls skipped because the previous read had not completed")
+gatt_failures = registry.counter("thunderboard_gatt_failures_total",
+        "GATT operations of the scheduler that failed")
+migrations = registry.counter("thunderboard_adapter_migrations_total",
+        "Devices moved to another adapter after theirs failed")
+connect_seconds = registry.histogram("thunderboard_dbus_connect_seconds",
+        "Latency of successful Device1.Connect calls")
+start_notify_seconds = registry.histogram("thunderboard_dbus_start_notify_seconds",
+        "Latency of GattCharacteristic1.StartNotify calls")
+write_value_seconds = registry.histogram("thunderboard_dbus_write_value_seconds",
+        "Latency of GattCharacteristic1.WriteValue calls")
+gatt_queue_seconds = registry.histogram("thunderboard_gatt_queue_seconds",
+        "Time GATT operations waited in their device queue")
+gatt_operation_seconds = registry.histogram("thunderboard_gatt_operation_seconds",
+        "Latency of GATT operations issued by the scheduler")
+discovery_seconds = registry.histogram("thunderboard_discovery_seconds",
+        "Duration of scans, until the last wanted device was found or the timeout")
+
+
+# GET /metrics in the Prometheus text format
+def render_metrics(handler):
+    if handler.path not in ("/", "/metrics"):
+        handler.send_error(404)
+        return
+    body = registry.render().encode()
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain; version=0.0.4")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+# Serve the registry on address:port from a daemon thread. http.server is
+# imported here, it takes longer to load than the rest of the gateway's startup
+# and most installations leave the endpoint off.
+def serve(address, port):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        do_GET = render_metrics
+
+        # scrapes are not worth a log line each
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
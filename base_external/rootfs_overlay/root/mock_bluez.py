@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+#
+# Stand-in for bluetoothd, for running and measuring the gateway without an
+# adapter or boards. It owns org.bluez on the bus it is given (a private
+# dbus-daemon, never the real system bus) and exports:
+#
+#   /                              ObjectManager of everything below
+#   /org/bluez/hci0                Adapter1 and GattManager1, and hci1... with
+#                                  more than one adapter
+#   /org/bluez/hciN/dev_XX_...     Device1 of every simulated Thunderboard,
+#                                  on every adapter with a different RSSI
+#     .../service0                 Blinky service (bluetooth_gatt.Service)
+#     .../service0/char0           button state, read and notify
+#     .../service0/char1           LED, read, write and write-without-response
+#     .../service0/char2           battery level, read only (for --poll battery=N)
+#
+# Devices are known from the start as if BlueZ had them cached. Connect
+# replies at once and then signals Connected and ServicesResolved. Once
+# started, every device toggles its button state rate times per second and
+# remembers the time.monotonic() of every notification it sent. Powering an
+# adapter off (--fail-after) disconnects its devices and fails their Connect,
+# as a controller that went away.
+#
+# The gateway uses it through DBUS_SYSTEM_BUS_ADDRESS, e.g.
+#
+#   dbus-run-session python3 mock_bluez.py -n 4 --rate 2 [--adapters 2 --fail-after 30]
+#
+# prints the address to export before starting thunderboard_EFR32BG22.py.
+
+import argparse
+import os
+import time
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+import dbus.service
+import bluetooth_constants
+import bluetooth_exceptions
+import bluetooth_utils
+import sys
+sys.path.insert(0, '.')
+
+from bluetooth_gatt import Application, Service, Characteristic
+from gi.repository import GLib
+
+class MockAdapter(dbus.service.Object):
+    """
+    org.bluez.Adapter1 and org.bluez.GattManager1 of the mock
+    """
+
+    def __init__(self, bus, path, mock):
+        self.path = path
+        self.mock = mock
+        self.properties = {
+            'Address': '00:00:00:00:00:%02X' % len(mock.adapters),
+            'Name': 'mock',
+            'Powered': dbus.Boolean(True),
+            'Discovering': dbus.Boolean(False),
+        }
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        return {bluetooth_constants.ADAPTER_INTERFACE: self.properties,
+                bluetooth_constants.GATT_MANAGER_INTERFACE: {}}
+
+    def powered(self):
+        return bool(self.properties['Powered'])
+
+    # an adapter switched off drops the links of its devices
+    def set_powered(self, powered):
+        self.properties['Powered'] = dbus.Boolean(powered)
+        self.mock.invalidate()
+        self.PropertiesChanged(bluetooth_constants.ADAPTER_INTERFACE,
+                               {'Powered': dbus.Boolean(powered)}, [])
+        if not powered:
+            for device in self.mock.devices.values():
+                if device.adapter is self:
+                    device.set_connected(False)
+        return False
+
+    @dbus.service.method(bluetooth_constants.ADAPTER_INTERFACE)
+    def StartDiscovery(self):
+        self.properties['Discovering'] = dbus.Boolean(True)
+
+    @dbus.service.method(bluetooth_constants.ADAPTER_INTERFACE)
+    def StopDiscovery(self):
+        self.properties['Discovering'] = dbus.Boolean(False)
+
+    @dbus.service.method(bluetooth_constants.ADAPTER_INTERFACE, in_signature='a{sv}')
+    def SetDiscoveryFilter(self, properties):
+        pass
+
+    @dbus.service.method(bluetooth_constants.ADAPTER_INTERFACE, in_signature='o')
+    def RemoveDevice(self, path):
+        device = self.mock.devices.get(path)
+        if device is None:
+            raise bluetooth_exceptions.InvalidArgsException()
+        device.set_connected(False)
+
+    @dbus.service.method(bluetooth_constants.GATT_MANAGER_INTERFACE, in_signature='oa{sv}')
+    def RegisterApplication(self, path, options):
+        pass
+
+    @dbus.service.method(bluetooth_constants.GATT_MANAGER_INTERFACE, in_signature='o')
+    def UnregisterApplication(self, path):
+        pass
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != bluetooth_constants.ADAPTER_INTERFACE:
+            raise bluetooth_exceptions.InvalidArgsException()
+        return self.properties
+
+    @dbus.service.signal(bluetooth_constants.DBUS_PROPERTIES,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+
+class LedCharacteristic(Characteristic):
+    """
+    LED of a simulated board, remembers the last value written
+    """
+
+    def __init__(self, bus, index, service):
+        Characteristic.__init__(self, bus, index, bluetooth_constants.LED_CHR_UUID,
+                                ['read', 'write', 'write-without-response'], service)
+        self.value = b'\x00'
+        self.writes = 0
+
+    @dbus.service.method(bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE, in_signature='aya{sv}')
+    def WriteValue(self, value, options):
+        self.value = bytes(value)
+        self.writes += 1
+
+
+class MockDevice(dbus.service.Object):
+    """
+    org.bluez.Device1 of a simulated Thunderboard with its Blinky service
+    """
+
+    def __init__(self, bus, adapter, bdaddr, mock, rssi=-60):
+        self.path = bluetooth_utils.device_address_to_path(bdaddr, adapter.path)
+        self.adapter = adapter
+        self.mock = mock
+        self.properties = {
+            'Address': bdaddr,
+            'Name': 'Thunderboard',
+            'Alias': 'Thunderboard',
+            'Adapter': dbus.ObjectPath(adapter.path),
+            'Paired': dbus.Boolean(False),
+            'Connected': dbus.Boolean(False),
+            'ServicesResolved': dbus.Boolean(False),
+            'RSSI': dbus.Int16(rssi),
+        }
+        dbus.service.Object.__init__(self, bus, self.path)
+
+        self.service = Service(bus, self.path, 0, bluetooth_constants.BUTTON_SVC_UUID, True)
+        self.button = Characteristic(bus, 0, bluetooth_constants.BUTTON_CHR_UUID,
+                                     ['read', 'notify'], self.service)
+        self.button.value = b'\x00'
+        self.service.add_characteristic(self.button)
+        self.led = LedCharacteristic(bus, 1, self.service)
+        self.service.add_characteristic(self.led)
+        self.battery = Characteristic(bus, 2, bluetooth_constants.BATTERY_LEVEL_CHR_UUID,
+                                      ['read'], self.service)
+        self.battery.value = bytes([100 - len(mock.devices) % 50])
+        self.service.add_characteristic(self.battery)
+
+        self.state = 0
+        # time.monotonic() of every notification sent
+        self.sent = []
+
+    def get_properties(self):
+        return {bluetooth_constants.DEVICE_INTERFACE: self.properties}
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+        self.mock.invalidate()
+        self.PropertiesChanged(bluetooth_constants.DEVICE_INTERFACE, {name: value}, [])
+
+    def set_connected(self, connected):
+        if bool(self.properties['Connected']) == connected:
+            return
+        self.set_property('Connected', dbus.Boolean(connected))
+        if connected:
+            self.set_property('ServicesResolved', dbus.Boolean(True))
+        else:
+            self.set_property('ServicesResolved', dbus.Boolean(False))
+            self.button.notifying = False
+
+    # signals after the Connect reply, as bluetoothd sends them
+    def connect_complete(self):
+        self.set_connected(True)
+        return False
+
+    @dbus.service.method(bluetooth_constants.DEVICE_INTERFACE)
+    def Connect(self):
+        if not self.adapter.powered():
+            raise bluetooth_exceptions.FailedException("Adapter not powered")
+        GLib.idle_add(self.connect_complete)
+
+    @dbus.service.method(bluetooth_constants.DEVICE_INTERFACE)
+    def Disconnect(self):
+        self.set_connected(False)
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
+                         in_signature='ss',
+                         out_signature='v')
+    def Get(self, interface, name):
+        if interface != bluetooth_constants.DEVICE_INTERFACE or name not in self.properties:
+            raise bluetooth_exceptions.InvalidArgsException()
+        return self.properties[name]
+
+    @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != bluetooth_constants.DEVICE_INTERFACE:
+            raise bluetooth_exceptions.InvalidArgsException()
+        return self.properties
+
+    @dbus.service.signal(bluetooth_constants.DBUS_PROPERTIES,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    # one button event, only sent while the gateway has notifications enabled
+    def press(self):
+        if self.button.notifying:
+            self.state ^= 1
+            self.sent.append(time.monotonic())
+            self.button.notify(bytes([self.state]))
+        return True
+
+
+class MockBluez(Application):
+    """
+    Root object of the mock, an ObjectManager over the adapters, the devices
+    and their GATT services
+    """
+
+    def __init__(self, bus, addresses, adapter_names=(bluetooth_constants.ADAPTER_NAME,)):
+        Application.__init__(self, bus, '/')
+        self.bus_name = dbus.service.BusName(bluetooth_constants.BLUEZ_SERVICE_NAME, bus)
+        self.adapters = []
+        for adapter_name in adapter_names:
+            self.adapters.append(MockAdapter(bus, bluetooth_constants.BLUEZ_NAMESPACE + adapter_name,
+                                             self))
+        self.adapter = self.adapters[0]
+        self.devices = {}
+        for index, bdaddr in enumerate(addresses):
+            # a different adapter hears each device best
+            for number, adapter in enumerate(self.adapters):
+                rssi = -50 - 10 * ((index + number) % len(self.adapters))
+                device = MockDevice(bus, adapter, bdaddr, self, rssi)
+                self.devices[device.path] = device
+                self.add_service(device.service)
+        self.timer_ids = []
+
+    def get_managed_objects(self):
+        if self.managed_objects is None:
+            objects = dict(Application.get_managed_objects(self))
+            for adapter in self.adapters:
+                objects[dbus.ObjectPath(adapter.path)] = adapter.get_properties()
+            for device in self.devices.values():
+                objects[dbus.ObjectPath(device.path)] = device.get_properties()
+            self.managed_objects = objects
+        return self.managed_objects
+
+    def notifying_count(self):
+        return sum(1 for device in self.devices.values() if device.button.notifying)
+
+    # every device sends rate button events per second, spread over the period
+    def start_events(self, rate):
+        interval = max(1, int(1000 / rate))
+        for index, device in enumerate(self.devices.values()):
+            GLib.timeout_add(interval * index // len(self.devices) + 1,
+                             self.start_device_events, device, interval)
+
+    def start_device_events(self, device, interval):
+        self.timer_ids.append(GLib.timeout_add(interval, device.press))
+        return False
+
+    def stop_events(self):
+        for timer_id in self.timer_ids:
+            GLib.source_remove(timer_id)
+        self.timer_ids = []
+
+def mock_addresses(count):
+    return ["00:0B:57:00:%02X:%02X" % (i >> 8, i & 0xff) for i in range(count)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock BlueZ with simulated Thunderboards")
+    parser.add_argument("-n", "--devices", type=int, default=1, help="number of boards")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="button events per second and board once notifying")
+    parser.add_argument("--adapters", type=int, default=1, help="number of adapters")
+    parser.add_argument("--fail-after", type=int, default=0,
+                        help="power off hci0 after this many seconds, 0 never")
+    args = parser.parse_args()
+
+    address = os.environ.get("DBUS_SESSION_BUS_ADDRESS")
+    if not address:
+        print("No session bus, run it under dbus-run-session")
+        sys.exit(1)
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    mock = MockBluez(dbus.bus.BusConnection(address), mock_addresses(args.devices),
+                     ["hci%d" % i for i in range(args.adapters)])
+    print("export DBUS_SYSTEM_BUS_ADDRESS=" + address)
+    print(" ".join(mock_addresses(args.devices)))
+    mock.start_events(args.rate)
+    if args.fail_after:
+        GLib.timeout_add_seconds(args.fail_after, mock.adapter.set_powered, False)
+    GLib.MainLoop().run()
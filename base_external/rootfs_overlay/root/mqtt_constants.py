@@ -3,4 +3,15 @@ import random
 client_id = f'python-mqtt-{random.randint(0, 1000)}'
 broker = 'localhost'
 port = 1883
-publish_topic = 'client/btn_status'
+# events go to <topic_prefix>/<device>/<characteristic>, see event_payload.py
+topic_prefix = 'thunderboard'
+payload_format = 'json'
+
+# store-and-forward buffer for broker outages, see offline_buffer.py
+offline_dir = '/var/lib/thunderboard/offline'
+offline_max_mb = 16
+drain_rate = 100
+
+# local log of all events, see event_log.py
+event_log_dir = '/var/lib/thunderboard/events'
+event_log_days = 14
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+#
+# Publish queue between the BLE side (D-Bus signal callbacks on the GLib main
+# loop) and the paho client. publish() only appends to a bounded queue, a worker
+# thread hands the messages to paho whose own loop_start thread does the network
+# I/O, so a slow broker never stalls the main loop.
+#
+# Rapid repeats of the same state from one device are coalesced, events can be
+# batched into one message per topic (JSON array or length prefixed binary) and
+# when the queue is full either the oldest or the newest message is dropped.
+#
+# With an OfflineBuffer attached, messages are stored on disk while the broker
+# is unreachable (set_connected() is fed from paho's on_connect/on_disconnect)
+# and drained in order at drain_rate messages per second once it is back. New
+# messages go to the buffer as long as it is not empty to keep the order.
+
+import collections
+import json
+import logging
+import struct
+import threading
+import time
+import sys
+sys.path.insert(0, '.')
+
+log = logging.getLogger("thunderboard")
+
+BATCH_FORMATS = ("json", "binary")
+DROP_POLICIES = ("oldest", "newest")
+
+# seconds between drain steps of the offline buffer
+DRAIN_TICK = 0.1
+
+# Encode a batch of payloads (bytes) into one message
+def encode_batch(payloads, batch_format):
+    if batch_format == "json":
+        return json.dumps([p.decode(errors="replace") for p in payloads],
+                          separators=(",", ":")).encode()
+    # binary: every payload prefixed with its length as big endian uint16
+    return b"".join(struct.pack("!H", len(p)) + p for p in payloads)
+
+def decode_batch(message, batch_format):
+    if batch_format == "json":
+        return [p.encode() for p in json.loads(message)]
+    payloads = []
+    offset = 0
+    while offset < len(message):
+        (length,) = struct.unpack_from("!H", message, offset)
+        offset += 2
+        payloads.append(bytes(message[offset:offset + length]))
+        offset += length
+    return payloads
+
+class MqttPublisher(object):
+    """
+    Bounded publish queue drained into an MQTT client by a worker thread
+    """
+
+    def __init__(self, client, queue_size=1024, drop_policy="oldest",
+                 coalesce_interval=0.0, batch_size=1, batch_format="json",
+                 batch_interval=0.0, offline=None, drain_rate=100):
+        self.client = client
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.coalesce_interval = coalesce_interval
+        self.batch_size = batch_size
+        self.batch_format = batch_format
+        self.batch_interval = batch_interval
+        self.offline = offline
+        self.drain_rate = drain_rate
+        self.connected = offline is None
+
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+        # coalesce key -> (state, time) of the last queued message
+        self.last = {}
+
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.stored = 0
+        self.drained = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="mqtt-publisher", daemon=True)
+        self.thread.start()
+
+    # Stop the worker after it published what is still queued
+    def stop(self, timeout=5.0):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    # called from paho's on_connect and on_disconnect
+    def set_connected(self, connected):
+        self.connected = connected
+        self.wakeup.set()
+
+    # Same arguments as paho's publish plus key, the identity used to coalesce
+    # repeated states (e.g. the topic), and state, the value compared to the
+    # previous one of the key (the payload if not given, which does not work for
+    # timestamped payloads). Never blocks on the network.
+    def publish(self, topic, payload=None, qos=0, retain=False, key=None, state=None):
+        if key is not None and self.coalesce_interval > 0:
+            if state is None:
+                state = payload
+            now = time.monotonic()
+            last = self.last.get(key)
+            if last is not None and last[0] == state and now - last[1] < self.coalesce_interval:
+                self.coalesced += 1
+                return
+            self.last[key] = (state, now)
+
+        with self.lock:
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                if self.drop_policy == "newest":
+                    return
+                self.queue.popleft()
+            self.queue.append((topic, payload, qos, retain))
+            self.queued += 1
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.offline is not None and (self.offline.pending or
+                                             (self.connected and not self.offline.empty())):
+                timeout = DRAIN_TICK
+            self.wakeup.wait(timeout)
+            if self.running and self.batch_interval > 0:
+                # give a burst the chance to fill a batch
+                time.sleep(self.batch_interval)
+            with self.lock:
+                self.wakeup.clear()
+                items = self.queue
+                self.queue = collections.deque()
+            if items:
+                self.send(items)
+            if self.offline is not None:
+                self.drain()
+            if not self.running and not self.queue:
+                break
+        if self.offline is not None:
+            self.offline.close()
+
+    def send(self, items):
+        if self.offline is not None and (not self.connected or not self.offline.empty()):
+            self.store(items)
+            return
+        failed = self.publish_items(items)
+        if failed:
+            if self.offline is not None:
+                self.store(failed)
+            else:
+                self.failed += len(failed)
+
+    def store(self, items):
+        for topic, payload, qos, retain in items:
+            self.offline.append(topic, payload, qos, retain)
+        self.stored += len(items)
+
+    # Send the next slice of the offline buffer, at most drain_rate messages per
+    # second. Messages are removed only when all of the slice was accepted,
+    # after a failure they are sent again (at least once delivery).
+    def drain(self):
+        if not self.connected or self.offline.empty():
+            self.offline.flush(force=False)
+            return
+        messages = self.offline.read(max(1, int(self.drain_rate * DRAIN_TICK)))
+        if self.publish_items(messages):
+            self.offline.rewind()
+            return
+        self.offline.commit()
+        self.drained += len(messages)
+
+    # Publish (topic, payload, qos, retain) items, returns the ones which
+    # could not be handed to the client
+    def publish_items(self, items):
+        if self.batch_size <= 1:
+            return [item for item in items if not self.send_one(*item, count=1)]
+
+        # group by topic keeping the order of events within a topic, a batch
+        # inherits the highest QoS and the retain flag of its last event
+        failed = []
+        batches = collections.OrderedDict()
+        for item in items:
+            batches.setdefault(item[0], []).append(item)
+        for topic, topic_items in batches.items():
+            for start in range(0, len(topic_items), self.batch_size):
+                chunk = topic_items[start:start + self.batch_size]
+                if len(chunk) == 1:
+                    payload = chunk[0][1]
+                else:
+                    payload = encode_batch([item[1] for item in chunk], self.batch_format)
+                qos = max(item[2] for item in chunk)
+                if not self.send_one(topic, payload, qos, chunk[-1][3], count=len(chunk)):
+                    failed.extend(chunk)
+        return failed
+
+    def send_one(self, topic, payload, qos, retain, count):
+        try:
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        except Exception as e:
+            log.error("MQTT publish to %s failed, %s", topic, e)
+            return False
+        if info is not None and getattr(info, "rc", 0) != 0:
+            return False
+        self.sent += count
+        return True
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+#
+# Minimal in-process MQTT 3.1.1 broker stand-in for benchmarks and local runs
+# without mosquitto. It accepts any number of clients, answers CONNECT, PINGREQ
+# and SUBSCRIBE, acknowledges QoS 1 publishes and records every PUBLISH it
+# receives. Messages are not forwarded between clients, but inject() sends a
+# message to every client subscribed to a matching topic.
+
+import socket
+import struct
+import threading
+import time
+import sys
+sys.path.insert(0, '.')
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+def topic_matches(pattern, topic):
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[index]:
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+class MqttSink(object):
+    """
+    MQTT server with one thread per client, recording received publishes
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, on_message=None):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(16)
+        self.host, self.port = self.server.getsockname()
+        # on_message(topic, payload, retain, receive_time), called on the client thread
+        self.on_message = on_message
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.received = 0
+        self.received_bytes = 0
+        self.retained = {}
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self.accept_loop, name="mqtt-sink", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        try:
+            self.server.close()
+        except OSError:
+            pass
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self.client_loop, args=(conn,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def read_exact(self, conn, count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = conn.recv(count - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return bytes(data)
+
+    def read_packet(self, conn):
+        header = self.read_exact(conn, 1)[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = self.read_exact(conn, 1)[0]
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, self.read_exact(conn, length) if length else b""
+
+    def client_loop(self, conn):
+        try:
+            while self.running:
+                header, body = self.read_packet(conn)
+                packet_type = header >> 4
+                if packet_type == CONNECT:
+                    conn.sendall(bytes([CONNACK << 4, 2, 0, 0]))
+                elif packet_type == PUBLISH:
+                    self.handle_publish(conn, header, body)
+                elif packet_type == SUBSCRIBE:
+                    self.handle_subscribe(conn, body)
+                elif packet_type == PINGREQ:
+                    conn.sendall(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.subscriptions = [s for s in self.subscriptions if s[1] is not conn]
+            conn.close()
+
+    def handle_publish(self, conn, header, body):
+        now = time.monotonic()
+        qos = (header >> 1) & 3
+        retain = bool(header & 1)
+        (topic_length,) = struct.unpack_from("!H", body, 0)
+        topic = body[2:2 + topic_length].decode()
+        offset = 2 + topic_length
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            conn.sendall(bytes([PUBACK << 4, 2]) + packet_id)
+        payload = body[offset:]
+        with self.lock:
+            self.received += 1
+            self.received_bytes += len(payload)
+            if retain:
+                self.retained[topic] = payload
+        if self.on_message is not None:
+            self.on_message(topic, payload, retain, now)
+
+    def handle_subscribe(self, conn, body):
+        packet_id = body[0:2]
+        offset = 2
+        granted = bytearray()
+        while offset < len(body):
+            (topic_length,) = struct.unpack_from("!H", body, offset)
+            pattern = body[offset + 2:offset + 2 + topic_length].decode()
+            offset += 2 + topic_length + 1
+            with self.lock:
+                self.subscriptions.append((pattern, conn))
+            granted.append(0)
+        conn.sendall(bytes([SUBACK << 4]) + encode_length(2 + len(granted)) + packet_id + bytes(granted))
+
+    # Send a QoS 0 message to every client subscribed to a matching topic
+    def inject(self, topic, payload):
+        topic_bytes = topic.encode()
+        body = struct.pack("!H", len(topic_bytes)) + topic_bytes + payload
+        packet = bytes([PUBLISH << 4]) + encode_length(len(body)) + body
+        with self.lock:
+            targets = [conn for pattern, conn in self.subscriptions if topic_matches(pattern, topic)]
+        for conn in targets:
+            try:
+                conn.sendall(packet)
+            except OSError:
+                pass
+        return len(targets)
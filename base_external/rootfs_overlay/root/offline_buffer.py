@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+#
+# Disk-backed FIFO of MQTT messages for broker outages. Messages are appended to
+# segment files in a directory; together the segments form a ring with a fixed
+# cap, when it is exceeded the oldest segment is deleted. The read position is
+# kept in a small file so messages survive a restart of the gateway.
+#
+# To keep write amplification low on the SD card, appends are collected in
+# memory and written in blocks of write_batch bytes or once the oldest pending
+# append is flush_interval seconds old, and fsync follows the configured policy:
+#   always   - fsync after every block written
+#   interval - fsync at most every fsync_interval seconds
+#   never    - leave it to the kernel
+#
+# The read position is written when a drain crosses a segment boundary, at most
+# every position_interval seconds otherwise and on close, a restart after a
+# power cut may send up to position_interval seconds of messages again.
+#
+# Record layout: crc32 (of the rest of the record), flags (bit 0 retain,
+# bits 1-2 qos), topic length, payload length, topic, payload. A record that
+# fails the crc check on read is counted and the rest of its segment skipped,
+# the records after it cannot be found without a trustworthy length.
+
+import binascii
+import logging
+import os
+import struct
+import time
+import sys
+sys.path.insert(0, '.')
+
+log = logging.getLogger("thunderboard")
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+RECORD_HEADER = struct.Struct("!IBHI")
+SEGMENT_FORMAT = "segment-%08d.log"
+POSITION_FILE = "position"
+
+class OfflineBuffer(object):
+    """
+    Append-only segmented ring buffer of MQTT messages
+    """
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, segment_size=1024 * 1024,
+                 fsync="interval", fsync_interval=5.0, write_batch=4096, flush_interval=1.0,
+                 position_interval=5.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_bytes // segment_size)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        self.position_interval = position_interval
+
+        self.pending = bytearray()
+        self.pending_count = 0
+        self.pending_since = 0
+        self.last_fsync = time.monotonic()
+        self.last_position = time.monotonic()
+        self.position_dirty = False
+        self.dropped_segments = 0
+        self.corrupt_records = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[8:16]) for name in os.listdir(directory)
+                               if name.startswith("segment-") and name.endswith(".log"))
+        if not self.segments:
+            self.segments = [1]
+        self.read_segment, self.read_offset = self.load_position()
+        if self.read_segment not in self.segments:
+            self.read_segment, self.read_offset = self.segments[0], 0
+        self.next_segment, self.next_offset = self.read_segment, self.read_offset
+
+        self.write_segment = self.segments[-1]
+        self.write_file = open(self.segment_path(self.write_segment), "ab")
+        self.write_offset = self.truncate_partial(self.write_segment)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, SEGMENT_FORMAT % segment)
+
+    def load_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE)) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def save_position(self):
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write("%d %d\n" % (self.read_segment, self.read_offset))
+            if self.fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.last_position = time.monotonic()
+        self.position_dirty = False
+
+    # A power cut can leave a half written record at the end of the last
+    # segment, cut it off so appends start on a record boundary
+    def truncate_partial(self, segment):
+        path = self.segment_path(segment)
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, flags, topic_length, payload_length = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + topic_length + payload_length
+            if end > len(data) or binascii.crc32(data[offset + 4:end]) != crc:
+                break
+            offset = end
+        if offset != len(data):
+            log.warning("Offline buffer: dropping %d bytes of a partial record", len(data) - offset)
+            self.write_file.truncate(offset)
+        return offset
+
+    def empty(self):
+        return (not self.pending and self.next_segment == self.write_segment
+                and self.next_offset >= self.write_offset)
+
+    def append(self, topic, payload, qos=0, retain=False):
+        topic = topic.encode()
+        body = struct.pack("!BHI", (qos << 1) | int(bool(retain)), len(topic), len(payload)) \
+            + topic + payload
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending += struct.pack("!I", binascii.crc32(body)) + body
+        self.pending_count += 1
+        if len(self.pending) >= self.write_batch:
+            self.flush()
+
+    # Write what is pending. Without force a block smaller than write_batch is
+    # kept in memory until it is flush_interval seconds old.
+    def flush(self, force=True):
+        if self.pending and (force or len(self.pending) >= self.write_batch or
+                             time.monotonic() - self.pending_since >= self.flush_interval):
+            if self.write_offset + len(self.pending) > self.segment_size and self.write_offset > 0:
+                self.roll_segment()
+            self.write_file.write(self.pending)
+            self.write_file.flush()
+            self.write_offset += len(self.pending)
+            self.pending = bytearray()
+            self.pending_count = 0
+            if self.fsync == "always":
+                self.sync()
+        if self.fsync == "interval" and time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.write_file.fileno())
+        self.last_fsync = time.monotonic()
+
+    def roll_segment(self):
+        self.sync()
+        self.write_file.close()
+        self.write_segment += 1
+        self.segments.append(self.write_segment)
+        self.write_file = open(self.segment_path(self.write_segment), "ab")
+        self.write_offset = 0
+        # over the cap, the oldest segment goes whether it was sent or not
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            if oldest == self.read_segment:
+                self.read_segment, self.read_offset = self.segments[0], 0
+                self.next_segment, self.next_offset = self.read_segment, 0
+                self.dropped_segments += 1
+                log.warning("Offline buffer full, dropped segment %d", oldest)
+            self.remove_segment(oldest)
+
+    def remove_segment(self, segment):
+        try:
+            os.remove(self.segment_path(segment))
+        except OSError:
+            pass
+
+    # Up to max_count messages (topic, payload, qos, retain) following the last
+    # read. They stay in the buffer until commit().
+    def read(self, max_count):
+        self.flush()
+        messages = []
+        segment, offset = self.next_segment, self.next_offset
+        while len(messages) < max_count:
+            if segment != self.write_segment and offset >= os.path.getsize(self.segment_path(segment)):
+                segment = self.segments[self.segments.index(segment) + 1]
+                offset = 0
+                continue
+            end_offset = self.write_offset if segment == self.write_segment else None
+            with open(self.segment_path(segment), "rb") as f:
+                f.seek(offset)
+                data = f.read(64 * 1024)
+                # a record larger than the chunk, read the rest of it
+                if len(data) >= RECORD_HEADER.size:
+                    crc, flags, topic_length, payload_length = RECORD_HEADER.unpack_from(data)
+                    length = RECORD_HEADER.size + topic_length + payload_length
+                    if length > len(data):
+                        data += f.read(length - len(data))
+            position = 0
+            corrupt = False
+            while len(messages) < max_count and position + RECORD_HEADER.size <= len(data):
+                crc, flags, topic_length, payload_length = RECORD_HEADER.unpack_from(data, position)
+                start = position + RECORD_HEADER.size
+                end = start + topic_length + payload_length
+                if end > len(data):
+                    # the first record was read whole, unless its length is bogus
+                    corrupt = position == 0
+                    break
+                if binascii.crc32(data[position + 4:end]) != crc:
+                    corrupt = True
+                    break
+                topic = data[start:start + topic_length].decode(errors="replace")
+                messages.append((topic, data[start + topic_length:end], flags >> 1, bool(flags & 1)))
+                position = end
+            offset += position
+            if corrupt:
+                # record boundaries after it are lost, go on with the next segment
+                self.corrupt_records += 1
+                log.error("Offline buffer: corrupt record in segment %d at %d, skipping the "
+                          "rest of the segment", segment, offset)
+                if segment == self.write_segment:
+                    offset = self.write_offset
+                    break
+                segment = self.segments[self.segments.index(segment) + 1]
+                offset = 0
+                continue
+            if position == 0 or (end_offset is not None and offset >= end_offset):
+                break
+        self.next_segment, self.next_offset = segment, offset
+        return messages
+
+    # Everything returned by read() has been sent
+    def commit(self):
+        crossed = self.read_segment != self.next_segment
+        while self.read_segment != self.next_segment:
+            self.remove_segment(self.segments.pop(0))
+            self.read_segment = self.segments[0]
+        if self.next_offset != self.read_offset:
+            self.position_dirty = True
+        self.read_offset = self.next_offset
+        if crossed or (self.position_dirty and
+                       time.monotonic() - self.last_position >= self.position_interval):
+            self.save_position()
+
+    # Forget what read() returned without commit, it is read again next time
+    def rewind(self):
+        self.next_segment, self.next_offset = self.read_segment, self.read_offset
+
+    def close(self):
+        self.flush()
+        if self.position_dirty:
+            self.save_position()
+        if self.fsync != "never":
+            self.sync()
+        self.write_file.close()
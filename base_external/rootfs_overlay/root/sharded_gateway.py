@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+#
+# Sharded gateway for boards with more cores than one interpreter can use:
+#
+#   python3 sharded_gateway.py [-w 4] [--shard-by device|adapter] bdaddr... [-- gateway options]
+#
+# The devices are split round robin over worker processes. Every worker is an
+# unchanged thunderboard_EFR32BG22.py with its own D-Bus connection, GLib loop
+# and sessions, started with --shard-ring: instead of an MQTT client it writes
+# decoded button, LED and status events into an EventRing in shared memory
+# (event_ring.py). This process is the only MQTT client. It drains the rings,
+# encodes topics and payloads and publishes through an MqttPublisher. LED
+# commands go back through a second ring per worker, to the worker owning the
+# device. Neither side polls an idle ring, the producer wakes the consumer
+# through a pipe when a ring goes from empty to non-empty.
+#
+# With --shard-by adapter worker i only uses the i-th --adapter, otherwise all
+# workers use all adapters. Workers that exit are restarted. Options that only
+# concern MQTT (coalescing, batching, offline buffer) are options of this
+# process, the workers run without an offline buffer; statistics, summaries and
+# sensor batches of the workers are not forwarded.
+
+import argparse
+import logging
+import os
+import select
+import signal
+import subprocess
+import time
+import bluetooth_constants
+import event_payload
+import metrics
+import mqtt_constants
+import sys
+sys.path.insert(0, '.')
+
+from event_ring import EventRing, KIND_BUTTON, KIND_LED, KIND_COMMAND
+from event_ring import clear_wakeup, wakeup_pipe
+from mqtt_publisher import MqttPublisher, BATCH_FORMATS, DROP_POLICIES
+from offline_buffer import OfflineBuffer, FSYNC_POLICIES
+from paho.mqtt import client as mqtt_client
+
+log = logging.getLogger("thunderboard")
+
+WORKER_SCRIPT = "thunderboard_EFR32BG22.py"
+# records per ring and drain step
+DRAIN_BATCH = 1024
+# seconds between checks of the worker processes
+CHECK_INTERVAL = 1.0
+# seconds before a worker that exited is started again
+RESTART_DELAY = 5.0
+
+running = True
+
+class Worker(object):
+    """
+    One gateway process, its share of the devices and its two rings
+    """
+
+    def __init__(self, index, addresses, adapter, ring_size):
+        self.index = index
+        self.addresses = addresses
+        self.adapter = adapter
+        prefix = "thunderboard-%d-%d" % (os.getpid(), index)
+        # kept open here so a restarted worker gets the same pipes
+        self.events_wakeup = wakeup_pipe()
+        self.commands_wakeup = wakeup_pipe()
+        self.events = EventRing(prefix + "-events", ring_size)
+        self.commands = EventRing(prefix + "-commands", ring_size,
+                                  wakeup_fd=self.commands_wakeup[1])
+        self.process = None
+        self.exit_time = None
+
+    def start(self, args):
+        command = [sys.executable, WORKER_SCRIPT] + self.addresses + [
+            "--shard-ring", self.events.name, "--shard-commands", self.commands.name,
+            "--shard-ring-fd", str(self.events_wakeup[1]),
+            "--shard-commands-fd", str(self.commands_wakeup[0]),
+            "--topic-prefix", args.topic_prefix, "--payload-format", args.payload_format,
+            "--gatt-cache", "%s.%d" % (args.gatt_cache, self.index),
+            "--offline-dir", "", "-l", args.log_level]
+        if self.adapter is not None:
+            command += ["--adapter", self.adapter]
+        command += args.worker_args
+        self.process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        pass_fds=(self.events_wakeup[1], self.commands_wakeup[0]))
+        self.exit_time = None
+        log.info("Worker %d (pid %d): %d device(s)%s", self.index, self.process.pid,
+                 len(self.addresses), " on " + self.adapter if self.adapter else "")
+
+    # start the worker again some time after it exited
+    def check(self, args):
+        if self.process.poll() is None:
+            return
+        now = time.monotonic()
+        if self.exit_time is None:
+            log.error("Worker %d exited with %d, restarting in %.0f s", self.index,
+                      self.process.returncode, RESTART_DELAY)
+            self.exit_time = now
+        elif now - self.exit_time >= RESTART_DELAY:
+            self.start(args)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def close(self):
+        self.events.close()
+        self.commands.close()
+        for fd in self.events_wakeup + self.commands_wakeup:
+            os.close(fd)
+
+
+class ShardPublisher(object):
+    """
+    Events of the worker rings to MQTT messages
+    """
+
+    def __init__(self, publisher, topic_prefix, payload_format):
+        self.publisher = publisher
+        self.topic_prefix = topic_prefix
+        self.payload_format = payload_format
+        # (address, kind) -> topic
+        self.topics = {}
+        self.events = 0
+
+    def topic(self, address, kind):
+        name = "button" if kind == KIND_BUTTON else "led" if kind == KIND_LED else "status"
+        topic = self.topics[(address, kind)] = "%s/%s/%s" % (self.topic_prefix, address.hex(), name)
+        return topic
+
+    # records of one ring, (sequence, timestamp, address, kind, reserved, value)
+    def publish(self, records):
+        topics = self.topics
+        for sequence, timestamp, address, kind, reserved, value in records:
+            topic = topics.get((address, kind))
+            if topic is None:
+                topic = self.topic(address, kind)
+            if kind == KIND_BUTTON:
+                self.publisher.publish(topic,
+                                       event_payload.encode_event(self.payload_format, timestamp, value),
+                                       retain=True, key=topic, state=value)
+            elif kind == KIND_LED:
+                self.publisher.publish(topic,
+                                       event_payload.encode_event(self.payload_format, timestamp, value),
+                                       qos=1, retain=True)
+            else:
+                self.publisher.publish(topic, event_payload.STATUS_ONLINE if value else
+                                       event_payload.STATUS_OFFLINE, qos=1, retain=True)
+        self.events += len(records)
+
+def stop(signum, frame):
+    global running
+    running = False
+
+# read the device list, one bluetooth device address per line,
+# '#' starts a comment
+def read_device_list(filename):
+    addresses = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                addresses.append(line)
+    return addresses
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Thunderboard gateway sharded over worker processes")
+    parser.add_argument("bdaddr", nargs="*", help="bluetooth device address(es) to connect")
+    parser.add_argument("-f", "--file", help="file listing device addresses, one per line")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes, default one per core")
+    parser.add_argument("--shard-by", default="device", choices=["device", "adapter"],
+                        help="split the devices only, or give every worker its own adapter")
+    parser.add_argument("--adapter", action="append", default=[],
+                        help="with --shard-by adapter, the adapter of each worker in order")
+    parser.add_argument("--ring-size", type=int, default=65536, help="events per ring")
+    parser.add_argument("-l", "--log-level", default="info",
+                        choices=["debug", "info", "warning", "error"], help="console log level")
+    parser.add_argument("--broker", default=mqtt_constants.broker, help="MQTT broker host")
+    parser.add_argument("--port", type=int, default=mqtt_constants.port, help="MQTT broker port")
+    parser.add_argument("--queue-size", type=int, default=1024, help="MQTT publish queue length")
+    parser.add_argument("--drop", default="oldest", choices=DROP_POLICIES,
+                        help="message dropped when the publish queue is full")
+    parser.add_argument("--coalesce-ms", type=int, default=0,
+                        help="drop repeats of a device's last state within this many ms")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="events combined into one MQTT message, 1 disables batching")
+    parser.add_argument("--batch-format", default="json", choices=BATCH_FORMATS,
+                        help="encoding of batched events")
+    parser.add_argument("--batch-ms", type=int, default=0,
+                        help="ms to wait for a batch to fill after the first event")
+    parser.add_argument("--topic-prefix", default=mqtt_constants.topic_prefix,
+                        help="events are published to <prefix>/<device>/<characteristic>")
+    parser.add_argument("--payload-format", default=mqtt_constants.payload_format,
+                        choices=event_payload.PAYLOAD_FORMATS, help="event payload encoding")
+    parser.add_argument("--offline-dir", default=mqtt_constants.offline_dir,
+                        help="directory buffering messages while the broker is unreachable, "
+                             "empty to disable")
+    parser.add_argument("--offline-max-mb", type=int, default=mqtt_constants.offline_max_mb,
+                        help="size cap of the offline buffer")
+    parser.add_argument("--fsync", default="interval", choices=FSYNC_POLICIES,
+                        help="when the offline buffer is synced to storage")
+    parser.add_argument("--drain-rate", type=int, default=mqtt_constants.drain_rate,
+                        help="messages per second sent from the offline buffer after reconnect")
+    parser.add_argument("--gatt-cache", default=bluetooth_constants.GATT_CACHE_FILE,
+                        help="GATT cache file, every worker keeps its own with the worker number "
+                             "appended")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics over HTTP on this port, 0 disables")
+    parser.add_argument("worker_args", nargs=argparse.REMAINDER,
+                        help="further options of every worker, after --")
+    return parser
+
+# Start the workers and drain their rings into MQTT until SIGINT or SIGTERM
+def run_gateway(args, addresses):
+    worker_count = max(1, min(args.workers, len(addresses)))
+    if args.shard_by == "adapter":
+        worker_count = min(worker_count, len(args.adapter))
+
+    workers = []
+    for index in range(worker_count):
+        adapter = args.adapter[index] if args.shard_by == "adapter" else None
+        workers.append(Worker(index, addresses[index::worker_count], adapter, args.ring_size))
+    # device id -> worker, for LED commands
+    workers_by_id = dict((event_payload.device_id(bdaddr), worker)
+                         for worker in workers for bdaddr in worker.addresses)
+
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            log.info("Connected to MQTT Broker!")
+            client.publish(event_payload.gateway_topic(args.topic_prefix, "status"),
+                           event_payload.STATUS_ONLINE, qos=1, retain=True)
+            client.subscribe(args.topic_prefix + "/+/led/set")
+            publisher.set_connected(True)
+        else:
+            log.error("Failed to connect, return code %d", rc)
+
+    def on_disconnect(client, userdata, rc):
+        log.warning("Disconnected from MQTT Broker, return code %d", rc)
+        publisher.set_connected(False)
+
+    # LED commands, on paho's thread; the command ring has this thread as its
+    # only producer
+    def on_message(client, userdata, message):
+        parts = message.topic.split("/")
+        if len(parts) < 3:
+            return
+        worker = workers_by_id.get(parts[-3])
+        value = event_payload.decode_command(message.payload)
+        if worker is None or value is None:
+            log.warning("Ignoring command on %s: %r", message.topic, message.payload)
+            return
+        worker.commands.put(time.time(), bytes.fromhex(parts[-3]), KIND_COMMAND, value)
+
+    client = mqtt_client.Client(mqtt_constants.client_id)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.will_set(event_payload.gateway_topic(args.topic_prefix, "status"),
+                    event_payload.STATUS_OFFLINE, qos=1, retain=True)
+
+    # the workers run without an offline buffer, this process is the only publisher
+    offline = None
+    if args.offline_dir:
+        offline = OfflineBuffer(args.offline_dir, max_bytes=args.offline_max_mb * 1024 * 1024,
+                                fsync=args.fsync)
+    publisher = MqttPublisher(client, queue_size=args.queue_size, drop_policy=args.drop,
+                              coalesce_interval=args.coalesce_ms / 1000.0,
+                              batch_size=args.batch_size, batch_format=args.batch_format,
+                              batch_interval=args.batch_ms / 1000.0,
+                              offline=offline, drain_rate=args.drain_rate)
+    publisher.start()
+    shards = ShardPublisher(publisher, args.topic_prefix, args.payload_format)
+
+    metrics.registry.counter("thunderboard_shard_events_total", "Events drained from the worker rings",
+                             lambda: shards.events)
+    metrics.registry.counter("thunderboard_shard_dropped_total", "Events dropped on a full worker ring",
+                             lambda: sum(worker.events.producer_dropped() for worker in workers))
+    metrics.registry.counter("thunderboard_mqtt_sent_total", "Messages handed to the MQTT client",
+                             lambda: publisher.sent)
+    metrics.registry.counter("thunderboard_mqtt_dropped_total", "Messages dropped on a full queue",
+                             lambda: publisher.dropped)
+    metrics.registry.counter("thunderboard_mqtt_coalesced_total", "Repeated states not published",
+                             lambda: publisher.coalesced)
+    metrics.registry.counter("thunderboard_mqtt_stored_total",
+                             "Messages stored in the offline buffer", lambda: publisher.stored)
+    metrics.registry.counter("thunderboard_mqtt_drained_total",
+                             "Messages sent from the offline buffer", lambda: publisher.drained)
+    if args.metrics_port:
+        metrics.serve("127.0.0.1", args.metrics_port)
+
+    client.connect_async(args.broker, args.port)
+    client.loop_start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.start(args)
+
+    # Drain the rings until stopped. Once all are empty wait for a wakeup of one
+    # of them, a signal or the next worker check; a wakeup is cleared before the
+    # rings are read so none is lost.
+    signal_wakeup = wakeup_pipe()
+    signal.set_wakeup_fd(signal_wakeup[1])
+    wakeups = [worker.events_wakeup[0] for worker in workers] + [signal_wakeup[0]]
+    last_check = time.monotonic()
+    while running:
+        drained = 0
+        for worker in workers:
+            records = worker.events.get(DRAIN_BATCH)
+            if records:
+                shards.publish(records)
+                drained += len(records)
+        now = time.monotonic()
+        if now - last_check >= CHECK_INTERVAL:
+            last_check = now
+            for worker in workers:
+                worker.check(args)
+        if not drained and running:
+            ready = select.select(wakeups, [], [], max(0, last_check + CHECK_INTERVAL - now))[0]
+            for fd in ready:
+                clear_wakeup(fd)
+
+    for worker in workers:
+        worker.stop()
+    # what the workers wrote while stopping, e.g. offline status
+    for worker in workers:
+        shards.publish(worker.events.get(worker.events.capacity))
+        worker.close()
+    publisher.stop()
+    client.loop_stop()
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.worker_args and args.worker_args[0] == "--":
+        args.worker_args = args.worker_args[1:]
+    # JSON batches carry text, binary events need the binary batch format
+    if args.payload_format == "struct" and args.batch_size > 1 and args.batch_format == "json":
+        parser.error("--payload-format struct needs --batch-format binary when batching")
+    if args.shard_by == "adapter" and not args.adapter:
+        parser.error("--shard-by adapter needs the adapters, e.g. --adapter hci0 --adapter hci1")
+
+    logging.basicConfig(format="%(message)s", level=getattr(logging, args.log_level.upper()))
+
+    addresses = list(args.bdaddr)
+    if args.file:
+        addresses += read_device_list(args.file)
+    if not addresses:
+        parser.print_usage()
+        return 1
+    run_gateway(args, addresses)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
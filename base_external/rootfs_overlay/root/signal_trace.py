@@ -0,0 +1,725 @@
+#!/usr/bin/python3
+#
+# Recording of the BlueZ signals a gateway receives, and replay of a recording
+# into the gateway's signal handlers for load tests and regression runs:
+#
+#   thunderboard_EFR32BG22.py --signal-trace trace.bin ...   record what the gateway gets
+#   python3 signal_trace.py record trace.bin [--seconds N]   all BlueZ signals on the bus
+#   python3 signal_trace.py dump trace.bin                   print the records
+#   python3 signal_trace.py replay trace.bin [--speed 0] [bdaddr...]
+#
+# A trace starts with a header (magic TBST, version, start time in us since
+# the epoch) followed by records of
+#
+#   varint  us since the previous record
+#   byte    RECORD_SIGNAL or RECORD_SNAPSHOT
+#   signal: path, interface, member, varint argument count, the arguments
+#   snapshot: the GetManagedObjects reply taken when the recording started
+#
+# Values are written with a one byte D-Bus type tag (y b n q i u x t d s o g,
+# Y for a byte array, a array, e dictionary, r struct) and read back as the
+# same dbus types. Strings are written once and referenced by number after
+# that, so the object paths and property names repeated in every signal cost a
+# byte or two.
+#
+# The replay needs no bus: a ReplayBus stands in for the system bus, keeps the
+# objects of the snapshot up to date with the recorded signals, answers method
+# calls from them (GetManagedObjects, GetAll, Get, ReadValue; Connect,
+# StartNotify and the like succeed) and delivers every record to the signal
+# receivers and message filters the gateway's AdapterScheduler, DeviceDiscovery
+# and DeviceSession objects register, exactly as dbus-python would. --speed 1
+# replays at the recorded timing and reports how late the handlers ran, 0 (the
+# default) replays as fast as possible and reports the sustainable rate.
+
+import argparse
+import collections
+import functools
+import logging
+import struct
+import time
+import dbus
+import dbus.exceptions
+import dbus.lowlevel
+import bluetooth_constants
+import bluetooth_utils
+import sys
+sys.path.insert(0, '.')
+
+from gi.repository import GLib
+
+log = logging.getLogger("thunderboard")
+
+MAGIC = b"TBST"
+VERSION = 1
+HEADER = struct.Struct("<4sHQ")
+
+RECORD_SIGNAL = 0
+RECORD_SNAPSHOT = 1
+
+# tag -> (dbus type, struct) of the fixed size types
+FIXED_TYPES = {
+    b"y": (dbus.Byte, struct.Struct("<B")),
+    b"b": (dbus.Boolean, struct.Struct("<B")),
+    b"n": (dbus.Int16, struct.Struct("<h")),
+    b"q": (dbus.UInt16, struct.Struct("<H")),
+    b"i": (dbus.Int32, struct.Struct("<i")),
+    b"u": (dbus.UInt32, struct.Struct("<I")),
+    b"x": (dbus.Int64, struct.Struct("<q")),
+    b"t": (dbus.UInt64, struct.Struct("<Q")),
+    b"d": (dbus.Double, struct.Struct("<d")),
+}
+STRING_TYPES = {
+    b"s": dbus.String,
+    b"o": dbus.ObjectPath,
+    b"g": dbus.Signature,
+}
+# type -> tag, plain python values are written as the closest dbus type
+TYPE_TAGS = dict((dbus_type, tag) for tag, (dbus_type, packer) in FIXED_TYPES.items())
+TYPE_TAGS.update((dbus_type, tag) for tag, dbus_type in STRING_TYPES.items())
+TYPE_TAGS.update({bool: b"b", int: b"x", float: b"d", str: b"s"})
+
+def encode_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+class TraceWriter(object):
+    """
+    Encoder of trace records into a file
+    """
+
+    def __init__(self, filename, start=None):
+        self.file = open(filename, "wb")
+        self.start = time.time() if start is None else start
+        self.file.write(HEADER.pack(MAGIC, VERSION, int(self.start * 1000000)))
+        # string -> number
+        self.strings = {}
+        self.last_us = 0
+        self.buffer = bytearray()
+        self.records = 0
+
+    def encode_string(self, out, text):
+        number = self.strings.get(text)
+        if number is not None:
+            encode_varint(out, number * 2 + 1)
+            return
+        self.strings[text] = len(self.strings)
+        data = text.encode()
+        encode_varint(out, len(data) * 2)
+        out += data
+
+    def encode_value(self, out, value):
+        value_type = type(value)
+        tag = TYPE_TAGS.get(value_type)
+        if tag is not None:
+            out += tag
+            if tag in FIXED_TYPES:
+                out += FIXED_TYPES[tag][1].pack(value)
+            else:
+                self.encode_string(out, str(value))
+        elif value_type is dbus.ByteArray or value_type is bytes or value_type is bytearray:
+            out += b"Y"
+            encode_varint(out, len(value))
+            out += value
+        elif isinstance(value, dict):
+            out += b"e"
+            self.encode_string(out, getattr(value, "signature", None) or "")
+            encode_varint(out, len(value))
+            for key, item in value.items():
+                self.encode_value(out, key)
+                self.encode_value(out, item)
+        elif isinstance(value, tuple):
+            out += b"r"
+            encode_varint(out, len(value))
+            for item in value:
+                self.encode_value(out, item)
+        elif isinstance(value, list):
+            out += b"a"
+            self.encode_string(out, getattr(value, "signature", None) or "")
+            encode_varint(out, len(value))
+            for item in value:
+                self.encode_value(out, item)
+        else:
+            raise ValueError("cannot encode %r" % (value,))
+
+    def begin(self, record_type, timestamp):
+        now_us = int((timestamp - self.start) * 1000000)
+        encode_varint(self.buffer, max(0, now_us - self.last_us))
+        self.last_us = max(self.last_us, now_us)
+        self.buffer.append(record_type)
+        self.records += 1
+
+    def signal(self, timestamp, path, interface, member, args):
+        self.begin(RECORD_SIGNAL, timestamp)
+        out = self.buffer
+        self.encode_string(out, path)
+        self.encode_string(out, interface)
+        self.encode_string(out, member)
+        encode_varint(out, len(args))
+        for arg in args:
+            self.encode_value(out, arg)
+
+    def snapshot(self, timestamp, objects):
+        self.begin(RECORD_SNAPSHOT, timestamp)
+        self.encode_value(self.buffer, objects)
+
+    # also a GLib timer callback
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+        return True
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class TraceReader(object):
+    """
+    Decoder of a trace file, records as (seconds since the start, type, data)
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.data = f.read()
+        magic, version, start_us = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a signal trace" % filename)
+        self.start = start_us / 1000000.0
+
+    # strings is the table of the pass over the records
+    def decode_string(self, data, offset, strings):
+        value, offset = decode_varint(data, offset)
+        if value & 1:
+            return strings[value >> 1], offset
+        end = offset + (value >> 1)
+        text = data[offset:end].decode()
+        strings.append(text)
+        return text, end
+
+    def decode_value(self, data, offset, strings):
+        tag = data[offset:offset + 1]
+        offset += 1
+        fixed = FIXED_TYPES.get(tag)
+        if fixed is not None:
+            dbus_type, packer = fixed
+            return dbus_type(packer.unpack_from(data, offset)[0]), offset + packer.size
+        string_type = STRING_TYPES.get(tag)
+        if string_type is not None:
+            text, offset = self.decode_string(data, offset, strings)
+            return string_type(text), offset
+        if tag == b"Y":
+            length, offset = decode_varint(data, offset)
+            return dbus.ByteArray(data[offset:offset + length]), offset + length
+        if tag == b"r":
+            count, offset = decode_varint(data, offset)
+            items = []
+            for i in range(count):
+                item, offset = self.decode_value(data, offset, strings)
+                items.append(item)
+            return dbus.Struct(items), offset
+        signature, offset = self.decode_string(data, offset, strings)
+        count, offset = decode_varint(data, offset)
+        if tag == b"e":
+            items = {}
+            for i in range(count):
+                key, offset = self.decode_value(data, offset, strings)
+                items[key], offset = self.decode_value(data, offset, strings)
+            return dbus.Dictionary(items, signature=signature or None), offset
+        if tag == b"a":
+            items = []
+            for i in range(count):
+                item, offset = self.decode_value(data, offset, strings)
+                items.append(item)
+            return dbus.Array(items, signature=signature or None), offset
+        raise ValueError("bad tag %r at %d" % (tag, offset - 1))
+
+    # (seconds since the start, RECORD_SIGNAL, (path, interface, member, args))
+    # or (seconds, RECORD_SNAPSHOT, objects)
+    def __iter__(self):
+        data = self.data
+        offset = HEADER.size
+        now_us = 0
+        strings = []
+        while offset < len(data):
+            delta, offset = decode_varint(data, offset)
+            now_us += delta
+            record_type = data[offset]
+            offset += 1
+            if record_type == RECORD_SNAPSHOT:
+                objects, offset = self.decode_value(data, offset, strings)
+                yield now_us / 1000000.0, record_type, objects
+                continue
+            path, offset = self.decode_string(data, offset, strings)
+            interface, offset = self.decode_string(data, offset, strings)
+            member, offset = self.decode_string(data, offset, strings)
+            count, offset = decode_varint(data, offset)
+            args = []
+            for i in range(count):
+                arg, offset = self.decode_value(data, offset, strings)
+                args.append(arg)
+            yield now_us / 1000000.0, record_type, (path, interface, member, args)
+
+
+class SignalRecorder(object):
+    """
+    Writes every signal a bus connection receives into a trace
+    """
+
+    def __init__(self, filename):
+        self.writer = TraceWriter(filename)
+
+    # Start with a snapshot of the BlueZ objects, then record from a message
+    # filter, which sees every message delivered to the connection
+    def attach(self, bus):
+        om = dbus.Interface(bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, "/"),
+                            bluetooth_constants.DBUS_OM_IFACE)
+        self.writer.snapshot(time.time(), om.GetManagedObjects(byte_arrays=True))
+        bus.add_message_filter(self.filter)
+
+    def filter(self, bus, message):
+        if message.get_type() == dbus.lowlevel.MESSAGE_TYPE_SIGNAL:
+            self.writer.signal(time.time(), message.get_path(), message.get_interface(),
+                               message.get_member(), message.get_args_list(byte_arrays=True))
+        return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+    def flush(self):
+        return self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+# Byte arrays as a receiver without byte_arrays=True gets them
+def unpack_byte_arrays(value):
+    value_type = type(value)
+    if value_type is dbus.ByteArray:
+        return dbus.Array([dbus.Byte(b) for b in value], signature='y')
+    if value_type is dbus.Dictionary:
+        return dbus.Dictionary(((k, unpack_byte_arrays(v)) for k, v in value.items()),
+                               signature=value.signature)
+    if value_type is dbus.Array:
+        return dbus.Array([unpack_byte_arrays(v) for v in value], signature=value.signature)
+    if value_type is dbus.Struct:
+        return dbus.Struct([unpack_byte_arrays(v) for v in value])
+    return value
+
+
+class ReplayMessage(object):
+    """
+    A recorded signal as the message filters of dbus-python see it
+    """
+
+    def __init__(self, path, interface, member, args):
+        self.path = path
+        self.interface = interface
+        self.member = member
+        self.args = args
+
+    def get_type(self):
+        return dbus.lowlevel.MESSAGE_TYPE_SIGNAL
+
+    def get_path(self):
+        return self.path
+
+    def get_interface(self):
+        return self.interface
+
+    def get_member(self):
+        return self.member
+
+    def get_args_list(self, byte_arrays=False):
+        if byte_arrays:
+            return list(self.args)
+        return [unpack_byte_arrays(arg) for arg in self.args]
+
+
+class ReplayMatch(object):
+    """
+    Signal receiver added with add_signal_receiver
+    """
+
+    def __init__(self, bus, handler, signal_name, dbus_interface, path, keywords):
+        self.bus = bus
+        self.handler = handler
+        self.signal_name = signal_name
+        self.dbus_interface = dbus_interface
+        self.path = path
+        self.arg0 = keywords.get("arg0")
+        self.byte_arrays = keywords.get("byte_arrays", False)
+        self.path_keyword = keywords.get("path_keyword")
+
+    def deliver(self, message):
+        if ((self.signal_name is not None and message.member != self.signal_name) or
+                (self.dbus_interface is not None and message.interface != self.dbus_interface) or
+                (self.path is not None and message.path != self.path)):
+            return
+        args = message.get_args_list(byte_arrays=self.byte_arrays)
+        if self.arg0 is not None and (not args or args[0] != self.arg0):
+            return
+        if self.path_keyword is not None:
+            self.handler(*args, **{self.path_keyword: dbus.ObjectPath(message.path)})
+        else:
+            self.handler(*args)
+
+    def remove(self):
+        self.bus.remove_receiver(self)
+
+
+class ReplayProxy(object):
+    """
+    Object of the ReplayBus, methods answered from the replayed object state
+    """
+
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.path = path
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        return functools.partial(self.bus.call, self.path, member)
+
+
+class ReplayBus(object):
+    """
+    Stand-in for the system bus, fed from a trace
+    """
+
+    def __init__(self, objects):
+        # path -> interface -> properties
+        self.objects = dict((str(path), dict((str(i), dict(p)) for i, p in interfaces.items()))
+                            for path, interfaces in objects.items())
+        self.receivers = []
+        self.filters = []
+        self.calls = collections.Counter()
+
+    def get_object(self, bus_name, path, introspect=True):
+        return ReplayProxy(self, str(path))
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None, bus_name=None,
+                            path=None, **keywords):
+        match = ReplayMatch(self, handler, signal_name, dbus_interface, path, keywords)
+        self.receivers.append(match)
+        return match
+
+    def remove_receiver(self, match):
+        if match in self.receivers:
+            self.receivers.remove(match)
+
+    def add_match_string_non_blocking(self, rule):
+        pass
+
+    def remove_match_string_non_blocking(self, rule):
+        pass
+
+    def add_message_filter(self, func):
+        self.filters.append(func)
+
+    def remove_message_filter(self, func):
+        if func in self.filters:
+            self.filters.remove(func)
+
+    def flush(self):
+        pass
+
+    def properties(self, path, interface):
+        properties = self.objects.get(path, {}).get(interface)
+        if properties is None:
+            raise dbus.exceptions.DBusException("No such object %s" % path,
+                                                name="org.freedesktop.DBus.Error.UnknownObject")
+        return properties
+
+    def call(self, path, member, *args, **keywords):
+        self.calls[member] += 1
+        reply_handler = keywords.get("reply_handler")
+        error_handler = keywords.get("error_handler")
+        try:
+            if member == "GetManagedObjects":
+                result = (dbus.Dictionary(dict((dbus.ObjectPath(p), dict((i, dict(props))
+                          for i, props in interfaces.items()))
+                          for p, interfaces in self.objects.items()), signature='oa{sa{sv}}'),)
+            elif member == "GetAll":
+                result = (dbus.Dictionary(self.properties(path, args[0]), signature='sv'),)
+            elif member == "Get":
+                result = (self.properties(path, args[0])[args[1]],)
+            elif member == "ReadValue":
+                value = self.properties(path, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
+                result = (dbus.ByteArray(bytes(value.get('Value', b""))),)
+            else:
+                result = ()
+        except (dbus.exceptions.DBusException, KeyError, IndexError) as e:
+            if not isinstance(e, dbus.exceptions.DBusException):
+                e = dbus.exceptions.DBusException(str(e), name="org.freedesktop.DBus.Error.InvalidArgs")
+            if error_handler is None:
+                raise e
+            GLib.idle_add(lambda: error_handler(e) and False)
+            return None
+        if reply_handler is not None:
+            GLib.idle_add(lambda: reply_handler(*result) and False)
+            return None
+        return result[0] if result else None
+
+    # BlueZ changes its objects before it signals the change
+    def apply(self, path, interface, member, args):
+        if member == "PropertiesChanged" and interface == bluetooth_constants.DBUS_PROPERTIES:
+            properties = self.objects.setdefault(path, {}).setdefault(str(args[0]), {})
+            properties.update(args[1])
+            for name in args[2]:
+                properties.pop(name, None)
+        elif member == "InterfacesAdded":
+            interfaces = self.objects.setdefault(str(args[0]), {})
+            for name, properties in args[1].items():
+                interfaces[str(name)] = dict(properties)
+        elif member == "InterfacesRemoved":
+            interfaces = self.objects.get(str(args[0]), {})
+            for name in args[1]:
+                interfaces.pop(str(name), None)
+            if not interfaces:
+                self.objects.pop(str(args[0]), None)
+
+    def emit(self, path, interface, member, args):
+        self.apply(path, interface, member, args)
+        message = ReplayMessage(path, interface, member, args)
+        for func in list(self.filters):
+            func(self, message)
+        for match in list(self.receivers):
+            match.deliver(message)
+
+
+# Kind of a signal for the statistics, e.g. "PropertiesChanged Device1"
+def signal_kind(interface, member, args):
+    if member == "PropertiesChanged" and args:
+        return member + " " + str(args[0]).rsplit(".", 1)[-1]
+    if member in ("InterfacesAdded", "InterfacesRemoved") and len(args) > 1:
+        return member + " " + ",".join(sorted(str(i).rsplit(".", 1)[-1] for i in args[1]))
+    return member
+
+
+class NullPublisher(object):
+    """
+    MqttPublisher stand-in counting what the sessions publish
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, key=None, state=None):
+        self.published += 1
+
+
+class Replayer(object):
+    """
+    The gateway's scheduler, discovery and sessions on a ReplayBus, fed a trace
+    """
+
+    def __init__(self, reader, addresses=None, speed=0.0, scan_timeout=10, sensor_interval=1.0):
+        import adapter_scheduler
+        import characteristic_decoders
+        import device_session
+        import gatt_scheduler
+
+        if not addresses:
+            # the devices connected at some point of the capture
+            addresses = self.connected_devices(reader)
+        self.addresses = addresses
+        records = iter(reader)
+        first = next(records, None)
+        if first is None or first[1] != RECORD_SNAPSHOT:
+            raise ValueError("trace does not start with a snapshot")
+        # decoded before the run, the replay measures the handlers only
+        self.records = iter(list(records))
+        self.bus = ReplayBus(first[2])
+        self.speed = speed
+        self.publisher = NullPublisher()
+        self.sessions = {}
+        # kind -> [count, seconds in handlers, max seconds]
+        self.kinds = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        self.lags = []
+        self.count = 0
+        self.busy = 0.0
+
+        self.sensor_streams = characteristic_decoders.SensorStreams(self.publisher, "replay")
+        GLib.timeout_add(int(sensor_interval * 1000), self.sensor_streams.flush)
+        self.gatt_scheduler = gatt_scheduler.GattScheduler(self.bus)
+
+        def create_session(bdaddr, discovery):
+            session = device_session.DeviceSession(self.bus, discovery, bdaddr, self.publisher,
+                                                   sensor_streams=self.sensor_streams,
+                                                   gatt_scheduler=self.gatt_scheduler)
+            self.sessions[session.device_path] = session
+            return session
+        self.scheduler = adapter_scheduler.AdapterScheduler(self.bus, create_session, scan_timeout)
+        self.scheduler.session_removed = lambda session: self.sessions.pop(session.device_path, None)
+        self.scheduler.start()
+        for bdaddr in addresses:
+            self.scheduler.assign(bdaddr)
+        bluetooth_utils.MatchRule(self.bus, self.sd_interfaces_added,
+                bluetooth_constants.DBUS_OM_IFACE, "InterfacesAdded",
+                path = "/", arg0path = bluetooth_constants.BLUEZ_NAMESPACE)
+        self.scheduler.run(self.sd_interfaces_added)
+
+    @staticmethod
+    def connected_devices(reader):
+        addresses = set()
+        for timestamp, record_type, data in reader:
+            if record_type == RECORD_SNAPSHOT:
+                for path, interfaces in data.items():
+                    device = interfaces.get(bluetooth_constants.DEVICE_INTERFACE)
+                    if device and device.get('Connected'):
+                        addresses.add(str(device['Address']))
+            elif data[2] == "PropertiesChanged" and data[3] and \
+                    data[3][0] == bluetooth_constants.DEVICE_INTERFACE and \
+                    data[3][1].get('Connected'):
+                addresses.add(bluetooth_utils.device_path_to_address(data[0]))
+        return sorted(addresses)
+
+    # as in the gateway, GATT objects go to the session owning them
+    def sd_interfaces_added(self, path, interfaces):
+        session = self.sessions.get(bluetooth_utils.object_path_to_device_path(path))
+        if session is not None:
+            session.sd_interfaces_added(path, interfaces)
+
+    def dispatch(self, path, interface, member, args):
+        started = time.perf_counter()
+        self.bus.emit(path, interface, member, args)
+        elapsed = time.perf_counter() - started
+        kind = self.kinds[signal_kind(interface, member, args)]
+        kind[0] += 1
+        kind[1] += elapsed
+        if elapsed > kind[2]:
+            kind[2] = elapsed
+        self.busy += elapsed
+        self.count += 1
+
+    # Replay everything, returns the wall clock seconds it took
+    def run(self):
+        loop = GLib.MainLoop()
+        self.started = time.monotonic()
+        if self.speed > 0:
+            GLib.idle_add(self.timed_step, loop)
+        else:
+            GLib.idle_add(self.fast_step, loop)
+        loop.run()
+        elapsed = time.monotonic() - self.started
+        self.sensor_streams.flush()
+        return elapsed
+
+    # as fast as possible, in slices so replies and timers of the sessions run
+    # in between like they would between signals
+    def fast_step(self, loop):
+        for i in range(256):
+            record = next(self.records, None)
+            if record is None:
+                loop.quit()
+                return False
+            if record[1] == RECORD_SIGNAL:
+                self.dispatch(*record[2])
+        return True
+
+    def timed_step(self, loop):
+        record = next(self.records, None)
+        if record is None:
+            loop.quit()
+            return False
+        timestamp, record_type, data = record
+        delay = timestamp / self.speed - (time.monotonic() - self.started)
+        if delay > 0:
+            GLib.timeout_add(int(delay * 1000), self.timed_signal, loop, timestamp, data)
+        else:
+            self.timed_signal(loop, timestamp, data)
+        return False
+
+    def timed_signal(self, loop, timestamp, data):
+        self.lags.append(time.monotonic() - self.started - timestamp / self.speed)
+        if data is not None and not isinstance(data, dict):
+            self.dispatch(*data)
+        GLib.idle_add(self.timed_step, loop)
+        return False
+
+    def report(self, elapsed):
+        print("%d signals in %.3f s, %.0f signals/s, %.3f s in handlers (%.0f signals/s)" %
+              (self.count, elapsed, self.count / max(elapsed, 1e-9), self.busy,
+               self.count / max(self.busy, 1e-9)))
+        print("%d session(s), %d message(s) published, %d sensor sample(s)" %
+              (len(self.sessions), self.publisher.published, self.sensor_streams.samples))
+        print("%-45s %10s %12s %10s" % ("signal", "count", "avg us", "max us"))
+        for name, (count, total, longest) in sorted(self.kinds.items()):
+            print("%-45s %10d %12.1f %10.1f" % (name, count, total / count * 1e6, longest * 1e6))
+        if self.lags:
+            lags = sorted(self.lags)
+            print("lag behind the recorded timing: p50 %.1f ms, p99 %.1f ms, max %.1f ms" %
+                  (lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.99)] * 1000,
+                   lags[-1] * 1000))
+        print("method calls: " + ", ".join("%s %d" % item for item in sorted(self.bus.calls.items())))
+
+def record(args):
+    import signal
+    import dbus.mainloop.glib
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+    recorder = SignalRecorder(args.trace)
+    bus.add_match_string_non_blocking("type='signal',sender='%s'" %
+                                      bluetooth_constants.BLUEZ_SERVICE_NAME)
+    recorder.attach(bus)
+    loop = GLib.MainLoop()
+    GLib.timeout_add_seconds(1, recorder.flush)
+    if args.seconds:
+        GLib.timeout_add_seconds(args.seconds, loop.quit)
+    signal.signal(signal.SIGINT, lambda signum, frame: loop.quit())
+    loop.run()
+    recorder.close()
+    print("%d records" % recorder.writer.records)
+
+def dump(args):
+    reader = TraceReader(args.trace)
+    for timestamp, record_type, data in reader:
+        if record_type == RECORD_SNAPSHOT:
+            print("%12.6f snapshot of %d objects" % (timestamp, len(data)))
+        else:
+            path, interface, member, signal_args = data
+            print("%12.6f %s %s.%s %s" % (timestamp, path, interface, member,
+                                          bluetooth_utils.dbus_to_python(signal_args)))
+
+def replay(args):
+    replayer = Replayer(TraceReader(args.trace), args.bdaddr, args.speed, args.scan_timeout,
+                        args.sensor_interval)
+    replayer.report(replayer.run())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record and replay BlueZ signal traces")
+    commands = parser.add_subparsers(dest="command", required=True)
+    parser_record = commands.add_parser("record", help="record all BlueZ signals on the system bus")
+    parser_record.add_argument("trace")
+    parser_record.add_argument("--seconds", type=int, default=0, help="stop after this long")
+    parser_dump = commands.add_parser("dump", help="print the records of a trace")
+    parser_dump.add_argument("trace")
+    parser_replay = commands.add_parser("replay", help="replay a trace into the gateway handlers")
+    parser_replay.add_argument("trace")
+    parser_replay.add_argument("bdaddr", nargs="*",
+                               help="devices to create sessions for, by default those "
+                                    "connected during the capture")
+    parser_replay.add_argument("--speed", type=float, default=0.0,
+                               help="1 for the recorded timing, 2 twice as fast, 0 as fast "
+                                    "as possible")
+    parser_replay.add_argument("--scan-timeout", type=int, default=10)
+    parser_replay.add_argument("--sensor-interval", type=float, default=1.0,
+                               help="seconds between sensor batch flushes")
+    parser_replay.add_argument("-l", "--log-level", default="warning",
+                               choices=["debug", "info", "warning", "error"])
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s",
+                        level=getattr(logging, getattr(args, "log_level", "warning").upper()))
+    {"record": record, "dump": dump, "replay": replay}[args.command](args)
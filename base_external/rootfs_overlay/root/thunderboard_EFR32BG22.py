@@ -1,307 +1,733 @@
 #!/usr/bin/python3
-
-import random
-import time
+#
+# Thunderboard EFR32BG22 BLE to MQTT gateway
+#
+#   python3 thunderboard_EFR32BG22.py [options] bdaddr...
+#   python3 thunderboard_EFR32BG22.py @/etc/thunderboard.conf
+#
+# Options can be read from a file with @FILE, any number per line and '#'
+# starting a comment; /etc/init.d/S99thunderboard runs the gateway as a daemon
+# that way. Signals:
+#
+#   SIGINT, SIGTERM  shut down: stop the notifications, disconnect the boards
+#                    (left connected with --keep-connections, so the next start
+#                    finds them connected and resolved and skips scan, connect
+#                    and service discovery), publish what is still queued and
+#                    the offline status, exit
+#   SIGHUP           reload: parse the options again, re-reading @FILE and
+#                    --file, and apply the device list, log level, stats
+#                    interval and polls in place. Boards that stay keep their
+#                    connection and session, only added ones connect. Other
+#                    options need a restart.
+#
+# Importing the module does nothing, main() runs the gateway. D-Bus, GLib,
+# paho and the parts behind options are imported when the startup gets to
+# them, and the time of every startup phase is logged.
+
+import argparse
+import json
+import logging
 import signal
-import sys
-import dbus
-import dbus.mainloop.glib
-import bluetooth_utils
+import time
 import bluetooth_constants
+import event_payload
+import metrics
 import mqtt_constants
-
-from gi.repository import GLib
-from paho.mqtt import client as mqtt_client
-
+import sys
 sys.path.insert(0, '.')
 
-bus = None
-adapter_interface = None
-device_interface = None
-mainloop = None
-timer_id = None
-
-devices = {}
-
-found_bs = False
-found_bc = False
-found_lc = False
-bs_path = None
-bc_path = None
-lc_path = None
-
-client = None
-
-# Callback for MQTT connect
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print("Connected to MQTT Broker!")
-    else:
-        print("Failed to connect, return code %d\n", rc)
-
-# Button state notification callback
-def button_received(interface, changed, invalidated, path):
-    if 'Value' in changed:
-        button = bluetooth_utils.dbus_to_python(changed['Value'])
-        print("Button State: " + str(button[0]))
-        client.publish(mqtt_constants.publish_topic, str(button[0]))
-
-# Enable notification for button state characteristics.
-def start_notifications():
-    global bc_path
-    global bus
-
-    char_proxy = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, bc_path)
-    char_interface = dbus.Interface(char_proxy, bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE)
-    bus.add_signal_receiver(button_received,
-                            dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
-                            signal_name = "PropertiesChanged",
-                            path = bc_path,
-                            path_keyword = "path")
-    try:
-        print("Starting notifications")
-        char_interface.StartNotify()
-        print("Done starting notifications")
-    except Exception as e:
-        print("Failed to start temperature notifications")
-        print(e.get_dbus_name())
-        print(e.get_dbus_message())
-        return bluetooth_constants.RESULT_EXCEPTION
-    else:
-        return bluetooth_constants.RESULT_OK
-
-def service_discovery_completed():
-    bus.remove_signal_receiver(sd_interfaces_added,"InterfacesAdded")
-    bus.remove_signal_receiver(sd_properties_changed,"PropertiesChanged")
-    start_notifications()
-
-def sd_properties_changed(interface, changed, invalidated, path):
-    global device_path
-
-    if path != device_path:
-        return
-    if 'ServicesResolved' in changed:
-        sr = bluetooth_utils.dbus_to_python(changed['ServicesResolved'])
-        print("ServicesResolved  : ", sr)
-        if sr == True:
-            service_discovery_completed()
-
-def sd_interfaces_added(path, interfaces):
-    global found_bs
-    global found_bc
-    global found_lc
-    global bs_path
-    global bc_path
-    global lc_path
-
-    if bluetooth_constants.GATT_SERVICE_INTERFACE in interfaces:
-        properties = interfaces[bluetooth_constants.GATT_SERVICE_INTERFACE]
-        print("--------------------------------------------------------------------------------")
-        print("SVC path   :", path)
-        if 'UUID' in properties:
-            uuid = properties['UUID']
-            if uuid == bluetooth_constants.BUTTON_SVC_UUID:
-                found_bs = True
-                bs_path = path
-            print("SVC UUID   : ", bluetooth_utils.dbus_to_python(uuid))
-            print("SVC name   : ", bluetooth_utils.get_name_from_uuid(uuid))
-        return
-    if bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE in interfaces:
-        properties = interfaces[bluetooth_constants.GATT_CHARACTERISTIC_INTERFACE]
-        print("  CHR path   :", path)
-        if 'UUID' in properties:
-            uuid = properties['UUID']
-            if uuid == bluetooth_constants.BUTTON_CHR_UUID:
-                found_bc = True
-                bc_path = path
-            elif uuid == bluetooth_constants.LED_CHR_UUID:
-                found_lc = True
-                lc_path = path
-            print("  CHR UUID   : ", bluetooth_utils.dbus_to_python(uuid))
-            print("  CHR name   : ", bluetooth_utils.get_name_from_uuid(uuid))
-            flags  = ""
-            for flag in properties['Flags']:
-                flags = flags + flag + ","
-            print("  CHR flags  : ", flags)
-        return
-    if bluetooth_constants.GATT_DESCRIPTOR_INTERFACE in interfaces:
-        properties = interfaces[bluetooth_constants.GATT_DESCRIPTOR_INTERFACE]
-        print("    DSC path   :", path)
-        if 'UUID' in properties:
-            uuid = properties['UUID']
-            print("    DSC UUID   : ", bluetooth_utils.dbus_to_python(uuid))
-            print("    DSC name   : ", bluetooth_utils.get_name_from_uuid(uuid))
-        return
-
-def connect():
-    global device_interface
-
-    try:
-        device_interface.Connect()
-    except Exception as e:
-        print("Failed to connect")
-        print(e.get_dbus_name())
-        print(e.get_dbus_message())
-        if ("UnknownObject" in e.get_dbus_name()):
-            print("Try scanning first to resolve this problem")
-        return bluetooth_constants.RESULT_EXCEPTION
-    else:
-        print("Connected OK")
-        return bluetooth_constants.RESULT_OK
-
-def is_connected(device_proxy):
-    props_interface = dbus.Interface(device_proxy, bluetooth_constants.DBUS_PROPERTIES)
-    connected = props_interface.Get(bluetooth_constants.DEVICE_INTERFACE,"Connected")
-    return connected
-
-def dd_interfaces_added(path, interfaces):
-    # interfaces is an array of dictionary entries
-    if not bluetooth_constants.DEVICE_INTERFACE in interfaces:
-        return
-    device_properties = interfaces[bluetooth_constants.DEVICE_INTERFACE]
-    if path not in devices:
-        devices[path] = device_properties
-        dev = devices[path]
-
-def dd_interfaces_removed(path, interfaces):
-    # interfaces is an array of dictionary strings in this signal
-    if not bluetooth_constants.DEVICE_INTERFACE in interfaces:
-        return
-    if path in devices:
-        dev = devices[path]
-        del devices[path]
-
-def dd_properties_changed(interface, changed, invalidated, path):
-    if interface != bluetooth_constants.DEVICE_INTERFACE:
-        return
-    if path in devices:
-        devices[path] = dict(devices[path].items())
-        devices[path].update(changed.items())
-    else:
-        devices[path] = changed
-    dev = devices[path]
-
-# we don't need the signals registered when device discovery
-# timeout ends
-def discovery_timeout():
-    global adapter_interface
-    global mainloop
-    global timer_id
-
-    GLib.source_remove(timer_id)
-    mainloop.quit()
-    adapter_interface.StopDiscovery()
-    bus = dbus.SystemBus()
-    bus.remove_signal_receiver(dd_interfaces_added,"InterfacesAdded")
-    bus.remove_signal_receiver(dd_interfaces_added,"InterfacesRemoved")
-    bus.remove_signal_receiver(dd_properties_changed,"PropertiesChanged")
-    return True
-
-# discover devices, characteristics and descriptor usineg
-# d-bus signals (InterfacesAdded, InterfacesRemoved, and PropertiesChanged)
-# and callback interface
-def discover_devices(bus, timeout):
-    global adapter_interface
-    global mainloop
-    global timer_id
-
-    # acquire the adapter interface so we can call its methods
-    adapter_object = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_path)
-    adapter_interface=dbus.Interface(adapter_object, bluetooth_constants.ADAPTER_INTERFACE)
-
-    # register signal handler functions so we can asynchronously report discovered devices
-    # InterfacesAdded signal is emitted by BlueZ when an advertising packet from a device it doesn't
-    # already know about is received
-    bus.add_signal_receiver(dd_interfaces_added,
-            dbus_interface = bluetooth_constants.DBUS_OM_IFACE,
-            signal_name = "InterfacesAdded")
-
-    # InterfacesRemoved signal is emitted by BlueZ when a device "goes away"
-    bus.add_signal_receiver(dd_interfaces_removed,
-            dbus_interface = bluetooth_constants.DBUS_OM_IFACE,
-            signal_name = "InterfacesRemoved")
-
-    # PropertiesChanged signal is emitted by BlueZ when something re: a device already encountered
-    # changes e.g. the RSSI value
-    bus.add_signal_receiver(dd_properties_changed,
-           dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
-            signal_name = "PropertiesChanged",
-            path_keyword = "path")
-
-    mainloop = GLib.MainLoop()
-    timer_id = GLib.timeout_add(timeout, discovery_timeout)
-    adapter_interface.StartDiscovery(byte_arrays=True)
-    mainloop.run()
-
-# disconnect from device and mqtt broker
-# this is needed when we are running this script again to connect
-# to the same device
-def disconnect():
-    global device_interface
-
-    try:
-        device_interface.Disconnect()
-    except Exception as e:
-        print("Failed to disconnect")
-        print(e.get_dbus_name())
-        print(e.get_dbus_message())
-        return bluetooth_constants.RESULT_EXCEPTION
+from characteristic_decoders import find_decoder
+from mqtt_publisher import MqttPublisher, BATCH_FORMATS, DROP_POLICIES
+from offline_buffer import OfflineBuffer, FSYNC_POLICIES
+
+log = logging.getLogger("thunderboard")
+
+STARTED = time.monotonic()
+
+# imported by import_dbus() and start_mqtt()
+dbus = None
+GLib = None
+mqtt_client = None
+
+# options a reload applies, changes of the others are only logged
+RELOAD_OPTIONS = ("bdaddr", "file", "log_level", "stats_interval", "poll")
+# seconds the StopNotify calls, and then the offline status, may take on shutdown
+SHUTDOWN_TIMEOUT = 5.0
+
+def import_dbus():
+    global dbus, GLib
+    import dbus
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+
+# read the device list, one bluetooth device address per line,
+# '#' starts a comment
+def read_device_list(filename):
+    addresses = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                addresses.append(line)
+    return addresses
+
+def read_addresses(args):
+    addresses = list(args.bdaddr)
+    if args.file:
+        addresses += read_device_list(args.file)
+    return addresses
+
+# --poll arguments, NAME=SECONDS or UUID=SECONDS, to uuid -> seconds
+def parse_polls(parser, values):
+    result = {}
+    for value in values:
+        name, _, seconds = value.partition("=")
+        decoder = find_decoder(name)
+        uuid = decoder.uuid if decoder is not None else name.lower()
+        if len(uuid) != 36:
+            parser.error("unknown characteristic " + name)
+        try:
+            result[uuid] = float(seconds)
+        except ValueError:
+            parser.error("bad poll interval " + value)
+        if result[uuid] <= 0:
+            parser.error("bad poll interval " + value)
+    return result
+
+# lines of an @FILE, several options per line and '#' comments
+def split_option_line(line):
+    return line.split('#', 1)[0].split()
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Thunderboard EFR32BG22 BLE to MQTT gateway",
+                                     fromfile_prefix_chars="@")
+    parser.convert_arg_line_to_args = split_option_line
+    parser.add_argument("bdaddr", nargs="*",
+                        help="bluetooth device address(es) to connect, or to listen to with --passive")
+    parser.add_argument("-f", "--file", help="file listing device addresses, one per line")
+    parser.add_argument("-l", "--log-level", default="info",
+                        choices=["debug", "info", "warning", "error"],
+                        help="console log level, debug also prints every button event")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run as a service: log to syslog, start without devices and "
+                             "wait for a reload")
+    parser.add_argument("--keep-connections", action="store_true",
+                        help="leave the boards connected on shutdown for a fast restart")
+    parser.add_argument("--gatt-cache", default=bluetooth_constants.GATT_CACHE_FILE,
+                        help="file remembering the GATT object paths of each device")
+    parser.add_argument("-t", "--scan-timeout", type=int, default=10,
+                        help="seconds per scan for devices BlueZ does not know yet")
+    parser.add_argument("--broker", default=mqtt_constants.broker, help="MQTT broker host")
+    parser.add_argument("--port", type=int, default=mqtt_constants.port, help="MQTT broker port")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="MQTT publish queue length")
+    parser.add_argument("--drop", default="oldest", choices=DROP_POLICIES,
+                        help="message dropped when the publish queue is full")
+    parser.add_argument("--coalesce-ms", type=int, default=0,
+                        help="drop repeats of a device's last state within this many ms")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="events combined into one MQTT message, 1 disables batching")
+    parser.add_argument("--batch-format", default="json", choices=BATCH_FORMATS,
+                        help="encoding of batched events")
+    parser.add_argument("--batch-ms", type=int, default=0,
+                        help="ms to wait for a batch to fill after the first event")
+    parser.add_argument("--topic-prefix", default=mqtt_constants.topic_prefix,
+                        help="events are published to <prefix>/<device>/<characteristic>")
+    parser.add_argument("--payload-format", default=mqtt_constants.payload_format,
+                        choices=event_payload.PAYLOAD_FORMATS, help="event payload encoding")
+    parser.add_argument("--offline-dir", default=mqtt_constants.offline_dir,
+                        help="directory buffering messages while the broker is unreachable, "
+                             "empty to disable")
+    parser.add_argument("--offline-max-mb", type=int, default=mqtt_constants.offline_max_mb,
+                        help="size cap of the offline buffer")
+    parser.add_argument("--fsync", default="interval", choices=FSYNC_POLICIES,
+                        help="when the offline buffer is synced to storage")
+    parser.add_argument("--drain-rate", type=int, default=mqtt_constants.drain_rate,
+                        help="messages per second sent from the offline buffer after reconnect")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics over HTTP on this port, 0 disables")
+    parser.add_argument("--metrics-address", default="127.0.0.1",
+                        help="address the metrics endpoint listens on")
+    parser.add_argument("--stats-interval", type=int, default=0,
+                        help="seconds between metrics published to <prefix>/gateway/stats, 0 disables")
+    parser.add_argument("--adapter", action="append",
+                        help="adapter to use (e.g. hci1), repeat for several, all powered ones by default")
+    parser.add_argument("--max-connections", type=int, default=10,
+                        help="devices connected through one adapter at most")
+    parser.add_argument("--max-devices", type=int, default=1024,
+                        help="devices remembered per adapter, the least recently seen are dropped")
+    parser.add_argument("--device-max-age", type=int, default=300,
+                        help="seconds after which a device not seen while scanning is dropped")
+    parser.add_argument("--passive", action="store_true",
+                        help="publish advertising data of scanned devices instead of connecting")
+    parser.add_argument("--rssi-threshold", type=int,
+                        help="passive mode: ignore devices received weaker than this many dBm")
+    parser.add_argument("--duplicate-data", default="on", choices=["on", "off"],
+                        help="passive mode: report every advertisement (on) or let the "
+                             "controller filter duplicates (off)")
+    parser.add_argument("--advert-interval", type=int, default=60,
+                        help="passive mode: seconds after which unchanged advertising data "
+                             "is published again")
+    parser.add_argument("--aggregate-window", type=int, default=0,
+                        help="publish per device statistics over windows of this many seconds, "
+                             "0 disables")
+    parser.add_argument("--aggregate-interval", type=int, default=0,
+                        help="seconds between statistics, shorter than the window for sliding "
+                             "windows, default the window")
+    parser.add_argument("--no-raw-events", action="store_true",
+                        help="with --aggregate-window, publish only the statistics, not every event")
+    parser.add_argument("--gatt-server", action="store_true",
+                        help="expose the state of the boards as a GATT service on the adapter")
+    parser.add_argument("--notify-ms", type=int, default=100,
+                        help="minimum ms between notifications of a GATT server characteristic")
+    parser.add_argument("--event-log-dir", default="",
+                        help="keep every event in a local log in this directory "
+                             "(e.g. %s), query it with event_log.py" % mqtt_constants.event_log_dir)
+    parser.add_argument("--event-log-days", type=int, default=mqtt_constants.event_log_days,
+                        help="days the local event log is kept")
+    parser.add_argument("--poll", action="append", default=[], metavar="NAME=SECONDS",
+                        help="read a characteristic of every board periodically, by decoder name "
+                             "(e.g. battery) or UUID")
+    parser.add_argument("--gatt-outstanding", type=int, default=1,
+                        help="GATT operations in flight per board at most")
+    parser.add_argument("--sensor-interval", type=float, default=0,
+                        help="stream the environmental and IMU characteristics of the boards, "
+                             "published in batches every this many seconds, 0 disables")
+    parser.add_argument("--signal-trace", default="",
+                        help="record the BlueZ signals the gateway receives into this file, "
+                             "for replay with signal_trace.py")
+    parser.add_argument("--shard-ring", help=argparse.SUPPRESS)
+    parser.add_argument("--shard-commands", help=argparse.SUPPRESS)
+    parser.add_argument("--shard-ring-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--shard-commands-fd", type=int, help=argparse.SUPPRESS)
+    return parser
+
+def setup_logging(args):
+    level = getattr(logging, args.log_level.upper())
+    if args.daemon:
+        from logging.handlers import SysLogHandler
+        handler = SysLogHandler(address="/dev/log", facility=SysLogHandler.LOG_DAEMON)
+        handler.setFormatter(logging.Formatter("thunderboard[%(process)d]: %(message)s"))
+        logging.basicConfig(level=level, handlers=[handler])
     else:
-        print("Disconnected OK")
-        return bluetooth_constants.RESULT_OK
-
-# Disconnect from device and exit gracefully
-def signal_handler(signal, frame):
-    print("Disconnecting from " + bdaddr)
-    disconnect()
-    adapter_interface.RemoveDevice(device_path)
-    sys.exit(0)
-
-# read bluetooth device address to connect
-if (len(sys.argv) != 2):
-    print("usage: python3 client.py [bdaddr]")
-    sys.exit(1)
-
-bdaddr = sys.argv[1]
-
-# install signal handler for Ctrl+C
-signal.signal(signal.SIGINT, signal_handler)
-
-# setup MQTT client
-client = mqtt_client.Client(mqtt_constants.client_id)
-client.on_connect = on_connect
-client.connect(mqtt_constants.broker, mqtt_constants.port)
-client.loop_start()
-
-# dbus initialisation
-dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-bus = dbus.SystemBus()
-
-adapter_path = bluetooth_constants.BLUEZ_NAMESPACE + bluetooth_constants.ADAPTER_NAME
-print("adapter_path: " + adapter_path)
-
-device_path = bluetooth_utils.device_address_to_path(bdaddr, adapter_path)
-print("device_path:  " + device_path)
-
-device_proxy = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, device_path)
-device_interface = dbus.Interface(device_proxy, bluetooth_constants.DEVICE_INTERFACE)
-
-# before connecting to the device, bluez daemon must scan
-# near-by devices and discover its services
-print("Scanning")
-discover_devices(bus, 1 * 1000)
-
-if is_connected(device_proxy) == False:
-    connect()
-
-print("Discovering services")
-bus.add_signal_receiver(sd_interfaces_added,
-        dbus_interface = bluetooth_constants.DBUS_OM_IFACE,
-        signal_name = "InterfacesAdded")
-
-bus.add_signal_receiver(sd_properties_changed,
-        dbus_interface = bluetooth_constants.DBUS_PROPERTIES,
-        signal_name = "PropertiesChanged",
-        path_keyword = "path")
-
-mainloop.run()
+        logging.basicConfig(format="%(message)s", level=level)
+
+
+class Gateway(object):
+    """
+    MQTT client, D-Bus side and device sessions of a running gateway, with
+    the options they were started with
+    """
+
+    def __init__(self, parser, argv, args, addresses, polls):
+        self.parser = parser
+        # kept for reload(), which parses them again
+        self.argv = argv
+        self.args = args
+        self.addresses = addresses
+        # uuid -> seconds, shared with every session
+        self.polls = polls
+
+        self.bus = None
+        self.scheduler = None
+        self.discovery = None
+        self.mainloop = None
+        # DeviceSession per device path, and per device id used in MQTT topics
+        self.sessions = {}
+        self.sessions_by_id = {}
+
+        self.client = None
+        self.publisher = None
+        self.gatt_cache = None
+        self.gatt_application = None
+        self.gatt_states = {}
+        self.aggregator = None
+        self.event_log = None
+        self.sensor_streams = None
+        self.gatt_scheduler = None
+        self.ingest = None
+        # LED commands from the publisher process, when running as a shard
+        self.command_ring = None
+        # BlueZ signals written to a trace file for signal_trace.py replay
+        self.signal_recorder = None
+        self.stats_timer_id = None
+        self.poll_timer_id = None
+        self.stopping = False
+        self.shutdown_deadline = None
+
+        # (phase, seconds) of the startup
+        self.phases = []
+        self.phase_start = STARTED
+
+    def phase(self, name):
+        now = time.monotonic()
+        self.phases.append((name, now - self.phase_start))
+        self.phase_start = now
+
+    # Callback for MQTT connect
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            log.info("Connected to MQTT Broker!")
+            client.publish(event_payload.gateway_topic(self.args.topic_prefix, "status"),
+                           event_payload.STATUS_ONLINE, qos=1, retain=True)
+            client.subscribe(self.args.topic_prefix + "/+/led/set")
+            self.publisher.set_connected(True)
+        else:
+            log.error("Failed to connect, return code %d", rc)
+
+    # Callback for MQTT disconnect, paho's network loop reconnects on its own
+    def on_disconnect(self, client, userdata, rc):
+        log.warning("Disconnected from MQTT Broker, return code %d", rc)
+        self.publisher.set_connected(False)
+
+    # Callback for MQTT messages, on paho's thread. Only LED commands are
+    # subscribed, they are handed to the session on the GLib main loop.
+    def on_message(self, client, userdata, message):
+        received = time.monotonic()
+        parts = message.topic.split("/")
+        if len(parts) < 3:
+            return
+        session = self.sessions_by_id.get(parts[-3])
+        value = event_payload.decode_command(message.payload)
+        if session is None or value is None:
+            log.warning("Ignoring command on %s: %r", message.topic, message.payload)
+            return
+        GLib.idle_add(session.set_led, value, received)
+
+    # LED commands of a shard, forwarded by sharded_gateway.py through the command ring
+    def poll_commands(self):
+        records = self.command_ring.get()
+        while records:
+            for record in records:
+                session = self.sessions_by_id.get(record[2].hex())
+                if session is not None:
+                    session.set_led(record[5], time.monotonic())
+            records = self.command_ring.get()
+        return True
+
+    # the command ring went from empty to non-empty
+    def commands_ready(self, fd, condition):
+        from event_ring import clear_wakeup
+        clear_wakeup(fd)
+        return self.poll_commands()
+
+    # InterfacesAdded is emitted on the object manager for every object of every device,
+    # hand it to the session owning the object
+    def sd_interfaces_added(self, path, interfaces):
+        import bluetooth_utils
+        session = self.sessions.get(bluetooth_utils.object_path_to_device_path(path))
+        if session is not None:
+            session.sd_interfaces_added(path, interfaces)
+
+    # Session of a device on the adapter the scheduler picked, also after a move
+    # to another adapter
+    def create_session(self, bdaddr, discovery):
+        from device_session import DeviceSession
+        args = self.args
+        session = DeviceSession(self.bus, discovery, bdaddr, self.publisher, self.gatt_cache,
+                                topic_prefix=args.topic_prefix, payload_format=args.payload_format,
+                                aggregator=self.aggregator, event_log=self.event_log,
+                                sensor_streams=self.sensor_streams,
+                                gatt_scheduler=self.gatt_scheduler, polls=self.polls,
+                                publish_events=self.aggregator is None or not args.no_raw_events)
+        if self.gatt_application is not None:
+            if session.bdaddr not in self.gatt_states:
+                self.gatt_states[session.bdaddr] = \
+                    self.gatt_application.add_device(session.bdaddr)
+            session.gatt_state = self.gatt_states[session.bdaddr]
+        self.sessions[session.device_path] = session
+        self.sessions_by_id[event_payload.device_id(session.bdaddr)] = session
+        log.info("device_path:  " + session.device_path)
+        return session
+
+    def session_removed(self, session):
+        self.sessions.pop(session.device_path, None)
+
+    # periodic JSON snapshot of the metrics to <prefix>/gateway/stats, and of the
+    # adapter use to <prefix>/gateway/adapters
+    def publish_stats(self):
+        self.publisher.publish(event_payload.gateway_topic(self.args.topic_prefix, "stats"),
+                               metrics.registry.snapshot_json())
+        self.publisher.publish(event_payload.gateway_topic(self.args.topic_prefix, "adapters"),
+                               json.dumps(self.scheduler.utilization(),
+                                          separators=(",", ":")).encode())
+        return True
+
+    def start_mqtt(self):
+        global mqtt_client
+        from paho.mqtt import client as mqtt_client
+        args = self.args
+        # setup MQTT client, shared by all devices
+        client = self.client = mqtt_client.Client(mqtt_constants.client_id)
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message
+        client.will_set(event_payload.gateway_topic(args.topic_prefix, "status"),
+                        event_payload.STATUS_OFFLINE, qos=1, retain=True)
+
+        offline = None
+        if args.offline_dir:
+            offline = OfflineBuffer(args.offline_dir, max_bytes=args.offline_max_mb * 1024 * 1024,
+                                    fsync=args.fsync)
+
+        # BLE callbacks only queue messages, a worker thread hands them to paho or,
+        # while the broker is unreachable, to the offline buffer
+        publisher = self.publisher = MqttPublisher(
+            client, queue_size=args.queue_size, drop_policy=args.drop,
+            coalesce_interval=args.coalesce_ms / 1000.0,
+            batch_size=args.batch_size, batch_format=args.batch_format,
+            batch_interval=args.batch_ms / 1000.0,
+            offline=offline, drain_rate=args.drain_rate)
+        publisher.start()
+
+        metrics.registry.counter("thunderboard_mqtt_queued_total", "Messages queued for publishing",
+                                 lambda: publisher.queued)
+        metrics.registry.counter("thunderboard_mqtt_sent_total", "Messages handed to the MQTT client",
+                                 lambda: publisher.sent)
+        metrics.registry.counter("thunderboard_mqtt_failed_total", "Messages the MQTT client refused",
+                                 lambda: publisher.failed)
+        metrics.registry.counter("thunderboard_mqtt_dropped_total", "Messages dropped on a full queue",
+                                 lambda: publisher.dropped)
+        metrics.registry.counter("thunderboard_mqtt_coalesced_total", "Repeated states not published",
+                                 lambda: publisher.coalesced)
+        metrics.registry.counter("thunderboard_mqtt_stored_total",
+                                 "Messages stored in the offline buffer", lambda: publisher.stored)
+        metrics.registry.counter("thunderboard_mqtt_drained_total",
+                                 "Messages sent from the offline buffer", lambda: publisher.drained)
+        metrics.registry.gauge("thunderboard_mqtt_queue_depth", "Messages waiting in the publish queue",
+                               publisher.queue_depth)
+        if offline is not None:
+            metrics.registry.counter("thunderboard_offline_corrupt_total",
+                                     "Corrupt records skipped in the offline buffer",
+                                     lambda: offline.corrupt_records)
+        if args.metrics_port:
+            metrics.serve(args.metrics_address, args.metrics_port)
+
+        # connect in the background, a broker that is down at startup is retried by
+        # paho's network loop instead of ending the gateway
+        client.connect_async(args.broker, args.port)
+        client.loop_start()
+
+    # a shard of sharded_gateway.py hands its events to the publisher process
+    # through shared memory instead of having its own MQTT client
+    def start_shard(self):
+        from event_ring import EventRing, RingPublisher
+        events = EventRing(self.args.shard_ring, wakeup_fd=self.args.shard_ring_fd)
+        self.publisher = RingPublisher(events, self.args.payload_format)
+        self.command_ring = EventRing(self.args.shard_commands)
+        if self.args.shard_commands_fd is not None:
+            GLib.io_add_watch(self.args.shard_commands_fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                              self.commands_ready)
+        else:
+            # started without the wakeup pipe, e.g. by hand
+            GLib.timeout_add(20, self.poll_commands)
+
+    # Publish what is still queued and the offline status, then disconnect;
+    # a clean disconnect suppresses the will
+    def stop_mqtt(self):
+        if self.publisher is not None:
+            self.publisher.stop()
+        if self.client is None:
+            return
+        if self.client.is_connected():
+            info = self.client.publish(event_payload.gateway_topic(self.args.topic_prefix, "status"),
+                                       event_payload.STATUS_OFFLINE, qos=1, retain=True)
+            info.wait_for_publish(SHUTDOWN_TIMEOUT)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def start_dbus(self):
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self.bus = dbus.SystemBus()
+        # attached first, the trace starts with the objects the scheduler reads
+        if self.args.signal_trace:
+            from signal_trace import SignalRecorder
+            self.signal_recorder = SignalRecorder(self.args.signal_trace)
+            self.signal_recorder.attach(self.bus)
+            GLib.timeout_add_seconds(1, self.signal_recorder.flush)
+
+    # one DeviceDiscovery per adapter, devices are spread over the adapters;
+    # False if no adapter is powered
+    def start_adapters(self):
+        from adapter_scheduler import AdapterScheduler
+        from gatt_cache import GattCache
+        args = self.args
+        self.gatt_cache = GattCache(args.gatt_cache)
+        self.scheduler = AdapterScheduler(self.bus, self.create_session, args.scan_timeout,
+                                          max_connections=args.max_connections,
+                                          max_devices=args.max_devices,
+                                          max_age=args.device_max_age, adapter_names=args.adapter)
+        self.scheduler.session_removed = self.session_removed
+        self.scheduler.start()
+        primary = self.scheduler.primary()
+        if primary is None:
+            log.error("No powered bluetooth adapter")
+            return False
+        # passive scanning and the GATT server run on the first adapter
+        self.discovery = primary.discovery
+        log.info("adapter_path: " + self.discovery.adapter_path)
+        return True
+
+    # what the options add to the sessions
+    def start_features(self):
+        from gatt_scheduler import GattScheduler
+        args = self.args
+        if args.gatt_server:
+            from gatt_server import GatewayApplication
+            self.gatt_application = GatewayApplication(self.bus,
+                                                       notify_interval=args.notify_ms / 1000.0)
+
+        if args.aggregate_window > 0:
+            from event_aggregator import EventAggregator
+            self.aggregator = EventAggregator(self.publisher, args.topic_prefix,
+                                              window=args.aggregate_window,
+                                              interval=args.aggregate_interval,
+                                              max_devices=args.max_devices, auto_add=args.passive)
+            self.discovery.rssi_callback = self.aggregator.rssi
+            GLib.timeout_add(int(self.aggregator.interval * 1000), self.aggregator.tick)
+
+        if args.event_log_dir:
+            from event_log import EventLog
+            event_log = self.event_log = EventLog(args.event_log_dir, keep_days=args.event_log_days)
+            GLib.timeout_add_seconds(1, event_log.flush, False)
+            metrics.registry.counter("thunderboard_event_log_written_total",
+                                     "Events written to the local event log",
+                                     lambda: event_log.written)
+
+        if args.sensor_interval > 0:
+            from characteristic_decoders import SensorStreams
+            sensor_streams = self.sensor_streams = SensorStreams(self.publisher, args.topic_prefix)
+            GLib.timeout_add(int(args.sensor_interval * 1000), sensor_streams.flush)
+            metrics.registry.counter("thunderboard_sensor_samples_total",
+                                     "Sensor samples decoded and published",
+                                     lambda: sensor_streams.samples)
+            metrics.registry.counter("thunderboard_sensor_dropped_total",
+                                     "Sensor samples dropped on a full stream buffer",
+                                     lambda: sensor_streams.dropped)
+
+        gatt_scheduler = self.gatt_scheduler = GattScheduler(self.bus,
+                                                             max_outstanding=args.gatt_outstanding)
+        self.start_poll_tick()
+        metrics.registry.gauge("thunderboard_gatt_poll_rate", "Poll reads completed per second",
+                               lambda: round(gatt_scheduler.poll_rate, 2))
+        metrics.registry.gauge("thunderboard_gatt_queue_depth", "GATT operations queued or in flight",
+                               gatt_scheduler.depth)
+
+        if args.stats_interval > 0:
+            self.stats_timer_id = GLib.timeout_add_seconds(args.stats_interval, self.publish_stats)
+
+    def start_poll_tick(self):
+        from gatt_scheduler import POLL_TICK
+        if self.polls and self.poll_timer_id is None:
+            self.poll_timer_id = GLib.timeout_add(int(POLL_TICK * 1000), self.gatt_scheduler.tick)
+
+    def start_sessions(self):
+        import bluetooth_utils
+        args = self.args
+        # passive mode connects to nothing, the addresses only select the devices
+        for bdaddr in ([] if args.passive else self.addresses):
+            self.scheduler.assign(bdaddr)
+
+        # GATT objects of the sessions arrive either with the managed objects read by
+        # the scheduler or later through InterfacesAdded during service discovery
+        bluetooth_utils.MatchRule(self.bus, self.sd_interfaces_added,
+                bluetooth_constants.DBUS_OM_IFACE, "InterfacesAdded",
+                path = "/", arg0path = bluetooth_constants.BLUEZ_NAMESPACE)
+
+        # before connecting to the devices, bluez daemon must know them, either
+        # from its cache or by scanning near-by devices. Sessions scan, connect and
+        # reconnect on their own from here on.
+        self.scheduler.run(self.sd_interfaces_added)
+
+        if args.passive:
+            from advert_ingest import AdvertIngest
+            self.ingest = AdvertIngest(self.publisher, args.topic_prefix, self.addresses,
+                                       min_interval=args.advert_interval,
+                                       max_devices=args.max_devices)
+            self.discovery.set_discovery_filter(rssi=args.rssi_threshold,
+                                                duplicate_data=args.duplicate_data == "on")
+            self.discovery.start_passive(self.ingest.advert_received)
+
+        if self.gatt_application is not None:
+            self.gatt_application.register(self.discovery.adapter_path,
+                    reply_handler=lambda: log.info("GATT application registered"),
+                    error_handler=lambda e: log.error("RegisterApplication failed: " + str(e)))
+
+    # Once every session notifies, the time it took since the start; sessions
+    # of a warm restart skip scan, connect and service discovery
+    def check_ready(self):
+        from device_session import STATE_NOTIFYING
+        if self.stopping:
+            return False
+        if any(session.state != STATE_NOTIFYING for session in self.sessions.values()):
+            return True
+        log.info("All %d device(s) notifying %.0f ms after the start", len(self.sessions),
+                 (time.monotonic() - STARTED) * 1000)
+        return False
+
+    # Start everything, False if the gateway cannot run
+    def start(self):
+        import_dbus()
+        self.phase("imports")
+        if self.args.shard_ring:
+            self.start_shard()
+        else:
+            self.start_mqtt()
+        self.phase("mqtt")
+        self.start_dbus()
+        self.phase("dbus")
+        if not self.start_adapters():
+            return False
+        self.phase("adapters")
+        self.start_features()
+        self.phase("features")
+        self.start_sessions()
+        self.phase("sessions")
+        log.info("Startup %s, %.0f ms", ", ".join("%s %.0f ms" % (name, seconds * 1000)
+                                                  for name, seconds in self.phases),
+                 (time.monotonic() - STARTED) * 1000)
+        if self.sessions:
+            GLib.timeout_add(100, self.check_ready)
+
+        # handled on the main loop, not in a Python signal handler between two
+        # bytecodes of whatever callback was running
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, self.shutdown)
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, self.shutdown)
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGHUP, self.reload)
+        return True
+
+    def run(self):
+        try:
+            started = self.start()
+        except KeyboardInterrupt:
+            started = False
+        if started:
+            self.mainloop = GLib.MainLoop()
+            self.mainloop.run()
+        self.close()
+        return 0 if started else 1
+
+    # Stop the notifications of a session and, unless keep_connection, disconnect.
+    # The StopNotify calls are queued on the GattQueue, stop() keeps them.
+    def close_session(self, session, keep_connection=False):
+        session.stop_notifications()
+        session.stop()
+        if not keep_connection:
+            log.info("Disconnecting from " + session.bdaddr)
+            session.disconnect()
+
+    # SIGINT or SIGTERM, on the main loop
+    def shutdown(self):
+        if self.stopping:
+            return False
+        self.stopping = True
+        keep = self.args.keep_connections
+        log.info("Shutting down, %s %d device(s)", "keeping" if keep else "disconnecting",
+                 len(self.sessions))
+        for session in list(self.sessions.values()):
+            self.close_session(session, keep)
+            if not keep:
+                session.discovery.remove_device(session.device_path)
+        if self.discovery is not None and self.discovery.passive:
+            self.discovery.stop_passive()
+        if self.gatt_application is not None:
+            self.gatt_application.unregister(self.discovery.adapter_path)
+        if self.sensor_streams is not None:
+            self.sensor_streams.flush()
+        # the main loop runs until the queued StopNotify calls are answered
+        self.shutdown_deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        GLib.timeout_add(20, self.finish_shutdown)
+        return False
+
+    def finish_shutdown(self):
+        if (self.gatt_scheduler is not None and self.gatt_scheduler.depth() > 0 and
+                time.monotonic() < self.shutdown_deadline):
+            return True
+        self.bus.flush()
+        self.mainloop.quit()
+        return False
+
+    # after the main loop ended, or a failed start
+    def close(self):
+        self.stop_mqtt()
+        if self.event_log is not None:
+            self.event_log.close()
+        if self.command_ring is not None:
+            self.command_ring.close()
+        if self.signal_recorder is not None:
+            self.signal_recorder.close()
+
+    # SIGHUP, on the main loop. Applies RELOAD_OPTIONS from the options parsed
+    # again, the sessions of devices still listed are left alone.
+    def reload(self):
+        try:
+            args = self.parser.parse_args(self.argv)
+            addresses = read_addresses(args)
+            polls = parse_polls(self.parser, args.poll)
+        except (SystemExit, OSError) as e:
+            log.error("Reload failed, configuration unchanged (%s)", e)
+            return True
+        ignored = [name for name, value in sorted(vars(args).items())
+                   if name not in RELOAD_OPTIONS and value != getattr(self.args, name)]
+        if ignored:
+            log.warning("Reload: changes of %s need a restart", ", ".join(ignored))
+
+        logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+        if args.stats_interval != self.args.stats_interval:
+            if self.stats_timer_id is not None:
+                GLib.source_remove(self.stats_timer_id)
+                self.stats_timer_id = None
+            if args.stats_interval > 0:
+                self.stats_timer_id = GLib.timeout_add_seconds(args.stats_interval,
+                                                               self.publish_stats)
+
+        if polls != self.polls:
+            self.polls.clear()
+            self.polls.update(polls)
+            for session in self.sessions.values():
+                session.update_polls()
+            self.start_poll_tick()
+
+        old = set(address.upper() for address in self.addresses)
+        new = set(address.upper() for address in addresses)
+        if self.ingest is not None:
+            self.ingest.set_addresses(new)
+        elif not self.args.passive:
+            for bdaddr in sorted(old - new):
+                session = self.scheduler.remove(bdaddr)
+                if session is not None:
+                    log.info("%s: No longer listed", bdaddr)
+                    self.close_session(session)
+                    self.sessions.pop(session.device_path, None)
+                    self.sessions_by_id.pop(event_payload.device_id(session.bdaddr), None)
+                    session.publish_status(event_payload.STATUS_OFFLINE)
+            for bdaddr in sorted(new - old):
+                self.scheduler.assign(bdaddr)
+
+        for name in RELOAD_OPTIONS:
+            setattr(self.args, name, getattr(args, name))
+        self.addresses = addresses
+        log.info("Reloaded, %d device(s): %d added, %d removed", len(new), len(new - old),
+                 len(old - new))
+        return True
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # JSON batches carry text, binary events need the binary batch format
+    if args.payload_format == "struct" and args.batch_size > 1 and args.batch_format == "json":
+        parser.error("--payload-format struct needs --batch-format binary when batching")
+    setup_logging(args)
+    addresses = read_addresses(args)
+    if not addresses and not args.passive and not args.daemon:
+        parser.print_usage()
+        return 1
+    polls = parse_polls(parser, args.poll)
+    return Gateway(parser, argv, args, addresses, polls).run()
+
+if __name__ == "__main__":
+    sys.exit(main())